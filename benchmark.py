@@ -0,0 +1,300 @@
+#!/usr/bin/python3
+#pylint: disable=no-member
+
+import argparse
+import random
+import time
+import json
+import platform
+import resource
+import tracemalloc
+import gcode_parser
+import sender
+
+try:
+	import text_to_gcode.text_to_gcode as text_to_gcode
+	import glyph_cache
+except ImportError:
+	text_to_gcode = None # the text_to_gcode submodule is not checked out
+
+
+def _log_stdout(*args, **kwargs):
+	kwargs["flush"] = True
+	print(*args, **kwargs)
+
+def randomPath(moveCount, seed=0):
+	"""Random walk in step space, with short and long moves and frequent pen changes"""
+	rng = random.Random(seed)
+	path = gcode_parser.Path()
+	x, y = 0.0, 0.0
+	for _ in range(moveCount):
+		x += rng.uniform(-20.0, 20.0) if rng.random() < 0.9 else rng.uniform(-2000.0, 2000.0)
+		y += rng.uniform(-20.0, 20.0) if rng.random() < 0.9 else rng.uniform(-2000.0, 2000.0)
+		path.appendCoordinates(1 if rng.random() < 0.8 else 0, x, y)
+	return path
+
+def randomGcode(lineCount, mode="g", seed=0):
+	"""
+	Gcode similar to the one produced by CAM software, with strokes of G1 moves separated
+	by G0 moves, occasional comments and feed and speed values. The mode ("g", "feed" or
+	"speed") decides which attribute tells whether the pen is writing.
+	"""
+	rng = random.Random(seed)
+	lines = ["(generated by benchmark.py)", "G21 G90"]
+	x, y = 0.0, 0.0
+	while len(lines) < lineCount:
+		x, y = rng.uniform(0.0, 200.0), rng.uniform(0.0, 200.0)
+		if mode == "g":
+			lines.append(f"G0 X{x:.3f} Y{y:.3f}")
+		elif mode == "feed":
+			lines.append(f"G1 X{x:.3f} Y{y:.3f} F3000")
+		else:
+			lines.append(f"G1 X{x:.3f} Y{y:.3f} S1000")
+
+		for i in range(rng.randint(1, 40)):
+			x += rng.uniform(-1.0, 1.0)
+			y += rng.uniform(-1.0, 1.0)
+			comment = " (contour)" if i == 0 and rng.random() < 0.1 else ""
+			if mode == "g" or mode == "feed":
+				lines.append(f"G1 X{x:.3f} Y{y:.3f} F800{comment}")
+			else:
+				lines.append(f"G1 X{x:.3f} Y{y:.3f} S0{comment}")
+
+	return "\n".join(lines[:lineCount]) + "\n"
+
+_parsingModes = {
+	"g": dict(useG=True),
+	"feed": dict(feedVisibleBelow=1000.0),
+	"speed": dict(speedVisibleBelow=500.0),
+}
+
+def timeIt(function, *args):
+	start = time.perf_counter()
+	result = function(*args)
+	return time.perf_counter() - start, result
+
+
+def benchmarkEncoder(sizes, log=_log_stdout):
+	log(f"{'moves':>10} {'seconds':>10} {'ns/move':>10} {'bytes':>12}")
+	for size in sizes:
+		path = randomPath(size)
+		seconds, data = timeIt(gcode_parser.toBinaryData, path)
+		log(f"{size:>10} {seconds:>10.3f} {seconds / size * 1e9:>10.1f} {len(data):>12}")
+
+
+def benchmarkParser(lineCount, log=_log_stdout):
+	log(f"{'mode':>6} {'lines':>10} {'seconds':>10} {'lines/s':>10}")
+	for mode, parsingMode in _parsingModes.items():
+		data = randomGcode(lineCount, mode)
+		seconds, _ = timeIt(lambda: sum(1 for _ in gcode_parser.iterParseGcode(data, **parsingMode)))
+		log(f"{mode:>6} {lineCount:>10} {seconds:>10.3f} {lineCount / seconds:>10.0f}")
+
+
+def benchmarkParallelParser(lineCount, workerCounts, log=_log_stdout):
+	log(f"{'mode':>6} {'workers':>8} {'seconds':>10} {'lines/s':>10} {'speedup':>8} {'identical':>10}")
+	for mode, parsingMode in _parsingModes.items():
+		data = randomGcode(lineCount, mode)
+		sequentialSeconds, sequentialPath = timeIt(lambda: gcode_parser.parseGcode(data, **parsingMode))
+		log(f"{mode:>6} {'-':>8} {sequentialSeconds:>10.3f} {lineCount / sequentialSeconds:>10.0f} {1.0:>8.2f} {'-':>10}")
+
+		for workers in workerCounts:
+			seconds, path = timeIt(lambda: gcode_parser.parseGcodeParallel(data, workers=workers, **parsingMode))
+			identical = all(getattr(path, column) == getattr(sequentialPath, column) for column in ("pen", "x", "y", "lineNr"))
+			log(f"{mode:>6} {workers:>8} {seconds:>10.3f} {lineCount / seconds:>10.0f} {sequentialSeconds / seconds:>8.2f} {str(identical):>10}")
+
+
+def randomText(characterCount, letters, seed=0):
+	"""Random words made of the characters available in letters, split in lines"""
+	rng = random.Random(seed)
+	characters = sorted(character for character in letters if not character.isspace())
+	text = []
+	while len(text) < characterCount:
+		text.extend(rng.choice(characters) for _ in range(rng.randint(1, 10)))
+		text.append("\n" if rng.random() < 0.1 else " ")
+	return "".join(text[:characterCount])
+
+def _pathStages():
+	"""Stages of print.py after parsing, every one receiving the result of the previous one"""
+	return [
+		("transform", "points", len,
+			lambda path: gcode_parser.resize(gcode_parser.addEnd(gcode_parser.translateToFirstQuarter(path)), 200.0, 200.0, 10.0)),
+		("encode", "commands", len,
+			gcode_parser.toBinaryData),
+		("send", "commands", lambda data: len(data) // gcode_parser.binaryRecord.size,
+			lambda data: sender.sendData(data, None, None, simulate=True)),
+	]
+
+def _gcodeStages(gcodeData, lineCount):
+	return [
+		("detect", "lines", lambda _: lineCount,
+			lambda _: gcode_parser.detectParsingMode(gcodeData)),
+		("parse", "lines", lambda _: lineCount,
+			lambda mode: gcode_parser.parseGcode(gcodeData, *mode)),
+	] + _pathStages()
+
+def _textStages(glyphs, text):
+	return [
+		("layout", "characters", lambda _: len(text),
+			lambda _: glyph_cache.layoutText(glyphs, text, 200.0, 8.0, 1.5)),
+	] + _pathStages()
+
+def _runStages(stages, measureMemory):
+	"""Returns a list of (stage, unit, items, seconds, peakBytes) tuples"""
+	results = []
+	if measureMemory:
+		tracemalloc.start()
+
+	result = None
+	for stage, unit, countItems, function in stages:
+		items = countItems(result)
+		if measureMemory:
+			tracemalloc.reset_peak()
+			currentBytes, _ = tracemalloc.get_traced_memory()
+		seconds, result = timeIt(function, result)
+		if measureMemory:
+			_, peakBytes = tracemalloc.get_traced_memory()
+			results.append((stage, unit, items, seconds, peakBytes - currentBytes))
+		else:
+			results.append((stage, unit, items, seconds, None))
+
+	if measureMemory:
+		tracemalloc.stop()
+	return results
+
+def benchmarkSuite(sizes, textSizes, glyphDirectory, measureMemory, log=_log_stdout):
+	"""
+	Runs every stage of the print.py pipeline on generated jobs and returns the results as a
+	json serializable dict. Timings come from a run without tracemalloc, since tracing slows
+	everything down; peak memory (allocated by python during the stage) from a second traced run.
+	"""
+	jobs = []
+	for size in sizes:
+		for mode in _parsingModes:
+			jobs.append((f"gcode-{mode}", size, lambda size=size, mode=mode: _gcodeStages(randomGcode(size, mode), size)))
+
+	if text_to_gcode is None:
+		log("[info] text_to_gcode is not available, skipping text jobs")
+	else:
+		glyphs = glyph_cache.parseLetters(text_to_gcode.readLetters(glyphDirectory))
+		for size in textSizes:
+			jobs.append(("text", size, lambda size=size: _textStages(glyphs, randomText(size, glyphs))))
+
+	log(f"{'job':>11} {'size':>9} {'stage':>9} {'seconds':>9} {'items/s':>11} {'peak MiB':>9}")
+	results = []
+	for job, size, makeStages in jobs:
+		timings = _runStages(makeStages(), False)
+		memories = _runStages(makeStages(), True) if measureMemory else timings
+
+		for (stage, unit, items, seconds, _), (_, _, _, _, peakBytes) in zip(timings, memories):
+			throughput = items / seconds if seconds > 0 else None
+			results.append(dict(job=job, size=size, stage=stage, unit=unit, items=items,
+				seconds=seconds, throughput=throughput, peak_bytes=peakBytes))
+			log(f"{job:>11} {size:>9} {stage:>9} {seconds:>9.3f} "
+				+ (f"{throughput:>11.0f}" if throughput is not None else f"{'-':>11}")
+				+ (f" {peakBytes / 1024 / 1024:>9.1f}" if peakBytes is not None else f" {'-':>9}"))
+
+	return dict(
+		timestamp=time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+		python=platform.python_version(),
+		machine=platform.machine(),
+		processor=platform.processor(),
+		max_rss_bytes=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+		results=results)
+
+def compareResults(oldResults, newResults, log=_log_stdout):
+	"""Prints the ratio between new and old time and memory for stages present in both results"""
+	old = {(result["job"], result["size"], result["stage"]): result for result in oldResults["results"]}
+	log(f"old: {oldResults['timestamp']}, new: {newResults['timestamp']}")
+	log(f"{'job':>11} {'size':>9} {'stage':>9} {'old s':>9} {'new s':>9} {'time':>7} {'memory':>7}")
+	for new in newResults["results"]:
+		key = (new["job"], new["size"], new["stage"])
+		if key not in old:
+			continue
+
+		timeRatio = f"{new['seconds'] / old[key]['seconds']:>7.2f}" if old[key]["seconds"] > 0 else f"{'-':>7}"
+		if old[key]["peak_bytes"] and new["peak_bytes"] is not None:
+			memoryRatio = f"{new['peak_bytes'] / old[key]['peak_bytes']:>7.2f}"
+		else:
+			memoryRatio = f"{'-':>7}"
+		log(f"{key[0]:>11} {key[1]:>9} {key[2]:>9} {old[key]['seconds']:>9.3f} {new['seconds']:>9.3f} {timeRatio} {memoryRatio}")
+
+
+def benchmarkFormats(sizes, log=_log_stdout):
+	log(f"{'moves':>10} {'v1 bytes':>12} {'v2 bytes':>12} {'ratio':>7} {'v2 seconds':>11} {'lossless':>9}")
+	for size in sizes:
+		path = randomPath(size)
+		simpleData = gcode_parser.toBinaryData(path)
+		seconds, compactData = timeIt(gcode_parser.toCompactBinaryData, path)
+		lossless = gcode_parser.toSimpleBinaryData(compactData) == simpleData
+		log(f"{size:>10} {len(simpleData):>12} {len(compactData):>12} {len(compactData) / len(simpleData):>7.3f} {seconds:>11.3f} {str(lossless):>9}")
+
+
+def parseArgs(namespace):
+	argParser = argparse.ArgumentParser(fromfile_prefix_chars="@",
+		description="Measure the performance of the plotter software on synthetic data")
+	subparsers = argParser.add_subparsers(dest="subcommand",
+		description="Benchmark subcommands")
+
+	encodeParser = subparsers.add_parser("encode", help="Benchmark gcode_parser.toBinaryData")
+	encodeParser.add_argument("--sizes", type=int, nargs="+", default=[10**4, 10**5, 10**6, 10**7], metavar="MOVES",
+		help="Number of moves of each generated path (the time per move should stay constant)")
+
+	formatParser = subparsers.add_parser("format", help="Compare the size of the binary formats and check that they are equivalent")
+	formatParser.add_argument("--sizes", type=int, nargs="+", default=[10**4, 10**5, 10**6], metavar="MOVES",
+		help="Number of moves of each generated path")
+
+	parseParser = subparsers.add_parser("parse", help="Benchmark the gcode tokenizer and parser in every parsing mode")
+	parseParser.add_argument("--lines", type=int, default=10**6, metavar="LINES",
+		help="Number of lines of the generated gcode")
+
+	parallelParser = subparsers.add_parser("parallel", help="Benchmark parsing with gcode_parser.parseGcodeParallel using different numbers of workers")
+	parallelParser.add_argument("--lines", type=int, default=10**6, metavar="LINES",
+		help="Number of lines of the generated gcode")
+	parallelParser.add_argument("--workers", type=int, nargs="+", default=[2, 4, 8], metavar="WORKERS",
+		help="Numbers of worker processes to try (the sequential parser is always measured too)")
+
+	suiteParser = subparsers.add_parser("suite", help="Benchmark every stage of the print.py pipeline (detect, parse, transform, encode, send) on generated gcode and text jobs")
+	suiteParser.add_argument("--sizes", type=int, nargs="+", default=[10**3, 10**4, 10**5, 10**6], metavar="LINES",
+		help="Number of lines of the generated gcode jobs, in each parsing mode (up to 10**7 is reasonable)")
+	suiteParser.add_argument("--text-sizes", type=int, nargs="+", default=[10**2, 10**3, 10**4], metavar="CHARACTERS",
+		help="Number of characters of the generated text jobs")
+	suiteParser.add_argument("--gcode-directory", type=str, default="./text_to_gcode/ascii_gcode/", metavar="DIR",
+		help="Directory containing the gcode information for all characters, used by text jobs")
+	suiteParser.add_argument("--no-memory", action="store_true",
+		help="Do not measure the peak memory of every stage, which requires running every job twice")
+	suiteParser.add_argument("-o", "--output", type=argparse.FileType('w'), metavar="FILE",
+		help="JSON file in which to save the results, to be compared with the compare subcommand")
+
+	compareParser = subparsers.add_parser("compare", help="Compare the results of two runs of the suite subcommand")
+	compareParser.add_argument("old", type=argparse.FileType('r'), metavar="OLD",
+		help="JSON results of the old run")
+	compareParser.add_argument("new", type=argparse.FileType('r'), metavar="NEW",
+		help="JSON results of the new run")
+
+	argParser.parse_args(namespace=namespace)
+
+	if namespace.subcommand is None:
+		argParser.error(f"exactly one subcommand from the following is required: encode, format, parse, parallel, suite, compare")
+
+def main():
+	class Args: pass
+	parseArgs(Args)
+
+	if Args.subcommand == "encode":
+		benchmarkEncoder(Args.sizes)
+	elif Args.subcommand == "format":
+		benchmarkFormats(Args.sizes)
+	elif Args.subcommand == "parse":
+		benchmarkParser(Args.lines)
+	elif Args.subcommand == "parallel":
+		benchmarkParallelParser(Args.lines, Args.workers)
+	elif Args.subcommand == "suite":
+		results = benchmarkSuite(Args.sizes, Args.text_sizes, Args.gcode_directory, not Args.no_memory)
+		if Args.output is not None:
+			json.dump(results, Args.output, indent=1)
+	elif Args.subcommand == "compare":
+		compareResults(json.load(Args.old), json.load(Args.new))
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,496 @@
+#!/usr/bin/python3
+#pylint: disable=no-member
+
+import argparse
+import os
+import errno
+import time
+import math
+import struct
+import select
+import fcntl
+import termios
+import threading
+import collections
+import weakref
+import job_log
+
+# constants and timings of plotter_new/plotter_new.ino and of the Arduino libraries it uses
+stepsPerRevolution = 200
+motorSpeed = 50 # rpm
+stepDelay = 60.0 / stepsPerRevolution / motorSpeed # seconds between two steps of a motor
+stepsDiagonalAtOnce = 20
+penDelay = 0.1 # seconds
+serialBufferSize = 64 # bytes, both for receiving and transmitting
+bitsPerByte = 10 # start bit, 8 data bits, stop bit
+lcdCharacterTime = 0.000204 # seconds, approximately two 4-bit transfers with their delays
+lcdLineLength = 16
+defaultBootTime = 1.5 # seconds between the port being opened (resetting the board) and "Setup"
+
+
+def _log_nothing(*args, **kwargs):
+	pass
+
+def _closeInForkedChild(emulatorReference):
+	emulator = emulatorReference()
+	if emulator is not None and emulator.master is not None:
+		os.close(emulator.master)
+
+def _int16(value):
+	return (value + 0x8000) % 0x10000 - 0x8000
+
+def _float32(value):
+	return struct.unpack("f", struct.pack("f", value))[0]
+
+def _sign(n):
+	return 1 if _int16(n) >= 0 else -1
+
+def _stepOld(x, y):
+	# the motors are mounted diagonally, so each one moves along x+y or x-y
+	aSteps, bSteps = _int16(abs(x + y)), _int16(abs(x - y))
+	aSign, bSign = _sign(x + y), _sign(x - y)
+
+	if aSteps == 0:
+		yield 1, bSteps * bSign
+	elif bSteps == 0:
+		yield 0, aSteps * aSign
+	elif aSteps == bSteps:
+		for _ in range(aSteps):
+			yield 0, aSign
+			yield 1, bSign
+	else:
+		# the motor with less steps makes one step at a time, the other one follows
+		few, many = (0, 1) if aSteps < bSteps else (1, 0)
+		fewSteps, manySteps = (aSteps, bSteps) if aSteps < bSteps else (bSteps, aSteps)
+		fewSign, manySign = (aSign, bSign) if aSteps < bSteps else (bSign, aSign)
+
+		done = 0
+		total = 0.0
+		stepsEvery = _float32(float(manySteps) / float(fewSteps))
+		for _ in range(fewSteps):
+			total = _float32(total + stepsEvery)
+			toDo = _int16(int(_float32(total - done)))
+			done += toDo
+			yield few, fewSign
+			yield many, toDo * manySign
+
+def firmwareSteps(x, y):
+	"""
+	Yields the (motor, steps) calls to Stepper.step() made by the firmware to move by (x, y)
+	steps, where motor is 0 for the motor moving along x+y and 1 for the one along x-y.
+	Float and int16 arithmetic is replicated, so rounding errors are the same.
+	"""
+	x, y = _int16(-x), _int16(y) # the firmware calls step2(-x, y)
+	if x == 0 or y == 0:
+		yield from _stepOld(x, y)
+		return
+
+	swapped = abs(y) > abs(x)
+	if swapped:
+		x, y = y, x
+	def stepSwap(stepX, stepY):
+		return _stepOld(stepY, stepX) if swapped else _stepOld(stepX, stepY)
+
+	xSign, ySign = _sign(x), _sign(y)
+	xAbs, yAbs = abs(x), abs(y)
+	xDone, yDone = 0, 0
+	yTotal = 0.0
+	stepsYEveryX = _float32(float(yAbs) / float(xAbs))
+	while xDone + stepsDiagonalAtOnce < xAbs:
+		yTotal = _float32(yTotal + _float32(stepsYEveryX * stepsDiagonalAtOnce))
+		yToDo = _int16(int(_float32(yTotal - yDone)))
+		yDone += yToDo
+		xDone += stepsDiagonalAtOnce
+		yield from stepSwap(stepsDiagonalAtOnce * xSign, 0)
+		yield from stepSwap(0, yToDo * ySign)
+	yield from stepSwap((xAbs - xDone) * xSign, 0)
+	yield from stepSwap(0, (yAbs - yDone) * ySign)
+
+
+class MotorClock:
+	"""
+	Timing of the Stepper library: step() busy waits until stepDelay has passed since the
+	previous step of the same motor, so a motor may step right away after the other one moved.
+	"""
+
+	def __init__(self):
+		self.lastStep = [-math.inf, -math.inf]
+		self.position = [0, 0]
+
+	def step(self, now, motor, steps):
+		"""Returns the time at which the steps are completed"""
+		if steps == 0:
+			return now
+		first = max(now, self.lastStep[motor] + stepDelay)
+		self.lastStep[motor] = first + (abs(steps) - 1) * stepDelay
+		self.position[motor] += steps
+		return self.lastStep[motor]
+
+	def move(self, now, x, y):
+		for motor, steps in firmwareSteps(x, y):
+			now = self.step(now, motor, steps)
+		return now
+
+
+class _Disconnected(Exception):
+	pass
+
+class PlotterEmulator:
+	"""
+	Emulates a plotter running plotter_new.ino behind a pseudo-terminal, which can be opened
+	as a serial port. Opening the port resets the plotter, as with a real Arduino. Bytes travel
+	at the baud rate through 64-byte buffers (overflowing bytes are dropped and reported), and
+	motors, pen and LCD take the time they take on the real plotter. Everything runs in real
+	time, or speed times faster. protocolVersion 1 or 2 emulates older versions of the firmware.
+	"""
+
+	def __init__(self, protocolVersion=3, baudRate=9600, speed=1.0, bootTime=defaultBootTime, recordFile=None, log=_log_nothing):
+		self.protocolVersion = protocolVersion
+		self.byteTime = bitsPerByte / baudRate
+		self.speed = speed
+		self.bootTime = bootTime
+		self.recordFile = recordFile
+		self.log = log
+
+		self.master, slave = os.openpty()
+		self.port = os.ttyname(slave)
+		os.close(slave)
+		# The plotter is reset when the port is opened, detected from the input flush pyserial does
+		# when opening it. In packet mode the flush is reported until it is read, so also a port
+		# closed and reopened right away is noticed, while the hang up in between may be missed.
+		fcntl.ioctl(self.master, termios.TIOCPKT, struct.pack("i", 1))
+		self.reopened = False # whether the port was opened again while a connection was running
+		# processes forked afterwards (e.g. pools preparing jobs) would keep the port open after unplug()
+		os.register_at_fork(after_in_child=lambda reference=weakref.ref(self): _closeInForkedChild(reference))
+
+		self.condition = threading.Condition()
+		self.connected = False
+		self.stopped = False
+		self.jobsCompleted = 0
+		self.connections = 0 # times the port was opened, each resetting the emulated board
+		self.jobLimit = None
+		self.thread = None
+
+	def start(self, jobs=None):
+		"""Starts emulating in a background thread and returns the port to connect to"""
+		self.thread = threading.Thread(target=self.run, args=(jobs,), daemon=True)
+		self.thread.start()
+		return self.port
+
+	def stop(self):
+		with self.condition:
+			self.stopped = True
+			self.condition.notify_all()
+		if self.thread is not None:
+			self.thread.join()
+
+	def unplug(self):
+		"""Stops emulating and closes the pseudo-terminal, so that the port fails like a cable pulled out"""
+		self.stop()
+		os.close(self.master)
+		self.master = None
+
+	def run(self, jobs=None):
+		"""Emulates connection after connection, until jobs jobs have been completed (forever if None)"""
+		self.jobLimit = jobs
+		while not self.stopped and (jobs is None or self.jobsCompleted < jobs):
+			if not self._waitForConnection():
+				break
+			try:
+				self._runConnection()
+			except _Disconnected:
+				self.log("[info] Disconnected")
+
+	def _readPacket(self):
+		"""Returns (status, data) read from the port, with status None if the port is closed"""
+		try:
+			packet = os.read(self.master, 4096)
+		except OSError as e:
+			if e.errno != errno.EIO:
+				raise
+			return None, b""
+		if not packet:
+			return None, b""
+		if packet[0] == termios.TIOCPKT_DATA:
+			return termios.TIOCPKT_DATA, packet[1:]
+		return packet[0], b""
+
+	def _discardInput(self):
+		# whatever is still there was sent before the port was opened
+		poll = select.poll()
+		poll.register(self.master, select.POLLIN | select.POLLPRI)
+		while any(event & (select.POLLIN | select.POLLPRI) for _, event in poll.poll(0)):
+			status, _ = self._readPacket()
+			if status is None:
+				return
+
+	def _waitForConnection(self):
+		poll = select.poll()
+		poll.register(self.master, select.POLLIN | select.POLLPRI)
+		while not self.stopped:
+			if self.reopened:
+				self.reopened = False
+				return True
+			events = poll.poll(100)
+			if not any(event & (select.POLLIN | select.POLLPRI) for _, event in events):
+				if events:
+					# the port is closed, and the hang up is reported continuously
+					time.sleep(0.01)
+				continue
+			status, _ = self._readPacket()
+			if status is not None and status & termios.TIOCPKT_FLUSHREAD:
+				self._discardInput()
+				return True
+		return False
+
+	def _runConnection(self):
+		self.connectionTime = time.monotonic()
+		self.now = 0.0 # emulated seconds since the connection
+		self.received = collections.deque() # (time at which it is available, byte)
+		self.receivedUntil = 0.0
+		self.transmittedUntil = 0.0
+		self.overflows = 0
+		self.connections += 1
+		self.connected = True
+
+		self.transmitQueue = collections.deque()
+		reader = threading.Thread(target=self._readLoop, daemon=True)
+		reader.start()
+		writer = threading.Thread(target=self._writeLoop, daemon=True)
+		writer.start()
+		try:
+			self._firmware()
+		finally:
+			with self.condition:
+				self.connected = False
+				self.condition.notify_all()
+			reader.join()
+			writer.join()
+
+	def _realTime(self, emulatedTime):
+		return self.connectionTime + emulatedTime / self.speed
+
+	def _emulatedTime(self):
+		return (time.monotonic() - self.connectionTime) * self.speed
+
+	def _readLoop(self):
+		poll = select.poll()
+		poll.register(self.master, select.POLLIN | select.POLLPRI | select.POLLHUP)
+		while True:
+			with self.condition:
+				if not self.connected or self.stopped:
+					return
+			events = poll.poll(50)
+			if not events:
+				continue
+			status, data = self._readPacket()
+			if status is None or status & termios.TIOCPKT_FLUSHREAD:
+				# the port was closed, or closed and opened again
+				with self.condition:
+					if status is not None:
+						self.reopened = True
+						self.transmitQueue.clear()
+					self.connected = False
+					self.condition.notify_all()
+				if status is not None:
+					self._discardInput()
+				return
+			if not data:
+				continue
+
+			arrival = self._emulatedTime()
+			with self.condition:
+				for byte in data:
+					# bytes reach the plotter one after the other at the baud rate
+					self.receivedUntil = max(self.receivedUntil, arrival) + self.byteTime
+					self.received.append((self.receivedUntil, byte))
+				self.condition.notify_all()
+
+	def _writeLoop(self):
+		while True:
+			with self.condition:
+				while not self.transmitQueue and self.connected and not self.stopped:
+					self.condition.wait()
+				if not self.transmitQueue:
+					return
+				deliveryTime, data = self.transmitQueue.popleft()
+
+			self._sleepUntil(deliveryTime)
+			if self.reopened:
+				# the replies of the previous connection are lost with the reset
+				return
+			try:
+				os.write(self.master, data)
+			except OSError:
+				return
+
+	def _wait(self, seconds):
+		self.now += seconds
+
+	def _sleepUntil(self, emulatedTime):
+		delay = self._realTime(emulatedTime) - time.monotonic()
+		if delay > 0:
+			time.sleep(delay)
+
+	def _readByte(self):
+		# wait for the real time to catch up, so that everything received until now is known
+		self._sleepUntil(self.now)
+
+		with self.condition:
+			while not self.received:
+				if not self.connected or self.stopped:
+					raise _Disconnected()
+				self.condition.wait()
+
+			# bytes received while the receive buffer was full are lost
+			buffered = sum(1 for availableTime, _ in self.received if availableTime <= self.now)
+			if buffered > serialBufferSize - 1:
+				self.overflows += buffered - (serialBufferSize - 1)
+				self.log(f"[WARNING] Receive buffer overflow, {buffered - (serialBufferSize - 1)} bytes lost", level="warning")
+				kept = list(self.received)
+				self.received = collections.deque(kept[:serialBufferSize - 1] + kept[buffered:])
+
+			availableTime, byte = self.received.popleft()
+			self.now = max(self.now, availableTime)
+			return byte
+
+	def _serialPrint(self, text):
+		data = text.encode("ascii")
+		for _ in data:
+			# Serial.print() blocks while the transmit buffer is full
+			queuedBytes = (self.transmittedUntil - self.now) / self.byteTime
+			if queuedBytes > serialBufferSize:
+				self.now = self.transmittedUntil - serialBufferSize * self.byteTime
+			self.transmittedUntil = max(self.transmittedUntil, self.now) + self.byteTime
+		with self.condition:
+			self.transmitQueue.append((self.transmittedUntil, data))
+			self.condition.notify_all()
+
+	def _lcdPrint(self, text, newline=False):
+		characters = len(text)
+		if newline:
+			# setCursor, clearing the line with spaces and setCursor again
+			characters += lcdLineLength + 2
+		self._wait(characters * lcdCharacterTime)
+
+	def _logMsg(self, text):
+		self._serialPrint(text)
+		self._lcdPrint(text)
+
+	def _loglnMsg(self, text):
+		self._serialPrint(text + "\r\n")
+		self._lcdPrint(text, newline=True)
+
+	def _record(self, mode, x, y):
+		if self.recordFile is not None:
+			self.recordFile.write(struct.pack(">chh", mode, x, y))
+
+	def _firmware(self):
+		self._wait(self.bootTime)
+		self._serialPrint("Setup\r\n")
+		motors = MotorClock()
+		penIsWriting = False
+		self._wait(penDelay)
+		commands = 0
+
+		while True:
+			mode = self._readByte()
+			isMovement = True
+			if mode == ord("w") or mode == ord("m"):
+				x, y = struct.unpack(">hh", bytes(self._readByte() for _ in range(4)))
+				newPenIsWriting = mode == ord("w")
+			elif self.protocolVersion >= 2 and (mode == ord("W") or mode == ord("M")):
+				x, y = struct.unpack(">bb", bytes(self._readByte() for _ in range(2)))
+				newPenIsWriting = mode == ord("W")
+			elif self.protocolVersion >= 2 and mode & 0x80:
+				x = ((mode >> 3) & 0b111) - (8 if mode & 0b100000 else 0)
+				y = (mode & 0b111) - (8 if mode & 0b100 else 0)
+				newPenIsWriting = bool(mode & 0x40)
+			else:
+				isMovement = False
+
+			if isMovement:
+				if newPenIsWriting != penIsWriting:
+					penIsWriting = newPenIsWriting
+					self._wait(penDelay)
+
+				self._logMsg("w x=" if penIsWriting else "m x=")
+				self._logMsg(str(x))
+				self._logMsg(" y=")
+				self._logMsg(str(y))
+				self.now = motors.move(self.now, x, y)
+				self._loglnMsg("*")
+				self._record(b"w" if penIsWriting else b"m", x, y)
+				commands += 1
+
+			elif mode == ord("a"):
+				penIsWriting = False
+				self._wait(penDelay)
+				self._loglnMsg("Completed!")
+				self.jobsCompleted += 1
+				self.log(f"[info] Job completed: {commands} commands in {self.now:.3f}s (emulated),"
+					+ f" motor positions {motors.position[0]} {motors.position[1]}, {self.overflows} bytes lost")
+				commands = 0
+				if self.recordFile is not None:
+					self.recordFile.flush()
+				if self.jobLimit is not None and self.jobsCompleted >= self.jobLimit:
+					self._sleepUntil(self.transmittedUntil)
+					return
+
+			elif mode == ord("v") and self.protocolVersion >= 2:
+				if self.protocolVersion >= 3:
+					self._serialPrint(f"Protocol {self.protocolVersion} window {serialBufferSize - 1}\r\n")
+				else:
+					self._serialPrint(f"Protocol {self.protocolVersion}\r\n")
+
+
+def parseArgs(namespace):
+	argParser = argparse.ArgumentParser(fromfile_prefix_chars="@",
+		description="Emulate a plotter running plotter_new.ino on a pseudo-terminal, printing its path on stdout")
+	argParser.add_argument("--protocol", type=int, choices=[1, 2, 3], default=3, metavar="VERSION",
+		help="Protocol version of the emulated firmware, to emulate older versions (default: 3)")
+	argParser.add_argument("--baud", "--baud-rate", type=int, default=9600, metavar="RATE", dest="baud_rate",
+		help="Baud rate of the emulated serial connection (default: 9600)")
+	argParser.add_argument("--speed", type=float, default=1.0, metavar="FACTOR",
+		help="Run FACTOR times faster than the real plotter (default: 1)")
+	argParser.add_argument("--boot-time", type=float, default=defaultBootTime, metavar="SECONDS",
+		help=f"Time between opening the port and the \"Setup\" message (default: {defaultBootTime})")
+	argParser.add_argument("--jobs", type=int, metavar="COUNT",
+		help="Exit after COUNT jobs have been completed (default: never)")
+	argParser.add_argument("--link", type=str, metavar="PATH",
+		help="Create a symbolic link to the pseudo-terminal at PATH")
+	argParser.add_argument("-r", "--record", type=argparse.FileType('wb'), metavar="FILE",
+		help="File in which to save all of the received movements, as version 1 binary data")
+	argParser.add_argument("-l", "--log", type=argparse.FileType('w'), required=False, metavar="FILE",
+		help="File in which to save logs about jobs and errors")
+	argParser.add_argument("--log-level", type=str, choices=job_log.levelNames, default=job_log.defaultLevel, metavar="LEVEL",
+		help=f"Log only messages at least as important as LEVEL, one of {', '.join(job_log.levelNames)} (default: {job_log.defaultLevel})")
+	argParser.add_argument("--log-format", type=str, choices=job_log.formats, default="text", metavar="FORMAT",
+		help="Write logs as plain \"text\" (default) or as \"json\" lines with time, level and message")
+	argParser.parse_args(namespace=namespace)
+
+def main():
+	class Args: pass
+	parseArgs(Args)
+
+	# written by a separate thread, so that logging does not delay the emulated plotter
+	log = job_log.noLog if Args.log is None else job_log.Logger(Args.log, Args.log_level, Args.log_format, background=True)
+
+	emulator = PlotterEmulator(Args.protocol, Args.baud_rate, Args.speed, Args.boot_time, Args.record, log=log)
+	if Args.link is not None:
+		if os.path.islink(Args.link):
+			os.remove(Args.link)
+		os.symlink(emulator.port, Args.link)
+	print(emulator.port, flush=True)
+
+	try:
+		emulator.run(Args.jobs)
+	except KeyboardInterrupt:
+		pass
+	finally:
+		if Args.link is not None:
+			os.remove(Args.link)
+
+
+if __name__ == "__main__":
+	main()
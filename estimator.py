@@ -0,0 +1,159 @@
+#!/usr/bin/python3
+#pylint: disable=no-member
+
+import argparse
+import json
+import collections
+import gcode_parser
+import emulator
+
+defaultWindowSize = emulator.serialBufferSize - 1 # what current plotters advertise
+defaultHostLatency = 0.001 # seconds between receiving a reply and sending the next command
+
+
+class DurationEstimate:
+	"""Time (in seconds) the plotter spends on each activity while printing a job"""
+
+	def __init__(self):
+		self.drawing = 0.0 # moving the motors with the pen down
+		self.travel = 0.0 # moving the motors with the pen up
+		self.pen = 0.0 # waiting for the pen servo
+		self.communication = 0.0 # waiting for commands to arrive or for replies to be transmitted
+		self.display = 0.0 # printing on the LCD
+		self.commands = 0
+		self.steps = 0
+
+	def total(self):
+		return self.drawing + self.travel + self.pen + self.communication + self.display
+
+	def toDict(self):
+		return dict(total=self.total(), drawing=self.drawing, travel=self.travel, pen=self.pen,
+			communication=self.communication, display=self.display, commands=self.commands, steps=self.steps)
+
+	def summary(self):
+		total = self.total()
+		lines = [f"Estimated duration: {total:.1f}s ({self.commands} commands, {self.steps} steps)"]
+		for name in ["drawing", "travel", "pen", "communication", "display"]:
+			seconds = getattr(self, name)
+			lines.append(f"  {name:<14} {seconds:>10.1f}s {seconds / total * 100 if total else 0.0:>6.1f}%")
+		return "\n".join(lines)
+
+
+def estimateDuration(data, baudRate=9600, windowSize=defaultWindowSize, hostLatency=defaultHostLatency):
+	"""
+	Estimates how long the plotter takes to print binary data (in any format), from the first
+	command to "Completed!". It follows the timeline of plotter_new.ino, as emulator.py does:
+	every movement is made of axis-aligned pieces where both motors step together, so each
+	piece takes one stepDelay per step and pieces follow each other seamlessly. Commands and
+	replies travel at the baud rate; with a windowSize of 0 every command is sent only after
+	the reply to the previous one (stop-and-wait), otherwise as soon as the window allows.
+	"""
+	estimate = DurationEstimate()
+	byteTime = emulator.bitsPerByte / baudRate
+
+	now = 0.0 # firmware clock
+	lastStep = -emulator.stepDelay # time of the last motor step
+	receivedUntil = 0.0 # time at which the last byte sent by the host has arrived
+	transmittedUntil = 0.0 # time at which the last byte printed by the plotter leaves
+	hostReady = 0.0 # time at which the host can send the next command
+	inFlight = collections.deque() # (length, reply time) of commands not yet acknowledged
+	inFlightBytes = 0
+	penIsWriting = False
+
+	def serialPrint(text):
+		nonlocal now, transmittedUntil
+		for _ in range(len(text)):
+			# Serial.print() blocks while the transmit buffer is full
+			queuedBytes = (transmittedUntil - now) / byteTime
+			if queuedBytes > emulator.serialBufferSize:
+				blockedUntil = transmittedUntil - emulator.serialBufferSize * byteTime
+				estimate.communication += blockedUntil - now
+				now = blockedUntil
+			transmittedUntil = max(transmittedUntil, now) + byteTime
+
+	def lcdPrint(characters):
+		nonlocal now
+		estimate.display += characters * emulator.lcdCharacterTime
+		now += characters * emulator.lcdCharacterTime
+
+	estimate.pen += emulator.penDelay
+	now += emulator.penDelay
+
+	for mode, x, y, offset, length in gcode_parser.iterBinaryCommands(data):
+		# the host sends the command as soon as the window (or the previous reply) allows it
+		while inFlight and inFlightBytes + length > windowSize:
+			replyLength, replyTime = inFlight.popleft()
+			inFlightBytes -= replyLength
+			hostReady = max(hostReady, replyTime + hostLatency)
+		receivedUntil = max(receivedUntil, hostReady) + length * byteTime
+		if receivedUntil > now:
+			estimate.communication += receivedUntil - now
+			now = receivedUntil
+
+		newPenIsWriting = mode == gcode_parser.writeByte
+		if newPenIsWriting != penIsWriting:
+			penIsWriting = newPenIsWriting
+			estimate.pen += emulator.penDelay
+			now += emulator.penDelay
+
+		text = f"{'w' if penIsWriting else 'm'} x={x} y={y}"
+		serialPrint(text)
+		lcdPrint(len(text))
+
+		steps = abs(x) + abs(y)
+		if steps > 0:
+			firstStep = max(now, lastStep + emulator.stepDelay)
+			lastStep = firstStep + (steps - 1) * emulator.stepDelay
+			if penIsWriting:
+				estimate.drawing += lastStep - now
+			else:
+				estimate.travel += lastStep - now
+			now = lastStep
+
+		serialPrint("*\r\n")
+		lcdPrint(1 + emulator.lcdLineLength + 2)
+		inFlight.append((length, transmittedUntil))
+		inFlightBytes += length
+		estimate.commands += 1
+		estimate.steps += steps
+
+	# the final 'a' is sent after every reply has been received
+	for _, replyTime in inFlight:
+		hostReady = max(hostReady, replyTime + hostLatency)
+	receivedUntil = max(receivedUntil, hostReady) + byteTime
+	if receivedUntil > now:
+		estimate.communication += receivedUntil - now
+		now = receivedUntil
+	estimate.pen += emulator.penDelay
+	now += emulator.penDelay
+	serialPrint("Completed!\r\n")
+	lcdPrint(len("Completed!") + emulator.lcdLineLength + 2)
+	estimate.communication += transmittedUntil - now
+	return estimate
+
+
+def parseArgs(namespace):
+	argParser = argparse.ArgumentParser(fromfile_prefix_chars="@",
+		description="Estimate how long the plotter takes to print binary data")
+	argParser.add_argument("-i", "--input", type=argparse.FileType('rb'), required=True, metavar="FILE",
+		help="Binary file containing the data to estimate (in any format)")
+	argParser.add_argument("--baud", "--baud-rate", type=int, default=9600, metavar="RATE", dest="baud_rate",
+		help="Baud rate of the connection with the plotter (default: 9600)")
+	argParser.add_argument("--window", type=int, default=defaultWindowSize, metavar="BYTES",
+		help=f"Bytes of commands that can be sent without waiting for replies, 0 for plotters with protocol version 1 or 2 (default: {defaultWindowSize})")
+	argParser.add_argument("--host-latency", type=float, default=defaultHostLatency, metavar="SECONDS",
+		help=f"Time the computer takes to react to a reply (default: {defaultHostLatency})")
+	argParser.add_argument("--json", action="store_true",
+		help="Print the estimate as json instead of as a human readable summary")
+	argParser.parse_args(namespace=namespace)
+
+def main():
+	class Args: pass
+	parseArgs(Args)
+
+	estimate = estimateDuration(Args.input.read(), Args.baud_rate, Args.window, Args.host_latency)
+	print(json.dumps(estimate.toDict(), indent=1) if Args.json else estimate.summary())
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,351 @@
+#!/usr/bin/python3
+#pylint: disable=no-member
+
+import argparse
+import os
+import sys
+import time
+import json
+import threading
+import collections
+import concurrent.futures
+import serial
+import gcode_parser
+import sender
+import job_cache
+import job_stats
+import job_log
+
+binaryExtension = ".bin"
+
+
+def _log_nothing(*args, **kwargs):
+	pass
+
+def prepareJob(path, options, cacheDirectory=None, logLevels=job_log.levelNames):
+	"""
+	Returns (binaryData, messages) for the job in path, where messages are the (args, kwargs) of
+	the log calls made while preparing it, only for the levels in logLevels. Files ending with
+	.bin are sent as they are, anything else is parsed as gcode and transformed according to
+	options (a dict with the gcode options of print.py). Runs in the preparation processes, so
+	everything has to be picklable.
+	"""
+	if path.endswith(binaryExtension):
+		with open(path, "rb") as file:
+			return file.read(), []
+
+	messages = []
+	def log(*args, **kwargs):
+		if kwargs.get("level", job_log.defaultLevel) in logLevels:
+			messages.append((args, kwargs))
+	log.isEnabled = lambda level: level in logLevels
+
+	with open(path, "r") as file:
+		data = file.read()
+
+	cache = None
+	if cacheDirectory is not None:
+		cache = job_cache.JobCache(cacheDirectory, log=log)
+		# the same key as print.py, so that jobs prepared by either are found by the other
+		key = job_cache.jobKey(job_cache.hashData(data), dict(options, subcommand="gcode"))
+		cached = cache.get(key)
+		if cached is not None:
+			return cached[0], messages
+
+	binaryData, _ = gcode_parser.gcodeToBinary(data, options, log=log)
+	if cache is not None:
+		cache.put(key, binaryData)
+	return binaryData, messages
+
+
+class Plotter:
+	"""A plotter of the farm, with the statistics of the jobs it printed"""
+
+	def __init__(self, port):
+		self.port = port
+		self.connection = None # sender.Connection, kept open between jobs
+		self.stats = job_stats.Stats() # filled by sender.sendData
+		self.jobsPrinted = 0
+		self.jobsFailed = 0
+		self.printingTime = 0.0 # seconds spent sending jobs
+		self.connectingTime = 0.0 # seconds spent waiting for the plotter to reset after opening the port
+		self.waitingTime = 0.0 # seconds spent waiting for the next job to be prepared
+		self.failed = False # whether the connection failed and the plotter was taken out of the farm
+
+	def utilization(self, wallTime):
+		return self.printingTime / wallTime if wallTime > 0 else 0.0
+
+	def toDict(self, wallTime):
+		return dict(port=self.port, jobsPrinted=self.jobsPrinted, jobsFailed=self.jobsFailed,
+			printingTime=self.printingTime, connectingTime=self.connectingTime, waitingTime=self.waitingTime, utilization=self.utilization(wallTime),
+			failed=self.failed, commandsSent=self.stats.counters.get("commands sent", 0),
+			bytesSent=self.stats.counters.get("bytes sent", 0))
+
+
+class PlotterFarm:
+	"""
+	Prints a queue of jobs on several plotters at once, with one thread per plotter sending the
+	next job as soon as the previous one is completed, on a connection kept open between jobs
+	(opening the port resets the plotter). Jobs are prepared in a pool of processes,
+	a few of them ahead of the plotters, so that plotters do not wait for parsing and encoding.
+	When the connection fails it is opened again once, and if that fails too the plotter is taken out
+	of the farm; in both cases its job is given to another one.
+	"""
+
+	def __init__(self, ports, baudRate, options, prepareWorkers=None, cacheDirectory=None, windowed=True, log=_log_nothing):
+		self.plotters = [Plotter(port) for port in ports]
+		self.baudRate = baudRate
+		self.options = options
+		self.prepareWorkers = prepareWorkers or os.cpu_count() or 1
+		self.cacheDirectory = cacheDirectory
+		self.windowed = windowed
+		self.log = log
+		# the preparation processes can't use log, so they record the messages for these levels
+		self.logLevels = [] if log is _log_nothing else [level for level in job_log.levelNames if job_log.isEnabled(log, level)]
+
+		self.lock = threading.Lock()
+		self.pendingPaths = collections.deque()
+		self.preparedJobs = collections.deque() # (path, future) in order
+		self.stopping = False
+		self.failedPaths = []
+		self.wallTime = 0.0
+
+	def _prepareAhead(self):
+		# keep one job ready for every plotter, plus one being prepared by every worker
+		while self.pendingPaths and len(self.preparedJobs) < len(self.plotters) + self.prepareWorkers:
+			path = self.pendingPaths.popleft()
+			self.preparedJobs.append((path, self.executor.submit(prepareJob, path, self.options, self.cacheDirectory, self.logLevels)))
+
+	def _takeJob(self):
+		with self.lock:
+			if self.stopping or not self.preparedJobs:
+				return None
+			job = self.preparedJobs.popleft()
+			self._prepareAhead()
+			return job
+
+	def _giveBack(self, job):
+		with self.lock:
+			self.preparedJobs.appendleft(job)
+
+	def _connect(self, plotter, plotterLog):
+		start = time.perf_counter()
+		try:
+			plotter.connection = sender.Connection(plotter.port, self.baudRate, log=plotterLog)
+			return True
+		except (serial.SerialException, OSError) as e:
+			plotterLog(f"[error] Could not connect, taking the plotter out of the farm: {e}", level="error")
+			plotter.failed = True
+			return False
+		finally:
+			plotter.connectingTime += time.perf_counter() - start
+
+	def _disconnect(self, plotter):
+		if plotter.connection is not None:
+			try:
+				plotter.connection.close()
+			except (serial.SerialException, OSError):
+				pass
+			plotter.connection = None
+
+	def _runPlotter(self, plotter):
+		if self.log is _log_nothing:
+			# lets sendData skip formatting messages
+			plotterLog = sender._log_nothing
+		else:
+			def plotterLog(*args, **kwargs):
+				self.log(f"[{plotter.port}]", *args, **kwargs)
+			# lets sendData skip formatting messages that would not be written
+			plotterLog.isEnabled = lambda level: job_log.isEnabled(self.log, level)
+
+		if not self._connect(plotter, plotterLog):
+			return
+		try:
+			self._printJobs(plotter, plotterLog)
+		finally:
+			self._disconnect(plotter)
+
+	def _printJobs(self, plotter, plotterLog):
+		# whether the connection was opened again after failing, and no job was completed since then
+		reconnected = False
+		while True:
+			job = self._takeJob()
+			if job is None:
+				return
+			path, future = job
+
+			start = time.perf_counter()
+			try:
+				data, messages = future.result()
+			except Exception as e:
+				plotterLog(f"[error] Could not prepare {path}: {e}", level="error")
+				plotter.jobsFailed += 1
+				with self.lock:
+					self.failedPaths.append(path)
+				continue
+			finally:
+				plotter.waitingTime += time.perf_counter() - start
+			for args, kwargs in messages:
+				plotterLog(*args, **kwargs)
+
+			plotterLog(f"[info] Printing {path}")
+			start = time.perf_counter()
+			try:
+				sender.sendData(data, plotter.port, self.baudRate, log=plotterLog, stats=plotter.stats, windowed=self.windowed,
+					connection=plotter.connection)
+			except (serial.SerialException, OSError) as e:
+				plotter.printingTime += time.perf_counter() - start
+				self._giveBack(job)
+				self._disconnect(plotter)
+				if reconnected:
+					plotterLog(f"[error] Connection failed again, taking the plotter out of the farm: {e}", level="error")
+					plotter.failed = True
+					return
+				plotterLog(f"[error] Connection failed, connecting again: {e}", level="error")
+				if not self._connect(plotter, plotterLog):
+					return
+				reconnected = True
+				continue
+			plotter.printingTime += time.perf_counter() - start
+			plotter.jobsPrinted += 1
+			reconnected = False
+			plotterLog(f"[info] Completed {path}")
+
+	def run(self, paths):
+		"""Prints every job in paths on the first plotter available, returning once all are done"""
+		start = time.perf_counter()
+		self.pendingPaths.extend(paths)
+		self.executor = concurrent.futures.ProcessPoolExecutor(self.prepareWorkers)
+		try:
+			with self.lock:
+				self._prepareAhead()
+			threads = [threading.Thread(target=self._runPlotter, args=(plotter,), daemon=True) for plotter in self.plotters]
+			for thread in threads:
+				thread.start()
+
+			try:
+				for thread in threads:
+					thread.join()
+			except KeyboardInterrupt:
+				with self.lock:
+					self.stopping = True
+				self.log("[info] Waiting for the jobs being printed to complete, press Ctrl+C again to abort")
+				for thread in threads:
+					thread.join()
+		finally:
+			self.executor.shutdown(wait=False, cancel_futures=True)
+			self.wallTime = time.perf_counter() - start
+
+	def unprintedPaths(self):
+		"""Jobs that were not printed, because they failed or because no plotter was left"""
+		return self.failedPaths + [path for path, _ in self.preparedJobs] + list(self.pendingPaths)
+
+	def toDict(self):
+		return dict(wallTime=self.wallTime, jobsPrinted=sum(plotter.jobsPrinted for plotter in self.plotters),
+			unprinted=self.unprintedPaths(), plotters=[plotter.toDict(self.wallTime) for plotter in self.plotters])
+
+	def summary(self):
+		lines = [f"Printed {sum(plotter.jobsPrinted for plotter in self.plotters)} jobs in {self.wallTime:.1f}s"]
+		for plotter in self.plotters:
+			lines.append(f"  {plotter.port:<20} {plotter.jobsPrinted:>4} jobs {plotter.stats.counters.get('commands sent', 0):>9} commands"
+				+ f"  printing {plotter.printingTime:>8.1f}s  connecting {plotter.connectingTime:>5.1f}s  waiting {plotter.waitingTime:>6.1f}s"
+				+ f"  utilization {plotter.utilization(self.wallTime) * 100:>5.1f}%" + ("  FAILED" if plotter.failed else ""))
+		unprinted = self.unprintedPaths()
+		if unprinted:
+			lines.append(f"Not printed: {' '.join(unprinted)}")
+		return "\n".join(lines)
+
+
+def parseArgs(namespace):
+	argParser = argparse.ArgumentParser(fromfile_prefix_chars="@",
+		description="Print a queue of jobs on several plotters at once")
+	argParser.add_argument("jobs", type=str, nargs="+", metavar="JOB",
+		help="Files to print in order, each on the first plotter available: files ending with .bin contain binary data, any other file gcode")
+
+	ioGroup = argParser.add_argument_group("Output options")
+	ioGroup.add_argument("-l", "--log", type=argparse.FileType('w'), required=False, metavar="FILE",
+		help="File in which to save logs, comments and warnings of all plotters")
+	ioGroup.add_argument("--log-level", type=str, choices=job_log.levelNames, default=job_log.defaultLevel, metavar="LEVEL",
+		help=f"Log only messages at least as important as LEVEL, one of {', '.join(job_log.levelNames)}: \"comment\" adds gcode comments, \"trace\" every command sent and reply received (default: {job_log.defaultLevel})")
+	ioGroup.add_argument("--log-format", type=str, choices=job_log.formats, default="text", metavar="FORMAT",
+		help="Write logs as plain \"text\" (default) or as \"json\" lines with time, level and message")
+	ioGroup.add_argument("--binary-format", type=int, choices=[1, 2], default=1, metavar="VERSION",
+		help="Format of the binary data: 1 is understood by all plotters, 2 is more compact (default: 1)")
+	ioGroup.add_argument("--report", type=str, choices=["summary", "json"], default="summary", metavar="FORMAT",
+		help="Print how many jobs every plotter printed and how much of the time it was busy, either as a human readable \"summary\" (default) or as \"json\"")
+
+	genGroup = argParser.add_argument_group("Gcode generation options")
+	genGroup.add_argument("--end-home", action="store_true",
+		help="Add a trailing instruction to move to (0,0) instead of just taking the pen up")
+	genGroup.add_argument("-s", "--size", type=str, default="1.0x1.0", metavar="XxY",
+		help="The size of the print area in millimeters (e.g. 192.7x210.3)")
+	genGroup.add_argument("-d", "--dilation", type=float, default=1.0, metavar="FACTOR",
+		help="Dilation factor to apply (useful to convert mm to steps)")
+	genGroup.add_argument("--optimize-travel", action="store_true",
+		help="Reorder the strokes to reduce the distance travelled with the pen up")
+	genGroup.add_argument("--keep-stroke-direction", action="store_true",
+		help="When optimizing travel, do not draw strokes backwards")
+	genGroup.add_argument("--simplify", type=float, metavar="STEPS",
+		help="Remove points that are less than STEPS steps away from the simplified path (after dilation)")
+
+	parseGroup = argParser.add_argument_group("Gcode parsing options (detected automatically for every job if not provided)")
+	parseGroup.add_argument("--use-g", action="store_true",
+		help="Consider `G0` as pen up and `G1` as pen down")
+	parseGroup.add_argument("--feed-visible-below", type=float, metavar="VALUE",
+		help="Consider `F` (feed) commands with a value above the provided as pen down, otherwise as pen up")
+	parseGroup.add_argument("--speed-visible-below", type=float, metavar="VALUE",
+		help="Consider `S` (speed) commands with a value above the provided as pen down, otherwise as pen up")
+	parseGroup.add_argument("--detection-sample", type=int, metavar="LINES", dest="sample_lines",
+		help="Detect the parsing mode looking only at the first LINES lines, instead of at the whole input")
+	parseGroup.add_argument("-j", "--jobs", type=int, default=0, metavar="WORKERS", dest="workers",
+		help="Prepare the upcoming jobs using WORKERS processes, 0 means one per CPU core (default: 0)")
+
+	cacheGroup = argParser.add_argument_group("Job cache options")
+	cacheGroup.add_argument("--cache-dir", type=str, default=job_cache.defaultDirectory, metavar="DIR",
+		help=f"Directory in which to cache prepared jobs (default: {job_cache.defaultDirectory})")
+	cacheGroup.add_argument("--no-cache", action="store_true",
+		help="Neither read nor write the job cache")
+
+	connGroup = argParser.add_argument_group("Plotter connectivity options")
+	connGroup.add_argument("-p", "--port", "--serial-port", type=str, action="append", required=True, metavar="PORT", dest="serial_ports",
+		help="A serial port a plotter is connected to, repeat it for every plotter of the farm")
+	connGroup.add_argument("--baud", "--baud-rate", type=int, required=True, metavar="RATE", dest="baud_rate",
+		help="The baud rate to use for the connection with the plotters. It has to be equal to the plotters baud rate.")
+	connGroup.add_argument("--stop-and-wait", action="store_true",
+		help=f"Wait for the reply to every command before sending the next one, even if the plotters could receive more commands in advance. Without it the protocol of every plotter is queried, and plotters with an older firmware take {sender.protocolQueryTimeout:g}s to time out before sending starts, even for version 1 binary data")
+
+	argParser.parse_args(namespace=namespace)
+
+
+	try:
+		size = namespace.size.split("x")
+		namespace.xSize = float(size[0])
+		namespace.ySize = float(size[1])
+	except:
+		argParser.error(f"invalid formatting for --size: {namespace.size}")
+
+	if namespace.workers < 0:
+		argParser.error("--jobs can't be negative")
+	if namespace.sample_lines is not None and namespace.sample_lines < 1:
+		argParser.error("--detection-sample must be at least 1")
+	if len(set(namespace.serial_ports)) != len(namespace.serial_ports):
+		argParser.error("every --port can be used only once")
+
+def main():
+	class Args: pass
+	parseArgs(Args)
+
+	log = job_log.noLog if Args.log is None else job_log.Logger(Args.log, Args.log_level, Args.log_format, background=True)
+	options = gcode_parser.optionsFromArgs(Args)
+	farm = PlotterFarm(Args.serial_ports, Args.baud_rate, options, Args.workers or None,
+		None if Args.no_cache else Args.cache_dir, windowed=not Args.stop_and_wait, log=log)
+	try:
+		farm.run(Args.jobs)
+	finally:
+		print(json.dumps(farm.toDict(), indent=1) if Args.report == "json" else farm.summary())
+	if farm.unprintedPaths():
+		sys.exit(1)
+
+
+if __name__ == "__main__":
+	main()
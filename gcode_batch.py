@@ -0,0 +1,304 @@
+#!/usr/bin/python3
+#pylint: disable=no-member
+
+import argparse
+import sys
+import os
+import glob
+import json
+import time
+import shlex
+import itertools
+import concurrent.futures
+import gcode_parser
+import job_log
+import job_stats
+
+binaryExtension = ".bin"
+gcodeExtension = ".gcode"
+
+
+def _log_nothing(*args, **kwargs):
+	pass
+
+
+class BatchJob:
+	"""
+	A gcode file to convert, with the paths of its outputs (gcodeOutput may be None) and the
+	options to convert it with (a dict with the gcode options of gcode_parser.py, as in farm.py)
+	"""
+
+	def __init__(self, input, binaryOutput, gcodeOutput, options):
+		self.input = input
+		self.binaryOutput = binaryOutput
+		self.gcodeOutput = gcodeOutput
+		self.options = options
+
+def convertFile(job, logLevels=()):
+	"""
+	Converts the gcode file of job exactly like gcode_parser.py would, and returns (result,
+	messages): result is a json-serializable dict with the input, the outputs, the error (None if
+	the conversion succeeded), the wall time and the statistics of every stage, and messages are
+	the (args, kwargs) of the log calls made, only for the levels in logLevels. Runs in the
+	worker processes, so everything has to be picklable.
+	"""
+	messages = []
+	if len(logLevels) == 0:
+		log = _log_nothing
+	else:
+		def log(*args, **kwargs):
+			if kwargs.get("level", job_log.defaultLevel) in logLevels:
+				messages.append((args, kwargs))
+		log.isEnabled = lambda level: level in logLevels
+
+	options = job.options
+	stats = job_stats.Stats()
+	start = time.perf_counter()
+	error = None
+	try:
+		for output in (job.binaryOutput, job.gcodeOutput):
+			if output is not None and os.path.abspath(output) == os.path.abspath(job.input):
+				raise ValueError(f"the output {output} would overwrite the input")
+
+		with stats.stage("read"):
+			with open(job.input, "r") as file:
+				data = file.read()
+
+		parsedGcode = gcode_parser.parseWithOptions(data, options, log=log, stats=stats)
+		binaryData, gcode = gcode_parser.transformAndEncode(parsedGcode, options, job.gcodeOutput is not None,
+			log=log, stats=stats)
+		stats.count("binary bytes", len(binaryData))
+
+		with stats.stage("write"):
+			for output in (job.binaryOutput, job.gcodeOutput):
+				if output is not None and os.path.dirname(output) != "":
+					os.makedirs(os.path.dirname(output), exist_ok=True)
+			with open(job.binaryOutput, "wb") as file:
+				file.write(binaryData)
+			if job.gcodeOutput is not None:
+				with open(job.gcodeOutput, "w") as file:
+					file.write(gcode)
+
+	except Exception as e:
+		error = f"{type(e).__name__}: {e}"
+
+	return dict(input=job.input, binaryOutput=job.binaryOutput, gcodeOutput=job.gcodeOutput, error=error,
+		seconds=time.perf_counter() - start, stats=stats.toDict()), messages
+
+
+class BatchReport:
+	"""The results of convertBatch, in the same order as the jobs, and the total wall time"""
+
+	def __init__(self, results, wallTime):
+		self.results = results
+		self.wallTime = wallTime
+		self.stats = job_stats.Stats()
+		for result in results:
+			self.stats.merge(result["stats"])
+
+	def failures(self):
+		return [result for result in self.results if result["error"] is not None]
+
+	def filesPerSecond(self):
+		return len(self.results) / self.wallTime if self.wallTime > 0 else 0.0
+
+	def toDict(self):
+		return dict(wallTime=self.wallTime, files=len(self.results), failed=len(self.failures()),
+			filesPerSecond=self.filesPerSecond(), linesParsed=self.stats.counters.get("lines parsed", 0),
+			stats=self.stats.toDict(), results=self.results)
+
+	def summary(self):
+		failures = self.failures()
+		lines = [f"Converted {len(self.results) - len(failures)} of {len(self.results)} files in {self.wallTime:.2f}s"
+			+ f" ({self.filesPerSecond():.1f} files/s, {self.stats.counters.get('lines parsed', 0) / self.wallTime if self.wallTime > 0 else 0.0:.0f} lines/s)",
+			"Summed over all files (the stages of different files overlap):",
+			self.stats.summary()]
+		if failures:
+			lines.append("Failed:")
+			for result in failures:
+				lines.append(f"  {result['input']}: {result['error']}")
+		return "\n".join(lines)
+
+def convertBatch(jobs, workers=None, log=_log_nothing):
+	"""
+	Converts every BatchJob in jobs using a pool of workers processes (os.cpu_count() if workers
+	is None, none at all if it is 1), and returns a BatchReport. A failing file does not stop the
+	others. The messages logged while converting a file are written to log prefixed with its path.
+	"""
+	if workers is None:
+		workers = os.cpu_count() or 1
+	# the worker processes can't use log, so they record the messages for these levels
+	logLevels = [] if log is _log_nothing else [level for level in job_log.levelNames if job_log.isEnabled(log, level)]
+
+	start = time.perf_counter()
+	results = []
+	executor = None
+	try:
+		if workers <= 1:
+			outputs = map(convertFile, jobs, itertools.repeat(logLevels))
+		else:
+			executor = concurrent.futures.ProcessPoolExecutor(workers)
+			# small files take less than the round trip to a worker, so send them in batches
+			outputs = executor.map(convertFile, jobs, itertools.repeat(logLevels),
+				chunksize=max(1, min(32, len(jobs) // (workers * 4))))
+
+		for result, messages in outputs:
+			for args, kwargs in messages:
+				log(f"[{result['input']}]", *args, **kwargs)
+			if result["error"] is None:
+				log(f"[info] Converted {result['input']} in {result['seconds']:.3f}s")
+			else:
+				log(f"[error] Could not convert {result['input']}: {result['error']}", level="error")
+			results.append(result)
+	finally:
+		if executor is not None:
+			executor.shutdown(wait=False, cancel_futures=True)
+
+	return BatchReport(results, time.perf_counter() - start)
+
+
+def _addConversionArguments(argParser):
+	# also used to parse the options on the lines of manifests
+	parseGroup = argParser.add_argument_group("Gcode parsing options (detected automatically for every file if not provided)")
+	parseGroup.add_argument("-g", "--use-g", action="store_true",
+		help="Consider `G0` as pen up and `G1` as pen down")
+	parseGroup.add_argument("--feed-visible-below", type=float, metavar="VALUE",
+		help="Consider `F` (feed) commands with a value above the provided as pen down, otherwise as pen up")
+	parseGroup.add_argument("--speed-visible-below", type=float, metavar="VALUE",
+		help="Consider `S` (speed) commands with a value above the provided as pen down, otherwise as pen up")
+	parseGroup.add_argument("--detection-sample", type=int, metavar="LINES", dest="sample_lines",
+		help="Detect the parsing mode looking only at the first LINES lines, instead of at the whole input")
+
+	genGroup = argParser.add_argument_group("Gcode generation options")
+	genGroup.add_argument("--end-home", action="store_true",
+		help="Add a trailing instruction to move to (0,0) instead of just taking the pen up")
+	genGroup.add_argument("-s", "--size", type=str, default="1.0x1.0", metavar="XxY",
+		help="The size of the print area in millimeters (e.g. 192.7x210.3)")
+	genGroup.add_argument("-d", "--dilation", type=float, default=1.0, metavar="FACTOR",
+		help="Dilation factor to apply (useful to convert mm to steps)")
+	genGroup.add_argument("--optimize-travel", action="store_true",
+		help="Reorder the strokes to reduce the distance travelled with the pen up")
+	genGroup.add_argument("--keep-stroke-direction", action="store_true",
+		help="When optimizing travel, do not draw strokes backwards")
+	genGroup.add_argument("--simplify", type=float, metavar="STEPS",
+		help="Remove points that are less than STEPS steps away from the simplified path (after dilation)")
+	genGroup.add_argument("--binary-format", type=int, choices=[1, 2], default=1, metavar="VERSION",
+		help="Format of the binary data: 1 is understood by all plotters, 2 is more compact (default: 1)")
+
+def _conversionOptions(namespace, argParser):
+	try:
+		size = namespace.size.split("x")
+		namespace.xSize, namespace.ySize = float(size[0]), float(size[1])
+	except:
+		argParser.error(f"invalid formatting for --size: {namespace.size}")
+	if namespace.sample_lines is not None and namespace.sample_lines < 1:
+		argParser.error("--detection-sample must be at least 1")
+
+	return gcode_parser.optionsFromArgs(namespace)
+
+def _outputPaths(relativePath, outputDirectory, gcodeOutput):
+	base = os.path.join(outputDirectory, os.path.splitext(relativePath)[0])
+	return base + binaryExtension, base + gcodeExtension if gcodeOutput else None
+
+def listJobs(namespace):
+	"""
+	Returns the BatchJob of every file to convert: the files matching --pattern in the --input
+	directory (and its subdirectories), or the files listed in the --input manifest, one per line
+	followed by the options that differ from the shared ones (e.g. `part.gcode -s 100x80 --use-g`)
+	"""
+	sharedOptions = _conversionOptions(namespace, namespace.argParser)
+	jobs = []
+	if os.path.isdir(namespace.input):
+		paths = glob.glob(os.path.join(glob.escape(namespace.input), "**", namespace.pattern), recursive=True)
+		for path in sorted(paths):
+			if os.path.isfile(path):
+				jobs.append(BatchJob(path, *_outputPaths(os.path.relpath(path, namespace.input),
+					namespace.output_dir, namespace.gcode_output), sharedOptions))
+		return jobs
+
+	manifestDirectory = os.path.dirname(namespace.input)
+	with open(namespace.input, "r") as manifest:
+		for lineNr, line in enumerate(manifest, 1):
+			words = shlex.split(line, comments=True)
+			if len(words) == 0:
+				continue
+
+			options = sharedOptions
+			if len(words) > 1:
+				lineParser = argparse.ArgumentParser(prog=f"{namespace.input}:{lineNr}", add_help=False)
+				_addConversionArguments(lineParser)
+				# options not on the line keep their shared value
+				lineParser.set_defaults(**{dest: getattr(namespace, dest) for dest in vars(lineParser.parse_args([]))})
+				options = _conversionOptions(lineParser.parse_args(words[1:]), lineParser)
+
+			path = os.path.join(manifestDirectory, words[0])
+			# files outside of the directory of the manifest are saved directly in the output directory
+			relativePath = os.path.relpath(path, manifestDirectory)
+			if os.path.isabs(words[0]) or relativePath.startswith(os.pardir):
+				relativePath = os.path.basename(path)
+			jobs.append(BatchJob(path, *_outputPaths(relativePath, namespace.output_dir, namespace.gcode_output), options))
+	return jobs
+
+def parseArgs(namespace):
+	argParser = argparse.ArgumentParser(fromfile_prefix_chars="@",
+		description="Convert many gcode files to binary data at once, like gcode_parser.py does for a single file")
+	ioGroup = argParser.add_argument_group("Input/output options")
+	ioGroup.add_argument("-i", "--input", type=str, required=True, metavar="PATH",
+		help="Directory containing the gcode files to convert, or manifest file listing one gcode file per line, optionally followed by options overriding the shared ones for that file")
+	ioGroup.add_argument("--pattern", type=str, default="*.gcode", metavar="GLOB",
+		help="Convert the files matching GLOB in the input directory and its subdirectories (default: *.gcode)")
+	ioGroup.add_argument("-O", "--output-dir", type=str, required=True, metavar="DIR",
+		help=f"Directory in which to save the binary data of every file, with the same relative path and the {binaryExtension} extension")
+	ioGroup.add_argument("--gcode-output", action="store_true",
+		help=f"Also save the generated gcode of every file in the output directory, with the {gcodeExtension} extension")
+	ioGroup.add_argument("--summary", type=argparse.FileType('w'), required=False, metavar="FILE",
+		help="File in which to save the results and statistics of every file, and the total throughput, as json")
+	ioGroup.add_argument("--report", type=str, choices=["summary", "json"], default="summary", metavar="FORMAT",
+		help="Print how many files were converted, how fast and which ones failed, either as a human readable \"summary\" (default) or as \"json\" (without the results of every file)")
+	ioGroup.add_argument("-l", "--log", type=argparse.FileType('w'), required=False, metavar="FILE",
+		help="File in which to save logs, comments and warnings of all files")
+	ioGroup.add_argument("--log-level", type=str, choices=job_log.levelNames, default=job_log.defaultLevel, metavar="LEVEL",
+		help=f"Log only messages at least as important as LEVEL, one of {', '.join(job_log.levelNames)}: \"comment\" adds gcode comments (default: {job_log.defaultLevel})")
+	ioGroup.add_argument("--log-format", type=str, choices=job_log.formats, default="text", metavar="FORMAT",
+		help="Write logs as plain \"text\" (default) or as \"json\" lines with time, level and message")
+	ioGroup.add_argument("-j", "--jobs", type=int, default=0, metavar="WORKERS", dest="workers",
+		help="Convert the files using WORKERS processes, 0 means one per CPU core (default: 0)")
+
+	_addConversionArguments(argParser)
+
+	argParser.parse_args(namespace=namespace)
+
+
+	namespace.argParser = argParser
+	_conversionOptions(namespace, argParser)
+	if not os.path.exists(namespace.input):
+		argParser.error(f"no such directory or manifest: {namespace.input}")
+	if namespace.workers < 0:
+		argParser.error("--jobs can't be negative")
+
+def main():
+	class Args: pass
+	parseArgs(Args)
+
+	log = job_log.noLog if Args.log is None else job_log.Logger(Args.log, Args.log_level, Args.log_format, background=True)
+	try:
+		jobs = listJobs(Args)
+	except OSError as e:
+		Args.argParser.error(f"could not read the manifest: {e}")
+
+	report = convertBatch(jobs, Args.workers or None, log=log)
+
+	if Args.summary is not None:
+		json.dump(report.toDict(), Args.summary, indent=1)
+	if Args.report == "json":
+		reportDict = report.toDict()
+		del reportDict["results"]
+		reportDict["failures"] = [dict(input=result["input"], error=result["error"]) for result in report.failures()]
+		print(json.dumps(reportDict, indent=1))
+	else:
+		print(report.summary())
+	if report.failures():
+		sys.exit(1)
+
+if __name__ == '__main__':
+	main()
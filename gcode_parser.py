@@ -6,9 +6,40 @@ import argparse
 import sys
 import re
 import math
+import io
+import itertools
+import collections
+import struct
+import os
+import concurrent.futures
+from array import array
+import job_stats
+import job_log
 
 writeByte = b"w"
 moveByte = b"m"
+# mode byte followed by x and y deltas as big endian int16
+binaryRecord = struct.Struct(">chh")
+minBinaryDelta, maxBinaryDelta = -2**15, 2**15 - 1
+
+# The compact format (version 2) starts with compactHeader, followed by records of three kinds:
+# - the 5-byte records of the simple format (version 1), with `w`/`m` and two int16
+# - 3-byte records with `W`/`M` (write/move) followed by x and y deltas as int8
+# - 1-byte records with bits 1pxxxyyy, where p is 1 to write, and xxx and yyy are
+#   the x and y deltas as 3-bit two's complement numbers (from -4 to 3)
+compactHeader = b"v2"
+writeShortByte = b"W"
+moveShortByte = b"M"
+shortRecord = struct.Struct(">cbb")
+minShortDelta, maxShortDelta = -2**7, 2**7 - 1
+tinyRecordFlag, tinyWriteFlag = 0x80, 0x40
+minTinyDelta, maxTinyDelta = -4, 3
+
+# G2/G3 arcs are flattened into segments whose distance from the arc is at most the arc
+# tolerance, in gcode units. It is derived from arcStepTolerance (in steps, at the final size)
+# with arcToleranceFor, and defaultArcTolerance is used when the final size is not known.
+arcStepTolerance = 0.5
+defaultArcTolerance = 0.01
 
 
 def _log_nothing(*args, **kwargs):
@@ -20,49 +51,203 @@ class AttrType(Enum):
 	x   = 1,
 	y   = 2
 
+def _logsComments(log):
+	# formatting every comment is expensive, so skip it when they would not be written anyway
+	return log is not _log_nothing and job_log.isEnabled(log, "comment")
+
+def _removeComments(code, lineNr, log=_log_nothing, logComments=True):
+	parts = []
+	while True:
+		begin = code.find("(")
+		if begin == -1:
+			parts.append(code)
+			break
+
+		end = code.find(")")
+		if end == -1:
+			log(f"[WARNING {lineNr:>5}]: missing closing parenthesis on comment starting in position {begin+1}", level="warning")
+			parts.append(code[:begin])
+			break
+
+		if logComments:
+			log(f"[comment {lineNr:>5}]: {code[begin+1:end]}", level="comment")
+		parts.append(code[:begin])
+		parts.append(" ")
+		code = code[end+1:]
+	return "".join(parts)
+
 class AttributeParser:
-	def __init__(self, useG, feedVisibleBelow, speedVisibleBelow):
+	# plain decimal numbers, the only ones found in practice; if there is a fraction
+	# (i.e. a group matched) the number is parsed as float, otherwise as int
+	_numberRegex = re.compile(r"[-+]?(?:[0-9]+(\.[0-9]*)?|(\.[0-9]+))")
+
+	def __init__(self, useG, feedVisibleBelow, speedVisibleBelow, arcTolerance=defaultArcTolerance):
 		self.useG = useG
 		self.useFeed = feedVisibleBelow is not None
 		self.feedVisibleBelow = feedVisibleBelow
 		self.useSpeed = speedVisibleBelow is not None
 		self.speedVisibleBelow = speedVisibleBelow
 
+		self.arcTolerance = arcTolerance
+		# the motion mode is modal: None for straight lines (G0/G1), True for clockwise
+		# arcs (G2) and False for counterclockwise ones (G3)
+		self.clockwise = None
+		# set when the last line parsed had arc words, which takeArcPoints then consumes
+		self.arcLine = False
+		self.arcI, self.arcJ, self.arcR = None, None, None
+
 		if not self.useG and not self.useFeed and not self.useSpeed:
 			raise ValueError("At least a method (G, feed or speed) has to be specified to parse gcode")
 
-	def parseAttribute(self, word, lineNr, log=_log_nothing):
+	def _parseValue(self, word):
+		"""Returns the value of the word as int or float, or None if it is not a number"""
+		match = AttributeParser._numberRegex.fullmatch(word, 1)
+		if match is not None:
+			return int(word[1:]) if match.lastindex is None else float(word[1:])
+
+		# unusual formats (e.g. exponents or underscores) are handled as python does
 		try:
-			try: # attribute value is an integer
-				value = int(word[1:])
-			except ValueError: # attribute value is a floating point number
-				value = float(word[1:])
-
-			key = word[0].upper()
-			if   key == "G" and self.useG:
-				if value == 0 or value == 1:
-					key = AttrType.pen
-				else:
-					raise ValueError()
-			elif key == "F" and self.useFeed:
-				key = AttrType.pen
-				value = 1 if value < self.feedVisibleBelow else 0
-			elif key == "S" and self.useSpeed:
-				key = AttrType.pen
-				value = 1 if value < self.speedVisibleBelow else 0
-			elif key == "X":
-				key = AttrType.x
-			elif key == "Y":
-				key = AttrType.y
+			return int(word[1:])
+		except ValueError:
+			try:
+				return float(word[1:])
+			except ValueError:
+				return None
+
+	def parseLine(self, code, lineNr, pen, x, y, log=_log_nothing):
+		"""
+		Parses the words of a line without comments, starting from the provided attributes and
+		returning the updated (pen, x, y). Equivalent to calling parseAttribute on every word.
+		"""
+		numberRegex = AttributeParser._numberRegex
+		for word in code.split(" "):
+			if word == "":
+				continue
+
+			# inlined fast path of _parseValue
+			match = numberRegex.fullmatch(word, 1)
+			if match is not None:
+				value = int(word[1:]) if match.lastindex is None else float(word[1:])
 			else:
-				raise ValueError()
+				value = self._parseValue(word)
+
+			if value is not None:
+				key = word[0].upper()
+				if key == "X":
+					x = value
+					continue
+				elif key == "Y":
+					y = value
+					continue
+				elif key == "G":
+					if value == 0 or value == 1:
+						self.clockwise = None
+						if self.useG:
+							pen = int(value)
+							continue
+					elif value == 2 or value == 3:
+						self.clockwise = value == 2
+						self.arcLine = True
+						if self.useG:
+							pen = 1
+						continue
+				elif key == "I":
+					self.arcI = value
+					self.arcLine = True
+					continue
+				elif key == "J":
+					self.arcJ = value
+					self.arcLine = True
+					continue
+				elif key == "R":
+					self.arcR = value
+					self.arcLine = True
+					continue
+				elif key == "F" and self.useFeed:
+					pen = 1 if value < self.feedVisibleBelow else 0
+					continue
+				elif key == "S" and self.useSpeed:
+					pen = 1 if value < self.speedVisibleBelow else 0
+					continue
+
+			log(f"[WARNING {lineNr:>5}]: ignoring unknown attribute \"{word}\"", level="warning")
+
+		return pen, x, y
+
+	def takeArcPoints(self, startX, startY, endX, endY, lineNr, log=_log_nothing):
+		"""
+		Returns the (x, y) points strictly between start and end of the arc described by the last
+		line parsed (see arcLine), and forgets its I, J and R words. Arcs that can't be drawn
+		are replaced by a straight line (i.e. no points) with a warning.
+		"""
+		clockwise, i, j, r = self.clockwise, self.arcI, self.arcJ, self.arcR
+		self.arcLine = False
+		self.arcI, self.arcJ, self.arcR = None, None, None
+
+		if clockwise is None:
+			if i is not None or j is not None or r is not None:
+				log(f"[WARNING {lineNr:>5}]: ignoring arc attributes outside of G2/G3", level="warning")
+			return []
+		if i is None and j is None and r is None:
+			if (startX, startY) != (endX, endY):
+				log(f"[WARNING {lineNr:>5}]: arc without I, J or R, drawing a straight line", level="warning")
+			return []
+		return _arcPoints(startX, startY, endX, endY, clockwise, i, j, r, self.arcTolerance, lineNr, log)
 
-			return (key, value)
-		except (ValueError, IndexError):
-			if word != "":
-				log(f"[WARNING {lineNr:>5}]: ignoring unknown attribute \"{word}\"")
+	def parseAttribute(self, word, lineNr, log=_log_nothing):
+		if word == "":
 			return None
 
+		pen, x, y = self.parseLine(word, lineNr, None, None, None, log=log)
+		if pen is not None:
+			return (AttrType.pen, pen)
+		elif x is not None:
+			return (AttrType.x, x)
+		elif y is not None:
+			return (AttrType.y, y)
+		return None
+
+
+def _arcPoints(startX, startY, endX, endY, clockwise, i, j, r, tolerance, lineNr, log=_log_nothing):
+	if i is not None or j is not None:
+		centerX, centerY = startX + (i or 0), startY + (j or 0)
+	else:
+		chordX, chordY = endX - startX, endY - startY
+		chord = math.hypot(chordX, chordY)
+		if chord == 0:
+			log(f"[WARNING {lineNr:>5}]: the end of an arc with R has to differ from its start, ignoring the arc", level="warning")
+			return []
+		# distance of the center from the middle of the chord, which is slightly
+		# negative (i.e. a half circle) when R is rounded down
+		squaredDistance = r * r - chord * chord / 4
+		if abs(r) < chord / 2 - tolerance:
+			log(f"[WARNING {lineNr:>5}]: arc radius {abs(r)} is shorter than half of the chord, drawing a half circle", level="warning")
+		distance = math.sqrt(max(squaredDistance, 0.0))
+		# positive R chooses the arc shorter than a half circle, negative R the longer one
+		if clockwise == (r > 0):
+			distance = -distance
+		centerX = startX + chordX / 2 - distance * chordY / chord
+		centerY = startY + chordY / 2 + distance * chordX / chord
+
+	radius = math.hypot(startX - centerX, startY - centerY)
+	if radius == 0:
+		log(f"[WARNING {lineNr:>5}]: arc with a null radius, drawing a straight line", level="warning")
+		return []
+	startAngle = math.atan2(startY - centerY, startX - centerX)
+	sweep = math.atan2(endY - centerY, endX - centerX) - startAngle
+	# an arc ending where it starts is a full circle
+	if clockwise and sweep >= 0:
+		sweep -= 2 * math.pi
+	elif not clockwise and sweep <= 0:
+		sweep += 2 * math.pi
+
+	# the segments spanning at most this angle stay within tolerance of the arc
+	maxAngle = 2 * math.acos(max(1 - tolerance / radius, -1.0))
+	segments = max(1, math.ceil(abs(sweep) / maxAngle))
+	step = sweep / segments
+	return [(centerX + radius * math.cos(startAngle + step * k), centerY + radius * math.sin(startAngle + step * k))
+		for k in range(1, segments)]
+
 
 class ParsedLine:
 	@classmethod
@@ -71,28 +256,12 @@ class ParsedLine:
 
 	@classmethod
 	def fromGcodeLine(cls, attributeParser, line, lineNr, lastAttributes, log=_log_nothing):
-		def removeComments(code):
-			begin = code.find("(")
-			if begin == -1:
-				return code
-			else:
-				end = code.find(")")
-				if end == -1:
-					log(f"[WARNING {lineNr:>5}]: missing closing parenthesis on comment starting in position {begin+1}")
-					return code[:begin]
-				else:
-					log(f"[comment {lineNr:>5}]: {code[begin+1:end]}")
-					return code[:begin] + " " + removeComments(code[end+1:])
-
-		attributes = {k: v for k, v in lastAttributes.items()}
-		words = removeComments(line).split(" ")
-
-		for word in words:
-			attribute = attributeParser.parseAttribute(word, lineNr, log=log)
-			if attribute is not None:
-				attributes[attribute[0]] = attribute[1]
+		if "(" in line:
+			line = _removeComments(line, lineNr, log=log)
 
-		return cls(attributes, lineNr)
+		pen, x, y = attributeParser.parseLine(line, lineNr,
+			lastAttributes[AttrType.pen], lastAttributes[AttrType.x], lastAttributes[AttrType.y], log=log)
+		return cls.fromRawCoordinates(pen, x, y, lineNr)
 
 
 	def __init__(self, attributes, lineNr):
@@ -121,26 +290,183 @@ class ParsedLine:
 		return f"G{self[AttrType.pen]} X{self[AttrType.x]:.3f} Y{self[AttrType.y]:.3f}"
 
 
-def detectParsingMode(data, log=_log_nothing):
-	logLabel = "[info] parsing mode detection:"
-	gRegex = r"(?:\s|\A)[Gg]([01])(?:\s|\Z)"
-	feedRegex = r"(?:\s|\A)[Ff]([-+]?(?:[0-9]*\.[0-9]+|[0-9]+))(?:\s|\Z)"
-	speedRegex = r"(?:\s|\A)[Ss]([-+]?(?:[0-9]*\.[0-9]+|[0-9]+))(?:\s|\Z)"
-
-	gInvisibleCount, gVisibleCount = 0, 0
-	for gMatch in re.finditer(gRegex, data):
-		if gMatch.group(0) == "0": gInvisibleCount += 1
-		else: gVisibleCount += 1
-	log(logLabel, f"found {gInvisibleCount} invisible G attributes and {gVisibleCount} visible ones")
-
-	def getVisibilityFeedOrSpeed(regex):
-		foundValues, allCount = {}, 0
-		for match in re.finditer(regex, data):
-			allCount += 1
-			if match.group(1) in foundValues:
-				foundValues[match.group(1)] += 1
-			else:
-				foundValues[match.group(1)] = 1
+class Bounds:
+	def __init__(self):
+		self.minX, self.minY = math.inf, math.inf
+		self.maxX, self.maxY = -math.inf, -math.inf
+		self.last = None
+
+	def add(self, parsedLine):
+		x, y = parsedLine[AttrType.x], parsedLine[AttrType.y]
+		if x < self.minX: self.minX = x
+		if x > self.maxX: self.maxX = x
+		if y < self.minY: self.minY = y
+		if y > self.maxY: self.maxY = y
+		self.last = (x, y)
+
+	def isEmpty(self):
+		return self.last is None
+
+	def getTranslation(self):
+		return -self.minX, -self.minY
+
+	def getDilationFactor(self, xSize, ySize):
+		# same operations as translateToFirstQuarter+getDilationFactor, so that results are identical
+		translationX, translationY = self.getTranslation()
+		xSizeReal = (self.maxX + translationX) - (self.minX + translationX)
+		ySizeReal = (self.maxY + translationY) - (self.minY + translationY)
+
+		return min([
+			xSize / xSizeReal,
+			ySize / ySizeReal,
+		])
+
+
+class _PathAttributes:
+	"""Dict-like view on the attributes of a single point of a Path"""
+	def __init__(self, path, index):
+		self.path = path
+		self.index = index
+
+	def __getitem__(self, key):
+		if   key == AttrType.pen: return self.path.pen[self.index]
+		elif key == AttrType.x:   return self.path.x[self.index]
+		elif key == AttrType.y:   return self.path.y[self.index]
+		raise KeyError(key)
+
+	def __setitem__(self, key, value):
+		if   key == AttrType.pen: self.path.pen[self.index] = value
+		elif key == AttrType.x:   self.path.x[self.index] = value
+		elif key == AttrType.y:   self.path.y[self.index] = value
+		else: raise KeyError(key)
+
+	def items(self):
+		return [(key, self[key]) for key in AttrType]
+
+class Path:
+	"""
+	Compact columnar representation of parsed gcode: contiguous pen/x/y arrays instead of a dict
+	per line. Indexing or iterating yields ParsedLine views, so code written for lists of
+	ParsedLine keeps working, but the transformations below do not go through them.
+	"""
+	_noLineNr = -1
+
+	def __init__(self):
+		self.pen = array("b")
+		self.x = array("d")
+		self.y = array("d")
+		self.lineNr = array("q")
+
+	@classmethod
+	def fromParsedLines(cls, parsedLines):
+		path = cls()
+		for line in parsedLines:
+			path.append(line)
+		return path
+
+	def append(self, parsedLine):
+		self.appendCoordinates(parsedLine[AttrType.pen], parsedLine[AttrType.x], parsedLine[AttrType.y], parsedLine.lineNr)
+
+	def appendCoordinates(self, pen, x, y, lineNr=None):
+		self.pen.append(pen)
+		self.x.append(x)
+		self.y.append(y)
+		self.lineNr.append(Path._noLineNr if lineNr is None else lineNr)
+
+	def pop(self):
+		line = ParsedLine.fromRawCoordinates(self.pen.pop(), self.x.pop(), self.y.pop(), self.lineNr.pop())
+		if line.lineNr == Path._noLineNr:
+			line.lineNr = None
+		return line
+
+	def __len__(self):
+		return len(self.pen)
+
+	def __getitem__(self, index):
+		if index < 0:
+			index += len(self)
+		if not 0 <= index < len(self):
+			raise IndexError("path index out of range")
+
+		lineNr = self.lineNr[index]
+		return ParsedLine(_PathAttributes(self, index), None if lineNr == Path._noLineNr else lineNr)
+
+	def __iter__(self):
+		for index in range(len(self)):
+			yield self[index]
+
+	def iterCoordinates(self):
+		return zip(self.pen, self.x, self.y)
+
+	def extend(self, other, start, end, reverse=False):
+		"""Appends the points in [start, end) of other; if reverse, they are traversed backwards"""
+		if not reverse:
+			self.pen.extend(other.pen[start:end])
+			self.x.extend(other.x[start:end])
+			self.y.extend(other.y[start:end])
+			self.lineNr.extend(other.lineNr[start:end])
+		elif end > start:
+			# the last point becomes a pen up point and all segments before it are drawn backwards
+			self.pen.append(0)
+			self.pen.extend(array("b", [1]) * (end - start - 1))
+			self.x.extend(other.x[end-1:start-1 if start > 0 else None:-1])
+			self.y.extend(other.y[end-1:start-1 if start > 0 else None:-1])
+			self.lineNr.extend(other.lineNr[end-1:start-1 if start > 0 else None:-1])
+
+
+	def getBounds(self):
+		bounds = Bounds()
+		if len(self) > 0:
+			bounds.minX, bounds.maxX = min(self.x), max(self.x)
+			bounds.minY, bounds.maxY = min(self.y), max(self.y)
+			bounds.last = (self.x[-1], self.y[-1])
+		return bounds
+
+	def translate(self, translationX, translationY):
+		self.x = array("d", [x + translationX for x in self.x])
+		self.y = array("d", [y + translationY for y in self.y])
+
+	def scale(self, factor):
+		self.x = array("d", [x * factor for x in self.x])
+		self.y = array("d", [y * factor for y in self.y])
+
+def asPath(parsedGcode):
+	return parsedGcode if isinstance(parsedGcode, Path) else Path.fromParsedLines(parsedGcode)
+
+def _iterCoordinates(parsedGcode):
+	if isinstance(parsedGcode, Path):
+		return parsedGcode.iterCoordinates()
+	return ((line[AttrType.pen], line[AttrType.x], line[AttrType.y]) for line in parsedGcode)
+
+
+class ParsingModeDetector:
+	"""
+	Collects the statistics needed to detect the parsing mode with a single regex scan,
+	and can be fed incrementally with chunks of text (e.g. while reading a file)
+	"""
+	attributeRegex = re.compile(r"(?<!\S)([GgFfSs])([-+]?(?:[0-9]*\.[0-9]+|[0-9]+))(?!\S)")
+
+	def __init__(self):
+		self.counts = collections.Counter()
+		self.lineCount = 0
+
+	def addText(self, text, lineCount):
+		# findall+Counter keep the whole scan in C code
+		self.counts.update(ParsingModeDetector.attributeRegex.findall(text))
+		self.lineCount += lineCount
+
+	def _getValues(self, keys):
+		foundValues = {}
+		for (key, value), count in self.counts.items():
+			if key in keys:
+				foundValues[value] = foundValues.get(value, 0) + count
+		return foundValues
+
+	@staticmethod
+	def _getVisibilityFeedOrSpeed(foundValues):
+		allCount = sum(foundValues.values())
+		if allCount == 0:
+			return 0, 0, None
 
 		average = 0
 		for value, count in foundValues.items():
@@ -156,51 +482,87 @@ def detectParsingMode(data, log=_log_nothing):
 
 		return invisibleCount, visibleCount, average
 
-	feedInvisibleCount, feedVisibleCount, feedThreshold = getVisibilityFeedOrSpeed(feedRegex)
-	log(logLabel, f"found {feedInvisibleCount} invisible feed attributes and " +
-		f"{feedVisibleCount} visible ones, with a feed threshold of {feedThreshold}")
-
-	speedInvisibleCount, speedVisibleCount, speedThreshold = getVisibilityFeedOrSpeed(speedRegex)
-	log(logLabel, f"found {speedInvisibleCount} invisible speed attributes and " +
-		f"{speedVisibleCount} visible ones, with a feed threshold of {speedThreshold}")
-
-
-	def score(invisible, visible): # higher is better
+	@staticmethod
+	def _score(invisible, visible): # higher is better
+		if invisible + visible == 0:
+			return 0.0
 		return ((1.0 - abs(invisible - visible) / (invisible + visible))
 			* (0.5 + 0.5 * visible / (invisible + visible))
 			* math.log10(invisible + visible))
 
-	gScore = score(gInvisibleCount, gVisibleCount)
-	feedScore = score(feedInvisibleCount, feedVisibleCount)
-	speedScore = score(speedInvisibleCount, speedVisibleCount)
-	log(logLabel, f"gScore={gScore}, feedScore={feedScore}, speedScore={speedScore}")
-
-	maxScore = max(gScore, feedScore, speedScore)
-	if maxScore == gScore:
-		log(logLabel, "chosen g mode")
-		return  True,  None,          None
-	elif maxScore == feedScore:
-		log(logLabel, f"chosen feed mode with feed visible below {feedThreshold}")
-		return  False, feedThreshold, None
+	def getParsingMode(self, log=_log_nothing):
+		logLabel = "[info] parsing mode detection:"
+		gValues = self._getValues("Gg")
+		gInvisibleCount = gValues.get("0", 0)
+		gVisibleCount = gValues.get("1", 0) + gValues.get("2", 0) + gValues.get("3", 0)
+		log(logLabel, f"found {gInvisibleCount} invisible G attributes and {gVisibleCount} visible ones")
+
+		feedInvisibleCount, feedVisibleCount, feedThreshold = self._getVisibilityFeedOrSpeed(self._getValues("Ff"))
+		log(logLabel, f"found {feedInvisibleCount} invisible feed attributes and " +
+			f"{feedVisibleCount} visible ones, with a feed threshold of {feedThreshold}")
+
+		speedInvisibleCount, speedVisibleCount, speedThreshold = self._getVisibilityFeedOrSpeed(self._getValues("Ss"))
+		log(logLabel, f"found {speedInvisibleCount} invisible speed attributes and " +
+			f"{speedVisibleCount} visible ones, with a speed threshold of {speedThreshold}")
+
+		gScore = self._score(gInvisibleCount, gVisibleCount)
+		feedScore = self._score(feedInvisibleCount, feedVisibleCount)
+		speedScore = self._score(speedInvisibleCount, speedVisibleCount)
+		log(logLabel, f"gScore={gScore}, feedScore={feedScore}, speedScore={speedScore}")
+
+		# how much the chosen mode stands out from the second best one, in [0, 1]
+		scores = sorted([gScore, feedScore, speedScore], reverse=True)
+		self.confidence = 0.0 if scores[0] <= 0 else (scores[0] - scores[1]) / scores[0]
+		log(logLabel, f"confidence={self.confidence:.3f} based on {self.lineCount} lines")
+
+		maxScore = scores[0]
+		if maxScore == gScore:
+			log(logLabel, "chosen g mode")
+			return  True,  None,          None
+		elif maxScore == feedScore:
+			log(logLabel, f"chosen feed mode with feed visible below {feedThreshold}")
+			return  False, feedThreshold, None
+		else:
+			log(logLabel, f"chosen speed mode with speed visible below {speedThreshold}")
+			return  False, None,          speedThreshold
+
+def detectParsingMode(data, sampleLines=None, log=_log_nothing, stats=job_stats.noStats):
+	"""
+	Detects the parsing mode from a string or a text file object, returning the triple
+	(useG, feedVisibleBelow, speedVisibleBelow). If sampleLines is not None only the
+	first sampleLines lines are read; the file position is not restored.
+	"""
+	detector = ParsingModeDetector()
+	if isinstance(data, str) and sampleLines is None:
+		detector.addText(data, data.count("\n") + 1)
 	else:
-		log(logLabel, f"chosen speed mode with speed visible below {speedThreshold}")
-		return  False, None,          speedThreshold
+		if isinstance(data, str):
+			data = io.StringIO(data)
 
+		remainingLines = math.inf if sampleLines is None else sampleLines
+		while remainingLines > 0:
+			lines = list(itertools.islice(data, min(remainingLines, 10000)))
+			if len(lines) == 0:
+				break
+			detector.addText("".join(lines), len(lines))
+			remainingLines -= len(lines)
 
-def translateToFirstQuarter(parsedGcode, log=_log_nothing):
-	translationX = -min([line[AttrType.x] for line in parsedGcode])
-	translationY = -min([line[AttrType.y] for line in parsedGcode])
+	stats.count("lines scanned", detector.lineCount)
+	return detector.getParsingMode(log=log)
 
-	for line in parsedGcode:
-		line[AttrType.x] += translationX
-		line[AttrType.y] += translationY
+
+def translateToFirstQuarter(parsedGcode, log=_log_nothing):
+	parsedGcode = asPath(parsedGcode)
+	translationX, translationY = parsedGcode.getBounds().getTranslation()
+	parsedGcode.translate(translationX, translationY)
 
 	log(f"[info] Translation vector: ({translationX}, {translationY})")
 	return parsedGcode
 
 def getDilationFactor(parsedGcode, xSize, ySize):
-	xSizeReal = max([line[AttrType.x] for line in parsedGcode]) - min([line[AttrType.x] for line in parsedGcode])
-	ySizeReal = max([line[AttrType.y] for line in parsedGcode]) - min([line[AttrType.y] for line in parsedGcode])
+	bounds = asPath(parsedGcode).getBounds()
+	xSizeReal = bounds.maxX - bounds.minX
+	ySizeReal = bounds.maxY - bounds.minY
 
 	return min([
 		xSize / xSizeReal,
@@ -208,19 +570,18 @@ def getDilationFactor(parsedGcode, xSize, ySize):
 	])
 
 def dilate(parsedGcode, dilationFactor):
-	for line in parsedGcode:
-		line[AttrType.x] *= dilationFactor
-		line[AttrType.y] *= dilationFactor
+	parsedGcode = asPath(parsedGcode)
+	parsedGcode.scale(dilationFactor)
 	return parsedGcode
 
 def addEnd(parsedGcode, endHome=False, log=_log_nothing):
+	parsedGcode = asPath(parsedGcode)
 	if endHome:
-		parsedGcode.append(ParsedLine.fromRawCoordinates(0, 0, 0))
+		parsedGcode.appendCoordinates(0, 0, 0)
 		log("[info] The gcode path ends at (0, 0)")
 	elif len(parsedGcode) > 0:
-		parsedGcode.append(ParsedLine.fromRawCoordinates(0,
-			parsedGcode[-1][AttrType.x], parsedGcode[-1][AttrType.y]))
-		log(f"[info] Before dilating the gcode path ends at ({parsedGcode[-1][AttrType.x]}, {parsedGcode[-1][AttrType.y]})")
+		parsedGcode.appendCoordinates(0, parsedGcode.x[-1], parsedGcode.y[-1])
+		log(f"[info] Before dilating the gcode path ends at ({parsedGcode.x[-1]}, {parsedGcode.y[-1]})")
 	return parsedGcode
 
 def resize(parsedGcode, xSize, ySize, dilation=1.0, log=_log_nothing):
@@ -230,47 +591,724 @@ def resize(parsedGcode, xSize, ySize, dilation=1.0, log=_log_nothing):
 	log("[info] Dilation factor:", dilationFactor)
 	return parsedGcode
 
-def toGcode(parsedGcode):
-	return "\n".join([l.gcode() for l in parsedGcode], ) + "\n"
+def getTravelDistance(parsedGcode):
+	"""Total length of the pen up moves, starting from (0, 0)"""
+	travel = 0.0
+	lastX, lastY = 0.0, 0.0
+	for pen, x, y in _iterCoordinates(parsedGcode):
+		if not pen:
+			travel += math.hypot(x - lastX, y - lastY)
+		lastX, lastY = x, y
+	return travel
+
+class _StrokeEndpointGrid:
+	"""Uniform grid of stroke endpoints, used to find the nearest unused stroke"""
+	def __init__(self, endpoints, used, strokeCount):
+		# endpoints is a list of (x, y, strokeIndex, reverse)
+		self.used = used
+		self.strokeCount = strokeCount
+
+		minX = min(e[0] for e in endpoints)
+		maxX = max(e[0] for e in endpoints)
+		minY = min(e[1] for e in endpoints)
+		maxY = max(e[1] for e in endpoints)
+		# about one endpoint per cell
+		self.cellSize = max(math.sqrt((maxX - minX) * (maxY - minY) / len(endpoints)),
+			(maxX - minX) / len(endpoints), (maxY - minY) / len(endpoints), 1e-9)
+
+		self.cells = {}
+		for endpoint in endpoints:
+			self.cells.setdefault(self._cellOf(endpoint[0], endpoint[1]), []).append(endpoint)
+		self.minCellX, self.minCellY = self._cellOf(minX, minY)
+		self.maxCellX, self.maxCellY = self._cellOf(maxX, maxY)
+
+	def _cellOf(self, x, y):
+		return int(math.floor(x / self.cellSize)), int(math.floor(y / self.cellSize))
+
+	def _iterRing(self, cellX, cellY, radius):
+		if radius == 0:
+			yield cellX, cellY
+			return
+		for x in range(max(cellX - radius, self.minCellX), min(cellX + radius, self.maxCellX) + 1):
+			yield x, cellY - radius
+			yield x, cellY + radius
+		for y in range(max(cellY - radius + 1, self.minCellY), min(cellY + radius - 1, self.maxCellY) + 1):
+			yield cellX - radius, y
+			yield cellX + radius, y
+
+	def findNearest(self, x, y):
+		cellX, cellY = self._cellOf(x, y)
+		# rings closer than minRadius or farther than maxRadius do not intersect the grid
+		minRadius = max(0, self.minCellX - cellX, cellX - self.maxCellX, self.minCellY - cellY, cellY - self.maxCellY)
+		maxRadius = max(abs(cellX - self.minCellX), abs(cellX - self.maxCellX),
+			abs(cellY - self.minCellY), abs(cellY - self.maxCellY))
+
+		best, bestDistance = None, math.inf
+		for radius in range(minRadius, maxRadius + 1):
+			for cell in self._iterRing(cellX, cellY, radius):
+				for endpoint in self.cells.get(cell, ()):
+					if self.used[endpoint[2]]:
+						continue
+					distance = (endpoint[0] - x) ** 2 + (endpoint[1] - y) ** 2
+					if distance < bestDistance:
+						best, bestDistance = endpoint, distance
+
+			# endpoints in the next rings are at least radius*cellSize away
+			if bestDistance <= (radius * self.cellSize) ** 2:
+				break
+		return best
+
+def optimizeTravel(parsedGcode, reverseStrokes=True, log=_log_nothing):
+	"""
+	Reorders (and, if reverseStrokes, reverses) the pen down strokes so that the pen up travel
+	between them is reduced, using a greedy nearest neighbour search. The plotter is assumed
+	to start at (0, 0), so this should be called after translateToFirstQuarter and before addEnd.
+	"""
+	path = asPath(parsedGcode)
+	travelBefore = getTravelDistance(path)
+
+	# pen down points at the beginning are drawn starting from (0, 0), so they are kept first
+	prefixEnd = 0
+	while prefixEnd < len(path) and path.pen[prefixEnd]:
+		prefixEnd += 1
+
+	# every stroke starts with a pen up point followed by pen down points; lone pen up
+	# points are dropped, since they would only add travel
+	strokes = []
+	i = prefixEnd
+	while i < len(path):
+		start = i
+		i += 1
+		while i < len(path) and path.pen[i]:
+			i += 1
+		if i - start > 1:
+			strokes.append((start, i))
+
+	optimizedPath = Path()
+	optimizedPath.extend(path, 0, prefixEnd)
+	x, y = (path.x[prefixEnd-1], path.y[prefixEnd-1]) if prefixEnd > 0 else (0.0, 0.0)
+
+	used = bytearray(len(strokes))
+	remaining = len(strokes)
+	grid = None
+	while remaining > 0:
+		if grid is None or remaining * 2 < grid.strokeCount:
+			# rebuild the grid from time to time, so that searches do not go through used strokes
+			endpoints = []
+			for index, (start, end) in enumerate(strokes):
+				if not used[index]:
+					endpoints.append((path.x[start], path.y[start], index, False))
+					if reverseStrokes:
+						endpoints.append((path.x[end-1], path.y[end-1], index, True))
+			grid = _StrokeEndpointGrid(endpoints, used, remaining)
+
+		_, _, index, reverse = grid.findNearest(x, y)
+		used[index] = 1
+		remaining -= 1
+
+		start, end = strokes[index]
+		optimizedPath.extend(path, start, end, reverse)
+		x, y = optimizedPath.x[-1], optimizedPath.y[-1]
+
+	travelAfter = getTravelDistance(optimizedPath)
+	saved = 0.0 if travelBefore == 0 else 100.0 * (travelBefore - travelAfter) / travelBefore
+	log(f"[info] Pen up travel reduced from {travelBefore:.3f} to {travelAfter:.3f} ({saved:.1f}% saved) by reordering {len(strokes)} strokes")
+	return optimizedPath
+
+def _douglasPeucker(xs, ys, tolerance):
+	"""Returns which points of the polyline have to be kept, as a bytearray of flags"""
+	keep = bytearray(len(xs))
+	keep[0], keep[-1] = 1, 1
+	toCheck = [(0, len(xs) - 1)]
+	squaredTolerance = tolerance * tolerance
+
+	while toCheck:
+		first, last = toCheck.pop()
+		ax, ay = xs[first], ys[first]
+		dx, dy = xs[last] - ax, ys[last] - ay
+		squaredLength = dx * dx + dy * dy
+
+		farthest, farthestDistance = None, squaredTolerance
+		for i in range(first + 1, last):
+			px, py = xs[i] - ax, ys[i] - ay
+			# squared distance from the segment (not from the whole line)
+			t = 0.0 if squaredLength == 0 else min(1.0, max(0.0, (px * dx + py * dy) / squaredLength))
+			ex, ey = px - t * dx, py - t * dy
+			distance = ex * ex + ey * ey
+			if distance > farthestDistance:
+				farthest, farthestDistance = i, distance
+
+		if farthest is not None:
+			keep[farthest] = 1
+			toCheck.append((first, farthest))
+			toCheck.append((farthest, last))
+
+	return keep
+
+def _iterSimplifiedPoints(points, tolerance):
+	"""
+	Simplifies the pen down runs of an iterable of (pen, x, y, lineNr) tuples with the
+	Douglas-Peucker algorithm, and joins runs separated by a pen up move not longer than
+	tolerance. Only one run at a time is kept in memory.
+	"""
+	# the plotter starts at (0, 0), which is the anchor of pen down points at the beginning
+	run = [(0, 0.0, 0.0, None)]
+	pendingPenUp = None
+
+	def flushRun():
+		if len(run) > 1:
+			keep = _douglasPeucker([p[1] for p in run], [p[2] for p in run], tolerance)
+			# the anchor has already been yielded
+			yield from (point for point, kept in zip(run[1:], keep[1:]) if kept)
+
+	for point in points:
+		if not point[0]:
+			if pendingPenUp is not None:
+				yield from flushRun()
+				yield pendingPenUp
+				run = [pendingPenUp]
+			pendingPenUp = point
+
+		elif pendingPenUp is not None:
+			if math.hypot(pendingPenUp[1] - run[-1][1], pendingPenUp[2] - run[-1][2]) <= tolerance:
+				# lifting the pen for such a short move is useless, just keep drawing
+				run.append(point)
+			else:
+				yield from flushRun()
+				yield pendingPenUp
+				run = [pendingPenUp, point]
+			pendingPenUp = None
 
-def toBinaryData(parsedGcode):
+		else:
+			run.append(point)
+
+	yield from flushRun()
+	if pendingPenUp is not None:
+		yield pendingPenUp
+
+def simplify(parsedGcode, tolerance, log=_log_nothing):
+	"""
+	Removes the points that deviate less than tolerance from the simplified path; since the
+	tolerance is absolute, this should be called after resize, when coordinates are in steps
+	"""
+	path = asPath(parsedGcode)
+	simplifiedPath = Path()
+	for pen, x, y, lineNr in _iterSimplifiedPoints(zip(path.pen, path.x, path.y, path.lineNr), tolerance):
+		simplifiedPath.pen.append(pen)
+		simplifiedPath.x.append(x)
+		simplifiedPath.y.append(y)
+		simplifiedPath.lineNr.append(Path._noLineNr if lineNr is None else lineNr)
+
+	log(f"[info] Simplification with tolerance {tolerance} kept {len(simplifiedPath)} of {len(path)} points")
+	return simplifiedPath
+
+def iterSimplified(parsedLines, tolerance):
+	"""Same as simplify, but works lazily on ParsedLine objects (e.g. generated by streamGcode)"""
+	points = ((line[AttrType.pen], line[AttrType.x], line[AttrType.y], line.lineNr) for line in parsedLines)
+	for pen, x, y, lineNr in _iterSimplifiedPoints(points, tolerance):
+		yield ParsedLine.fromRawCoordinates(pen, x, y, lineNr)
+
+def toGcode(parsedGcode):
+	return "".join([f"G{pen} X{x:.3f} Y{y:.3f}\n" for pen, x, y in _iterCoordinates(parsedGcode)]) or "\n"
+
+def _splitMove(mode, deltaX, deltaY):
+	# split in the smallest number of records that fit the int16 range, evenly spaced on the segment
+	parts = -(-max(abs(deltaX), abs(deltaY)) // maxBinaryDelta)
+	doneX, doneY = 0, 0
+	for part in range(1, parts + 1):
+		partX, partY = deltaX * part // parts, deltaY * part // parts
+		yield mode, partX - doneX, partY - doneY
+		doneX, doneY = partX, partY
+
+def iterBinaryRecords(parsedGcode):
+	"""Yields (mode, deltaX, deltaY) tuples, splitting moves that do not fit in the binary format"""
 	stepsX, stepsY = 0, 0
-	data = b""
 
-	for line in parsedGcode:
-		currentStepsX = int(round(line[AttrType.x]-stepsX))
-		currentStepsY = int(round(line[AttrType.y]-stepsY))
+	for pen, x, y in _iterCoordinates(parsedGcode):
+		currentStepsX = int(round(x-stepsX))
+		currentStepsY = int(round(y-stepsY))
 		stepsX += currentStepsX
 		stepsY += currentStepsY
 
-		if line[AttrType.pen]:
-			data += writeByte
+		mode = writeByte if pen else moveByte
+		if (minBinaryDelta <= currentStepsX <= maxBinaryDelta
+				and minBinaryDelta <= currentStepsY <= maxBinaryDelta):
+			yield mode, currentStepsX, currentStepsY
 		else:
-			data += moveByte
-
-		data += currentStepsX.to_bytes(2, byteorder="big", signed=True)
-		data += currentStepsY.to_bytes(2, byteorder="big", signed=True)
+			yield from _splitMove(mode, currentStepsX, currentStepsY)
 
-	return data
-
-def parseGcode(data, useG=False, feedVisibleBelow=None, speedVisibleBelow=None, log=_log_nothing):
-	attributeParser = AttributeParser(useG, feedVisibleBelow, speedVisibleBelow)
-	lines = data.split("\n")
+def toBinaryData(parsedGcode):
+	# preallocate one record per line, growing only if some moves need to be split
+	data = bytearray(binaryRecord.size * len(parsedGcode)) if hasattr(parsedGcode, "__len__") else bytearray()
+	offset = 0
+
+	for mode, deltaX, deltaY in iterBinaryRecords(parsedGcode):
+		if offset + binaryRecord.size > len(data):
+			data.extend(bytes(len(data) // 2 + binaryRecord.size))
+		binaryRecord.pack_into(data, offset, mode, deltaX, deltaY)
+		offset += binaryRecord.size
+
+	del data[offset:]
+	return bytes(data)
+
+def iterBinaryData(parsedGcode):
+	for record in iterBinaryRecords(parsedGcode):
+		yield binaryRecord.pack(*record)
+
+def _packCompactRecord(mode, deltaX, deltaY):
+	if minTinyDelta <= deltaX <= maxTinyDelta and minTinyDelta <= deltaY <= maxTinyDelta:
+		return bytes((tinyRecordFlag | (tinyWriteFlag if mode == writeByte else 0)
+			| ((deltaX & 0b111) << 3) | (deltaY & 0b111),))
+	elif minShortDelta <= deltaX <= maxShortDelta and minShortDelta <= deltaY <= maxShortDelta:
+		return shortRecord.pack(writeShortByte if mode == writeByte else moveShortByte, deltaX, deltaY)
+	else:
+		return binaryRecord.pack(mode, deltaX, deltaY)
+
+def iterCompactBinaryData(parsedGcode):
+	yield compactHeader
+	for record in iterBinaryRecords(parsedGcode):
+		yield _packCompactRecord(*record)
+
+def toCompactBinaryData(parsedGcode):
+	return b"".join(iterCompactBinaryData(parsedGcode))
+
+def iterBinaryCommands(data, offset=None):
+	"""
+	Decodes binary data in either format, yielding (mode, deltaX, deltaY, offset, length)
+	for every record, where mode is writeByte or moveByte. If offset is provided decoding
+	starts there instead of at the first record.
+	"""
+	if offset is None:
+		offset = len(compactHeader) if data[:len(compactHeader)] == compactHeader else 0
+	while offset < len(data):
+		first = data[offset]
+		try:
+			if first & tinyRecordFlag:
+				mode = writeByte if first & tinyWriteFlag else moveByte
+				# 3-bit two's complement
+				deltaX = ((first >> 3) & 0b111) - (8 if first & 0b100000 else 0)
+				deltaY = (first & 0b111) - (8 if first & 0b100 else 0)
+				length = 1
+			elif first == writeShortByte[0] or first == moveShortByte[0]:
+				_, deltaX, deltaY = shortRecord.unpack_from(data, offset)
+				mode = writeByte if first == writeShortByte[0] else moveByte
+				length = shortRecord.size
+			elif first == writeByte[0] or first == moveByte[0]:
+				mode, deltaX, deltaY = binaryRecord.unpack_from(data, offset)
+				length = binaryRecord.size
+			else:
+				raise ValueError(f"invalid binary data: unknown record type {first} at offset {offset}")
+		except struct.error:
+			raise ValueError(f"invalid binary data: truncated record at offset {offset}")
+
+		yield mode, deltaX, deltaY, offset, length
+		offset += length
+
+def toSimpleBinaryData(data):
+	"""Converts binary data in either format to the simple format (version 1)"""
+	return b"".join(binaryRecord.pack(mode, deltaX, deltaY)
+		for mode, deltaX, deltaY, _, _ in iterBinaryCommands(data))
+
+def countBinaryCommands(data):
+	if data[:len(compactHeader)] == compactHeader:
+		return sum(1 for _ in iterBinaryCommands(data))
+	return len(data) // binaryRecord.size
+
+def iterWithGcodeOutput(parsedLines, gcodeFile=None):
+	"""Yields parsedLines unchanged, writing the gcode of each one to gcodeFile (if not None)"""
+	for line in parsedLines:
+		if gcodeFile is not None:
+			gcodeFile.write(line.gcode() + "\n")
+		yield line
+
+def writeOutputs(parsedGcode, gcodeFile=None, binaryFile=None, binaryFormat=1):
+	"""
+	Writes the gcode and/or the binary data to files while iterating over parsedGcode only
+	once, so that it works with lines generated lazily (e.g. by streamGcode)
+	"""
+	iterData = iterCompactBinaryData if binaryFormat == 2 else iterBinaryData
+	for data in iterData(iterWithGcodeOutput(parsedGcode, gcodeFile)):
+		if binaryFile is not None:
+			binaryFile.write(data)
+
+def iterBinaryChunks(parsedGcode, binaryFormat=1, chunkSize=4096):
+	"""
+	Yields the binary data of parsedGcode in bytes chunks of about chunkSize bytes, every one
+	ending at a record boundary, so that the first ones can be sent before the others are ready
+	"""
+	iterData = iterCompactBinaryData if binaryFormat == 2 else iterBinaryData
+	chunk = bytearray()
+	for data in iterData(parsedGcode):
+		chunk += data
+		if len(chunk) >= chunkSize:
+			yield bytes(chunk)
+			chunk.clear()
+	if chunk:
+		yield bytes(chunk)
+
+def _iterLines(data):
+	# behaves like data.split("\n"), but also accepts text file objects and reads them lazily
+	if isinstance(data, str):
+		data = io.StringIO(data)
+
+	lineNr = 0
+	endsWithNewline = True
+	for line in data:
+		lineNr += 1
+		endsWithNewline = line.endswith("\n")
+		yield lineNr, (line[:-1] if endsWithNewline else line)
+
+	if endsWithNewline:
+		yield lineNr + 1, ""
+
+def _countingLog(log, stats):
+	"""Wraps log so that the warnings and comments logged while parsing are counted in stats"""
+	if not stats.enabled:
+		return log
+
+	def countingLog(*args, **kwargs):
+		if args and isinstance(args[0], str):
+			if args[0].startswith("[WARNING"):
+				stats.count("parse warnings")
+			elif args[0].startswith("[comment"):
+				stats.count("comments")
+		log(*args, **kwargs)
+	return countingLog
+
+def _iterParsedPoints(data, useG, feedVisibleBelow, speedVisibleBelow, log, stats=job_stats.noStats, arcTolerance=defaultArcTolerance):
+	# yields (pen, x, y, lineNr) tuples, avoiding the cost of ParsedLine objects for every line
+	log = _countingLog(log, stats)
+	logComments = _logsComments(log)
+	attributeParser = AttributeParser(useG, feedVisibleBelow, speedVisibleBelow, arcTolerance)
 	# mostly safe: it should be overwritten by the first (move) command in data
-	parsedGcode = [ParsedLine.fromRawCoordinates(0, 0, 0, 0)]
+	lastPen, lastX, lastY, lastLineNr = 0, 0, 0, 0
+
+	for lineNr, line in _iterLines(data):
+		if "(" in line:
+			line = _removeComments(line, lineNr, log=log, logComments=logComments)
+		pen, x, y = attributeParser.parseLine(line, lineNr, lastPen, lastX, lastY, log=log)
+
+		if attributeParser.arcLine:
+			# the points of the flattened arc come from the same line as its end
+			for arcX, arcY in attributeParser.takeArcPoints(lastX, lastY, x, y, lineNr, log=log):
+				if not ((arcX == lastX and arcY == lastY and pen == lastPen) or (pen == 0 and lastPen == 0)):
+					yield lastPen, lastX, lastY, lastLineNr
+				lastPen, lastX, lastY, lastLineNr = pen, arcX, arcY, lineNr
+
+		# same as ParsedLine.shouldOverwrite
+		if not ((x == lastX and y == lastY and pen == lastPen) or (pen == 0 and lastPen == 0)):
+			yield lastPen, lastX, lastY, lastLineNr
+		lastPen, lastX, lastY, lastLineNr = pen, x, y, lineNr
+
+	stats.count("lines parsed", lastLineNr)
+	# remove trailing command that does not write anything
+	if lastPen != 0:
+		yield lastPen, lastX, lastY, lastLineNr
+
+def iterParseGcode(data, useG=False, feedVisibleBelow=None, speedVisibleBelow=None, log=_log_nothing, stats=job_stats.noStats,
+		arcTolerance=defaultArcTolerance):
+	for pen, x, y, lineNr in _iterParsedPoints(data, useG, feedVisibleBelow, speedVisibleBelow, log, stats, arcTolerance):
+		yield ParsedLine.fromRawCoordinates(pen, x, y, lineNr)
+
+def parseGcode(data, useG=False, feedVisibleBelow=None, speedVisibleBelow=None, log=_log_nothing, stats=job_stats.noStats,
+		arcTolerance=defaultArcTolerance):
+	path = Path()
+	for point in _iterParsedPoints(data, useG, feedVisibleBelow, speedVisibleBelow, log, stats, arcTolerance):
+		path.appendCoordinates(*point)
+	stats.count("points parsed", len(path))
+	return path
+
+def pathFromPoints(points, stats=job_stats.noStats):
+	"""
+	Builds a Path from (pen, x, y, lineNr) tuples of already parsed lines (e.g. laid out text),
+	dropping redundant points exactly like parseGcode would drop them from the equivalent gcode
+	"""
+	path = Path()
+	lastPen, lastX, lastY, lastLineNr = 0, 0, 0, 0
+	for pen, x, y, lineNr in points:
+		# same as ParsedLine.shouldOverwrite
+		if not ((x == lastX and y == lastY and pen == lastPen) or (pen == 0 and lastPen == 0)):
+			path.appendCoordinates(lastPen, lastX, lastY, lastLineNr)
+		lastPen, lastX, lastY, lastLineNr = pen, x, y, lineNr
+
+	stats.count("lines parsed", lastLineNr)
+	if lastPen != 0:
+		path.appendCoordinates(lastPen, lastX, lastY, lastLineNr)
+	stats.count("points parsed", len(path))
+	return path
+
+def _splitChunks(data, chunkCount):
+	"""Splits data at newlines into at most chunkCount (text, firstLineNr) chunks of similar length"""
+	chunkSize = max(len(data) // chunkCount, 1)
+	chunks = []
+	start, lineNr = 0, 1
+	while True:
+		end = data.find("\n", start + chunkSize)
+		if end == -1:
+			chunks.append((data[start:], lineNr))
+			return chunks
+		chunks.append((data[start:end], lineNr))
+		lineNr += data.count("\n", start, end) + 1
+		start = end + 1
+
+def _parseChunk(chunk):
+	"""
+	Parses a chunk of lines in a worker process. The pen and the coordinates at the start of the
+	chunk are unknown (None), so lines are returned unmerged in prefix until the chunk has set all of
+	them. From then on nothing depends on previous chunks anymore, and lines are merged into points
+	as in _iterParsedPoints, except for the last one, which is returned separately since merging it
+	depends on the next chunk. Log calls are recorded to be replayed by the main process.
+	"""
+	(text, firstLineNr), useG, feedVisibleBelow, speedVisibleBelow, recordLog, recordComments = chunk
+	messages = []
+	log = (lambda *args, **kwargs: messages.append((args, kwargs))) if recordLog else _log_nothing
 
-	for l in range(0, len(lines)):
-		parsedLine = ParsedLine.fromGcodeLine(attributeParser, lines[l], l+1, parsedGcode[-1].attributes, log=log)
-		if parsedLine.shouldOverwrite(parsedGcode[-1].attributes):
-			parsedGcode[-1] = parsedLine
+	attributeParser = AttributeParser(useG, feedVisibleBelow, speedVisibleBelow)
+	prefix = []
+	points = Path()
+	pen, x, y = None, None, None
+	last = None
+
+	for lineNr, line in enumerate(text.split("\n"), firstLineNr):
+		if "(" in line:
+			line = _removeComments(line, lineNr, log=log, logComments=recordComments)
+		pen, x, y = attributeParser.parseLine(line, lineNr, pen, x, y, log=log)
+		if attributeParser.arcLine:
+			# chunks never contain G2/G3 (see parseGcodeParallel), so this only warns about stray arc words
+			attributeParser.takeArcPoints(x, y, x, y, lineNr, log=log)
+
+		if last is None:
+			prefix.append((pen, x, y, lineNr))
+			if pen is not None and x is not None and y is not None:
+				last = (pen, x, y, lineNr)
 		else:
-			parsedGcode.append(parsedLine)
+			lastPen, lastX, lastY, _ = last
+			# same as ParsedLine.shouldOverwrite
+			if not ((x == lastX and y == lastY and pen == lastPen) or (pen == 0 and lastPen == 0)):
+				points.appendCoordinates(*last)
+			last = (pen, x, y, lineNr)
+
+	return prefix, points, last, messages
+
+def parseGcodeParallel(data, useG=False, feedVisibleBelow=None, speedVisibleBelow=None, workers=None, log=_log_nothing, stats=job_stats.noStats,
+		arcTolerance=defaultArcTolerance):
+	"""
+	Same result as parseGcode(data), but the lines are split in chunks parsed by a pool of workers
+	processes (os.cpu_count() if workers is None). The chunks are then stitched together carrying
+	the pen and coordinates across chunk boundaries and merging lines at the seams. Gcode with
+	arcs is parsed sequentially, since flattening an arc needs the point it starts from.
+	"""
+	if workers is None:
+		workers = os.cpu_count() or 1
+	if workers > 1 and containsArcs(data):
+		log("[info] The gcode contains arcs, parsing it sequentially")
+		workers = 1
+	if workers <= 1:
+		return parseGcode(data, useG, feedVisibleBelow, speedVisibleBelow, log=log, stats=stats, arcTolerance=arcTolerance)
+
+	log = _countingLog(log, stats)
+	# more chunks than workers, so that a slow chunk does not keep the others waiting
+	chunks = _splitChunks(data, workers * 4)
+	recordLog = log is not _log_nothing and job_log.isEnabled(log, "warning")
+	recordComments = _logsComments(log)
+	path = Path()
+	lastPen, lastX, lastY, lastLineNr = 0, 0, 0, 0
+
+	with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+		for prefix, points, last, messages in executor.map(_parseChunk, ((chunk, useG, feedVisibleBelow, speedVisibleBelow, recordLog, recordComments) for chunk in chunks)):
+			for args, kwargs in messages:
+				log(*args, **kwargs)
+
+			for pen, x, y, lineNr in prefix:
+				# attributes not yet set in the chunk have the value they had at the end of the previous one
+				pen = lastPen if pen is None else pen
+				x = lastX if x is None else x
+				y = lastY if y is None else y
+				if not ((x == lastX and y == lastY and pen == lastPen) or (pen == 0 and lastPen == 0)):
+					path.appendCoordinates(lastPen, lastX, lastY, lastLineNr)
+				lastPen, lastX, lastY, lastLineNr = pen, x, y, lineNr
+
+			if last is not None:
+				path.extend(points, 0, len(points))
+				lastPen, lastX, lastY, lastLineNr = last
 
 	# remove trailing command that does not write anything
-	if len(parsedGcode) > 0 and parsedGcode[-1][AttrType.pen] == 0:
-		parsedGcode = parsedGcode[:-1]
+	if lastPen != 0:
+		path.appendCoordinates(lastPen, lastX, lastY, lastLineNr)
+	stats.count("lines parsed", lastLineNr)
+	stats.count("points parsed", len(path))
+	return path
+
+def scanBounds(data, useG=False, feedVisibleBelow=None, speedVisibleBelow=None, arcTolerance=defaultArcTolerance):
+	"""
+	Returns the Bounds of the path parseGcode would return for data (str or text file), without
+	building the path. Used to fix the transformations in advance when parsing lazily.
+	"""
+	bounds = Bounds()
+	minX, minY, maxX, maxY = bounds.minX, bounds.minY, bounds.maxX, bounds.maxY
+	x = y = None
+	for _, x, y, _ in _iterParsedPoints(data, useG, feedVisibleBelow, speedVisibleBelow, _log_nothing, arcTolerance=arcTolerance):
+		if x < minX: minX = x
+		if x > maxX: maxX = x
+		if y < minY: minY = y
+		if y > maxY: maxY = y
+
+	bounds.minX, bounds.minY, bounds.maxX, bounds.maxY = minX, minY, maxX, maxY
+	if x is not None:
+		bounds.last = (x, y)
+	return bounds
+
+_arcRegex = re.compile(r"(?<!\S)[Gg][-+]?0*[23](?![0-9])")
+
+def containsArcs(data):
+	"""
+	Whether data (str or seekable text file, whose position is restored) contains G2 or G3
+	words. False positives (e.g. in comments) are possible, but not false negatives.
+	"""
+	if isinstance(data, str):
+		return _arcRegex.search(data) is not None
+
+	start = data.tell()
+	try:
+		while True:
+			lines = list(itertools.islice(data, 10000))
+			if len(lines) == 0:
+				return False
+			if _arcRegex.search("".join(lines)) is not None:
+				return True
+	finally:
+		data.seek(start)
+
+def arcToleranceFor(data, xSize, ySize, dilation=1.0, useG=False, feedVisibleBelow=None, speedVisibleBelow=None):
+	"""
+	Returns the arc tolerance (in gcode units) that keeps the flattened arcs of data (str or
+	seekable text file, whose position is restored) within arcStepTolerance steps of the real
+	ones after resize(xSize, ySize, dilation), so that arcs get the fewest segments that still
+	matter once positions are rounded to steps. Returns defaultArcTolerance if there are no arcs.
+	"""
+	if not containsArcs(data):
+		return defaultArcTolerance
+
+	start = None if isinstance(data, str) else data.tell()
+	# the bounds barely depend on the tolerance, so the default one is good enough to find them
+	bounds = scanBounds(data, useG, feedVisibleBelow, speedVisibleBelow)
+	if start is not None:
+		data.seek(start)
+	if bounds.isEmpty():
+		return defaultArcTolerance
+	return arcStepTolerance / (dilation * bounds.getDilationFactor(xSize, ySize))
+
+def streamGcode(file, xSize, ySize, dilation=1.0, endHome=False,
+		useG=False, feedVisibleBelow=None, speedVisibleBelow=None, sampleLines=None, log=_log_nothing, stats=job_stats.noStats,
+		arcTolerance=None):
+	"""
+	Equivalent to parseGcode followed by translateToFirstQuarter, addEnd and resize, but
+	memory usage does not depend on the size of the input. The seekable text file is read
+	twice: the first time to collect the bounds, the second one to yield transformed lines.
+	If no parsing mode is provided it is detected with an additional pass (limited to the first
+	sampleLines lines if sampleLines is not None). If arcTolerance is None it is chosen with
+	arcToleranceFor, which scans the file once more if it contains arcs.
+	"""
+	start = file.tell()
+	if useG == False and feedVisibleBelow is None and speedVisibleBelow is None:
+		useG, feedVisibleBelow, speedVisibleBelow = detectParsingMode(file, sampleLines, log=log, stats=stats)
+		file.seek(start)
+
+	if arcTolerance is None:
+		arcTolerance = arcToleranceFor(file, xSize, ySize, dilation, useG, feedVisibleBelow, speedVisibleBelow)
+	bounds = scanBounds(file, useG, feedVisibleBelow, speedVisibleBelow, arcTolerance)
+	file.seek(start)
+
+	if bounds.isEmpty():
+		raise ValueError("the gcode does not contain any line to print")
+
+	translationX, translationY = bounds.getTranslation()
+	log(f"[info] Translation vector: ({translationX}, {translationY})")
+	if endHome:
+		log("[info] The gcode path ends at (0, 0)")
+	else:
+		log(f"[info] Before dilating the gcode path ends at ({bounds.last[0] + translationX}, {bounds.last[1] + translationY})")
+	dilationFactor = dilation * bounds.getDilationFactor(xSize, ySize)
+	log("[info] Dilation factor:", dilationFactor)
 
-	return parsedGcode
+	lastLine = None
+	for line in iterParseGcode(file, useG, feedVisibleBelow, speedVisibleBelow, log=log, stats=stats, arcTolerance=arcTolerance):
+		line[AttrType.x] = (line[AttrType.x] + translationX) * dilationFactor
+		line[AttrType.y] = (line[AttrType.y] + translationY) * dilationFactor
+		yield line
+		lastLine = line
+
+	if endHome:
+		yield ParsedLine.fromRawCoordinates(0, 0, 0)
+	else:
+		yield ParsedLine.fromRawCoordinates(0, lastLine[AttrType.x], lastLine[AttrType.y])
+
+# The options dicts taken by the pipeline below have the same keys as the command line arguments:
+# xSize, ySize, dilation, end_home, optimize_travel, keep_stroke_direction, simplify,
+# binary_format, use_g, feed_visible_below, speed_visible_below and sample_lines.
+
+def parseWithOptions(data, options, workers=1, log=_log_nothing, stats=job_stats.noStats):
+	"""
+	Parses the gcode in data according to options, detecting the parsing mode if none is given.
+	workers is passed to parseGcodeParallel.
+	"""
+	useG, feedVisibleBelow, speedVisibleBelow = options["use_g"], options["feed_visible_below"], options["speed_visible_below"]
+	if useG == False and feedVisibleBelow is None and speedVisibleBelow is None:
+		with stats.stage("detect"):
+			useG, feedVisibleBelow, speedVisibleBelow = detectParsingMode(data, options["sample_lines"], log=log, stats=stats)
+
+	with stats.stage("parse"):
+		arcTolerance = arcToleranceFor(data, options["xSize"], options["ySize"], options["dilation"],
+			useG, feedVisibleBelow, speedVisibleBelow)
+		return parseGcodeParallel(data, useG, feedVisibleBelow, speedVisibleBelow, workers=workers,
+			log=log, stats=stats, arcTolerance=arcTolerance)
+
+def transformAndEncode(parsedGcode, options, withGcode=False, log=_log_nothing, stats=job_stats.noStats):
+	"""
+	Transforms parsedGcode according to options and returns its binary data together with the
+	normalized gcode, which is None unless withGcode
+	"""
+	if len(parsedGcode) == 0:
+		raise ValueError("the gcode does not contain any line to print")
+
+	with stats.stage("transform"):
+		parsedGcode = translateToFirstQuarter(parsedGcode, log=log)
+		if options["optimize_travel"]:
+			parsedGcode = optimizeTravel(parsedGcode, not options["keep_stroke_direction"], log=log)
+		parsedGcode = addEnd(parsedGcode, options["end_home"], log=log)
+		parsedGcode = resize(parsedGcode, options["xSize"], options["ySize"], options["dilation"], log=log)
+		if options["simplify"] is not None:
+			parsedGcode = simplify(parsedGcode, options["simplify"], log=log)
+
+	with stats.stage("encode"):
+		if options["binary_format"] == 2:
+			binaryData = toCompactBinaryData(parsedGcode)
+		else:
+			binaryData = toBinaryData(parsedGcode)
+	if stats.enabled:
+		stats.count("commands encoded", countBinaryCommands(binaryData))
+
+	if not withGcode:
+		return binaryData, None
+	with stats.stage("gcode output"):
+		return binaryData, toGcode(parsedGcode)
+
+def gcodeToBinary(data, options, withGcode=False, workers=1, log=_log_nothing, stats=job_stats.noStats):
+	"""
+	The whole pipeline of gcode_parser.py, shared by the other tools: parses the gcode in data
+	and transforms it according to options, returning (binaryData, gcode) like transformAndEncode
+	"""
+	parsedGcode = parseWithOptions(data, options, workers, log=log, stats=stats)
+	return transformAndEncode(parsedGcode, options, withGcode, log=log, stats=stats)
+
+def optionsFromArgs(namespace):
+	"""The options dict of the pipeline from parsed command line arguments"""
+	return dict(xSize=namespace.xSize, ySize=namespace.ySize, dilation=namespace.dilation,
+		end_home=namespace.end_home, optimize_travel=namespace.optimize_travel,
+		keep_stroke_direction=namespace.keep_stroke_direction, simplify=namespace.simplify,
+		binary_format=namespace.binary_format, use_g=namespace.use_g,
+		feed_visible_below=namespace.feed_visible_below, speed_visible_below=namespace.speed_visible_below,
+		sample_lines=namespace.sample_lines)
 
 
 def parseArgs(namespace):
@@ -285,6 +1323,14 @@ def parseArgs(namespace):
 		help="File in which to save the binary data ready to be fed to the plotter")
 	ioGroup.add_argument("-l", "--log", type=argparse.FileType('w'), required=False, metavar="FILE",
 		help="File in which to save logs, comments and warnings")
+	ioGroup.add_argument("--log-level", type=str, choices=job_log.levelNames, default=job_log.defaultLevel, metavar="LEVEL",
+		help=f"Log only messages at least as important as LEVEL, one of {', '.join(job_log.levelNames)}: \"comment\" adds gcode comments, \"trace\" every command sent and reply received (default: {job_log.defaultLevel})")
+	ioGroup.add_argument("--log-format", type=str, choices=job_log.formats, default="text", metavar="FORMAT",
+		help="Write logs as plain \"text\" (default) or as \"json\" lines with time, level and message")
+	ioGroup.add_argument("--binary-format", type=int, choices=[1, 2], default=1, metavar="VERSION",
+		help="Format of the binary data: 1 is understood by all plotters, 2 is more compact (default: 1)")
+	ioGroup.add_argument("--stats", type=str, choices=["summary", "json"], metavar="FORMAT",
+		help="Print the time spent in every stage and other statistics to stderr, either as a human readable \"summary\" or as \"json\"")
 
 	parseGroup = argParser.add_argument_group("Gcode parsing options (detected automatically if not provided)")
 	parseGroup.add_argument("-g", "--use-g", action="store_true",
@@ -293,6 +1339,10 @@ def parseArgs(namespace):
 		help="Consider `F` (feed) commands with a value above the provided as pen down, otherwise as pen up")
 	parseGroup.add_argument("--speed-visible-below", type=float, metavar="VALUE",
 		help="Consider `S` (speed) commands with a value above the provided as pen down, otherwise as pen up")
+	parseGroup.add_argument("--detection-sample", type=int, metavar="LINES", dest="sample_lines",
+		help="Detect the parsing mode looking only at the first LINES lines, instead of at the whole input")
+	parseGroup.add_argument("-j", "--jobs", type=int, default=1, metavar="WORKERS", dest="workers",
+		help="Parse the gcode using WORKERS processes, 0 means one per CPU core (default: 1, not available with --stream)")
 
 	genGroup = argParser.add_argument_group("Gcode generation options")
 	genGroup.add_argument("--end-home", action="store_true",
@@ -301,6 +1351,14 @@ def parseArgs(namespace):
 		help="The size of the print area in millimeters (e.g. 192.7x210.3)")
 	genGroup.add_argument("-d", "--dilation", type=float, default=1.0, metavar="FACTOR",
 		help="Dilation factor to apply (useful to convert mm to steps)")
+	genGroup.add_argument("--stream", action="store_true",
+		help="Read the input twice instead of keeping it in memory (requires a seekable input)")
+	genGroup.add_argument("--optimize-travel", action="store_true",
+		help="Reorder the strokes to reduce the distance travelled with the pen up (not available with --stream)")
+	genGroup.add_argument("--keep-stroke-direction", action="store_true",
+		help="When optimizing travel, do not draw strokes backwards")
+	genGroup.add_argument("--simplify", type=float, metavar="STEPS",
+		help="Remove points that are less than STEPS steps away from the simplified path (after dilation)")
 
 	argParser.parse_args(namespace=namespace)
 
@@ -315,37 +1373,55 @@ def parseArgs(namespace):
 	except:
 		argParser.error(f"invalid formatting for --size: {namespace.size}")
 
-	namespace.auto = (namespace.use_g == False and
-		namespace.feed_visible_below is None and
-		namespace.speed_visible_below is None)
+	if namespace.stream and not namespace.input.seekable():
+		argParser.error("--stream requires a seekable input file")
+	if namespace.stream and namespace.optimize_travel:
+		argParser.error("--optimize-travel needs the whole gcode in memory and can't be used with --stream")
+	if namespace.stream and namespace.workers != 1:
+		argParser.error("--jobs needs the whole gcode in memory and can't be used with --stream")
+	if namespace.workers < 0:
+		argParser.error("--jobs can't be negative")
+	if namespace.sample_lines is not None and namespace.sample_lines < 1:
+		argParser.error("--detection-sample must be at least 1")
 
 def main():
 	class Args: pass
 	parseArgs(Args)
 
-	def log(*args, **kwargs):
-		if Args.log is not None:
-			print(*args, **kwargs, file=Args.log)
-
-	data = Args.input.read()
+	log = job_log.noLog if Args.log is None else job_log.Logger(Args.log, Args.log_level, Args.log_format)
+	stats = job_stats.noStats if Args.stats is None else job_stats.Stats()
+
+	if Args.stream:
+		with stats.stage("stream"):
+			parsedGcode = streamGcode(Args.input, Args.xSize, Args.ySize, Args.dilation, Args.end_home,
+				useG=Args.use_g,
+				feedVisibleBelow=Args.feed_visible_below,
+				speedVisibleBelow=Args.speed_visible_below,
+				sampleLines=Args.sample_lines,
+				log=log, stats=stats)
+			if Args.simplify is not None:
+				parsedGcode = iterSimplified(parsedGcode, Args.simplify)
+			writeOutputs(parsedGcode, Args.output, Args.binary_output, Args.binary_format)
 
-	if Args.auto:
-		Args.use_g, Args.feed_visible_below, Args.speed_visible_below = \
-			detectParsingMode(data, log=log)
-
-	parsedGcode = parseGcode(data, log=log,
-		useG=Args.use_g,
-		feedVisibleBelow=Args.feed_visible_below,
-		speedVisibleBelow=Args.speed_visible_below)
-
-	parsedGcode = translateToFirstQuarter(parsedGcode, log=log)
-	parsedGcode = addEnd(parsedGcode, Args.end_home, log=log)
-	parsedGcode = resize(parsedGcode, Args.xSize, Args.ySize, Args.dilation, log=log)
-
-	if Args.output is not None:
-		Args.output.write(toGcode(parsedGcode))
-	if Args.binary_output is not None:
-		Args.binary_output.write(toBinaryData(parsedGcode))
+	else:
+		with stats.stage("read"):
+			data = Args.input.read()
+
+		binaryData, gcode = gcodeToBinary(data, optionsFromArgs(Args), Args.output is not None,
+			Args.workers or None, log=log, stats=stats)
+		if Args.output is not None:
+			Args.output.write(gcode)
+		if Args.binary_output is not None:
+			Args.binary_output.write(binaryData)
+			stats.count("binary bytes", len(binaryData))
+
+	# Args is collected only at exit, when the files opened by argparse may be freed without being flushed
+	for file in (Args.output, Args.binary_output):
+		if file is not None:
+			file.flush()
+
+	if Args.stats is not None:
+		stats.write(sys.stderr, Args.stats)
 
 if __name__ == '__main__':
 	main()
\ No newline at end of file
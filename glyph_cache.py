@@ -0,0 +1,116 @@
+#pylint: disable=no-member
+
+import os
+import json
+import hashlib
+import text_to_gcode.text_to_gcode as text_to_gcode
+import gcode_parser
+import job_cache
+import job_stats
+
+_formatVersion = 2 # increase whenever the content of the cache files changes
+
+
+def _log_nothing(*args, **kwargs):
+	pass
+
+
+class Glyph:
+	"""
+	A character parsed into one (pen, x, y) point relative to its origin for every line of its gcode,
+	or None for empty lines, and its width
+	"""
+
+	def __init__(self, points, width):
+		self.points = points
+		self.width = width
+
+def _parseLetter(letter):
+	# the gcode of the letter is parsed the same way it would be parsed as part of the text
+	attributeParser = gcode_parser.AttributeParser(True, None, None)
+	pen, x, y = 0, 0, 0
+	points = []
+	# every line ends with "\n", so the last element of split is not a line
+	for line in repr(letter).split("\n")[:-1]:
+		if line == "":
+			# e.g. characters without strokes, still a line of the gcode
+			points.append(None)
+		else:
+			pen, x, y = attributeParser.parseLine(line, None, pen, x, y)
+			points.append((pen, x, y))
+	return Glyph(points, letter.width)
+
+def parseLetters(letters):
+	"""Converts the letters returned by text_to_gcode.readLetters to a dict of Glyph"""
+	return {character: _parseLetter(letter) for character, letter in letters.items()}
+
+def _cachePath(directory, cacheDirectory):
+	# one file for every glyph directory, replaced when the directory changes
+	name = hashlib.sha256(os.path.abspath(directory).encode("utf8")).hexdigest()[:16]
+	return os.path.join(cacheDirectory, f"glyphs-{name}.json")
+
+def loadGlyphs(directory, cacheDirectory=job_cache.defaultDirectory, log=_log_nothing):
+	"""
+	Returns the glyphs of the characters in directory (see text_to_gcode.readLetters), reading them
+	from a file in cacheDirectory if the directory has not changed since they were saved there.
+	If cacheDirectory is None the glyphs are always read from directory.
+	"""
+	if cacheDirectory is None:
+		return parseLetters(text_to_gcode.readLetters(directory))
+
+	path = _cachePath(directory, cacheDirectory)
+	directoryHash = job_cache.hashDirectory(directory)
+	try:
+		with open(path, "r") as file:
+			cached = json.load(file)
+		if cached["version"] == _formatVersion and cached["directory_hash"] == directoryHash:
+			log(f"[info] Glyph cache hit: {directory}")
+			return {character: Glyph([None if point is None else tuple(point) for point in points], width)
+				for character, (points, width) in cached["glyphs"].items()}
+	except FileNotFoundError:
+		pass
+	except (ValueError, KeyError, TypeError):
+		log(f"[WARNING]: ignoring invalid glyph cache {path}", level="warning")
+
+	glyphs = parseLetters(text_to_gcode.readLetters(directory))
+	os.makedirs(cacheDirectory, exist_ok=True)
+	# write to a temporary file first, so that readers never see a partial cache
+	temporaryPath = f"{path}.{os.getpid()}.tmp"
+	with open(temporaryPath, "w") as file:
+		json.dump(dict(version=_formatVersion, directory_hash=directoryHash,
+			glyphs={character: (glyph.points, glyph.width) for character, glyph in glyphs.items()}), file)
+	os.replace(temporaryPath, path)
+	log(f"[info] Glyph cache store: {directory}")
+	return glyphs
+
+def iterTextPoints(glyphs, text, lineLength, lineSpacing, padding):
+	"""
+	Yields the (pen, x, y, lineNr) points of text laid out exactly like text_to_gcode.textToGcode
+	does, where lineNr is the line of the point in the gcode textToGcode would return
+	"""
+	offsetX, offsetY = 0, 0
+	pen, x, y, lineNr = 0, 0, 0, 0
+	for character in text:
+		glyph = glyphs[character]
+		for point in glyph.points:
+			lineNr += 1
+			# empty lines repeat the last point
+			if point is not None:
+				glyphPen, glyphX, glyphY = point
+				pen, x, y = glyphPen, glyphX + offsetX, glyphY + offsetY
+			yield pen, x, y, lineNr
+
+		offsetX += glyph.width + padding
+		if offsetX >= lineLength:
+			offsetX = 0
+			offsetY -= lineSpacing
+
+	# the gcode ends with an empty line, which repeats the last point
+	yield pen, x, y, lineNr + 1
+
+def layoutText(glyphs, text, lineLength, lineSpacing, padding, stats=job_stats.noStats):
+	"""
+	Returns the Path of text laid out with glyphs, the same as parsing the gcode returned by
+	text_to_gcode.textToGcode with useG=True, but without generating and parsing gcode
+	"""
+	return gcode_parser.pathFromPoints(iterTextPoints(glyphs, text, lineLength, lineSpacing, padding), stats=stats)
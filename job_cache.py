@@ -0,0 +1,169 @@
+#!/usr/bin/python3
+#pylint: disable=no-member
+
+import argparse
+import os
+import hashlib
+import json
+import gcode_parser
+
+defaultDirectory = os.path.join(os.path.expanduser("~"), ".cache", "plotter")
+defaultMaxSize = 256 * 1024 * 1024 # bytes
+binaryExtension = ".bin"
+gcodeExtension = ".gcode"
+_hashChunkSize = 1024 * 1024
+
+
+def _log_nothing(*args, **kwargs):
+	pass
+
+def _codeVersion():
+	"""Hash of the parser and text layout source code, so that cached jobs are invalidated when it changes"""
+	hasher = hashlib.sha256()
+	# glyph_cache imports this module, so its source is found next to the parser
+	for path in (gcode_parser.__file__, os.path.join(os.path.dirname(gcode_parser.__file__), "glyph_cache.py")):
+		with open(path, "rb") as file:
+			hasher.update(file.read())
+	return hasher.hexdigest()
+
+def hashData(data):
+	"""Hashes str or bytes data the same way hashFile would hash a file containing it"""
+	return hashlib.sha256(data.encode("utf8") if isinstance(data, str) else data).hexdigest()
+
+def hashFile(file):
+	"""Hashes a (text or binary) file in chunks and then seeks it back to the start"""
+	hasher = hashlib.sha256()
+	while True:
+		chunk = file.read(_hashChunkSize)
+		if not chunk:
+			break
+		hasher.update(chunk.encode("utf8") if isinstance(chunk, str) else chunk)
+	file.seek(0)
+	return hasher.hexdigest()
+
+def hashDirectory(directory):
+	"""Hashes names, sizes and modification times of the files in directory"""
+	hasher = hashlib.sha256()
+	for name in sorted(os.listdir(directory)):
+		stat = os.stat(os.path.join(directory, name))
+		hasher.update(f"{name}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode("utf8"))
+	return hasher.hexdigest()
+
+def jobKey(inputHash, options):
+	"""
+	Returns the cache key of a job, i.e. a hash of the input hash (from hashData or hashFile)
+	and of every option (a json serializable dict) affecting the output
+	"""
+	return hashData(json.dumps([_codeVersion(), inputHash, options], sort_keys=True))
+
+
+class JobCache:
+	"""
+	On-disk cache of binary data (and optionally of the normalized gcode) indexed by job key.
+	Once the total size exceeds maxSize the least recently used entries are removed.
+	"""
+
+	def __init__(self, directory=defaultDirectory, maxSize=defaultMaxSize, log=_log_nothing):
+		self.directory = directory
+		self.maxSize = maxSize
+		self.log = log
+		os.makedirs(directory, exist_ok=True)
+
+	def _path(self, key, extension):
+		return os.path.join(self.directory, key + extension)
+
+	def _write(self, path, data):
+		# write to a temporary file first, so that readers never see partial entries
+		temporaryPath = f"{path}.{os.getpid()}.tmp"
+		with open(temporaryPath, "wb") as file:
+			file.write(data)
+		os.replace(temporaryPath, path)
+
+	def get(self, key, withGcode=False):
+		"""Returns (binaryData, gcode) or None if missing; gcode is None if not requested"""
+		try:
+			binaryPath = self._path(key, binaryExtension)
+			with open(binaryPath, "rb") as file:
+				binaryData = file.read()
+
+			gcode = None
+			if withGcode:
+				gcodePath = self._path(key, gcodeExtension)
+				with open(gcodePath, "rb") as file:
+					gcode = file.read().decode("utf8")
+				os.utime(gcodePath)
+		except FileNotFoundError:
+			return None
+
+		# the modification time is used to track the last use
+		os.utime(binaryPath)
+		self.log(f"[info] Job cache hit: {key}")
+		return binaryData, gcode
+
+	def put(self, key, binaryData, gcode=None):
+		self._write(self._path(key, binaryExtension), binaryData)
+		if gcode is not None:
+			self._write(self._path(key, gcodeExtension), gcode.encode("utf8"))
+		self.log(f"[info] Job cache store: {key}")
+		self.evict()
+
+	def _entries(self):
+		entries = []
+		for name in os.listdir(self.directory):
+			if name.endswith(binaryExtension) or name.endswith(gcodeExtension):
+				path = os.path.join(self.directory, name)
+				try:
+					stat = os.stat(path)
+				except FileNotFoundError:
+					continue # removed concurrently
+				entries.append((stat.st_mtime_ns, stat.st_size, path))
+		return entries
+
+	def size(self):
+		return sum(size for _, size, _ in self._entries())
+
+	def evict(self):
+		"""Removes the least recently used files until the cache fits in maxSize"""
+		entries = sorted(self._entries())
+		totalSize = sum(size for _, size, _ in entries)
+		for _, size, path in entries:
+			if totalSize <= self.maxSize:
+				break
+			try:
+				os.remove(path)
+			except FileNotFoundError:
+				pass
+			totalSize -= size
+			self.log(f"[info] Job cache evict: {os.path.basename(path)}")
+
+	def clear(self):
+		for _, _, path in self._entries():
+			try:
+				os.remove(path)
+			except FileNotFoundError:
+				pass
+		self.log(f"[info] Job cache cleared: {self.directory}")
+
+
+def parseArgs(namespace):
+	argParser = argparse.ArgumentParser(fromfile_prefix_chars="@",
+		description="Inspect or clear the cache of jobs prepared by print.py")
+	argParser.add_argument("--cache-dir", type=str, default=defaultDirectory, metavar="DIR",
+		help=f"Directory of the job cache (default: {defaultDirectory})")
+	argParser.add_argument("--clear", action="store_true",
+		help="Remove all of the cached jobs")
+	argParser.parse_args(namespace=namespace)
+
+def main():
+	class Args: pass
+	parseArgs(Args)
+
+	cache = JobCache(Args.cache_dir)
+	if Args.clear:
+		cache.clear()
+	entries = cache._entries()
+	print(f"{Args.cache_dir}: {len(entries)} files, {sum(size for _, size, _ in entries)} bytes")
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,164 @@
+#!/usr/bin/python3
+#pylint: disable=no-member
+
+import argparse
+import os
+import json
+import gcode_parser
+import job_cache
+
+defaultPath = os.path.join(job_cache.defaultDirectory, "journal.json")
+# the journal is padded to this size, so that it can be overwritten in place without truncating it
+paddedSize = 512 # bytes
+
+
+def _log_nothing(*args, **kwargs):
+	pass
+
+
+class JobJournal:
+	"""
+	Keeps track on disk of how far the job being sent got, so that it can be resumed after an
+	interruption. The checkpoint is the offset in the binary data right after the last command
+	acknowledged by the plotter, together with the absolute position (in steps from the start of
+	the job) reached by that command. The position reached by the last command sent is also
+	recorded, since that is where the plotter stops once it executes the commands it received:
+	it is saved right before sending new commands, so that it is exact even if the sender dies.
+	Saving less often would leave the plotter somewhere after the recorded position, and resuming
+	would then draw the rest of the job shifted. So the saves that happen while sending are made
+	cheap instead: the file is kept open and overwritten in place with a single write, which only
+	reaches the page cache. Such a write survives the sender being killed, and the kernel writes
+	the page to the disk (e.g. an SD card) at most once every few seconds. Call close() once
+	sending ends.
+	"""
+
+	def __init__(self, path=defaultPath, log=_log_nothing):
+		self.path = path
+		self.log = log
+		self.dataHash = None
+		self.dataSize = 0
+		self.offset = 0
+		self.position = (0, 0)
+		self.plotterPosition = (0, 0)
+		self.file = None # descriptor of the journal, opened by the first save
+
+	def begin(self, data):
+		"""Starts journaling a new job sending data from the beginning"""
+		self.dataHash = job_cache.hashData(data)
+		self.dataSize = len(data)
+		self.offset = len(gcode_parser.compactHeader) if data[:len(gcode_parser.compactHeader)] == gcode_parser.compactHeader else 0
+		self.position = (0, 0)
+		self.plotterPosition = (0, 0)
+		self.save()
+
+	def load(self, data):
+		"""
+		Loads the checkpoint of an interrupted job sending data. Returns False if there is no
+		journal, and raises ValueError if the journal belongs to a different job.
+		"""
+		try:
+			with open(self.path, "r") as file:
+				journal = json.load(file)
+		except FileNotFoundError:
+			return False
+
+		self.dataHash = job_cache.hashData(data)
+		self.dataSize = len(data)
+		if journal["data"] != self.dataHash:
+			raise ValueError(f"the job journal {self.path} belongs to a different job, it can't be resumed")
+		self.offset = journal["offset"]
+		self.position = tuple(journal["position"])
+		self.plotterPosition = tuple(journal["plotterPosition"])
+		return True
+
+	def isCompleted(self):
+		return self.offset >= self.dataSize
+
+	def acknowledge(self, offset, position):
+		"""Moves the checkpoint forward, it is saved along with the next commands sent"""
+		self.offset = offset
+		self.position = position
+
+	def send(self, plotterPosition):
+		"""Saves the journal before commands reaching plotterPosition are sent"""
+		self.plotterPosition = plotterPosition
+		self.save()
+
+	def connectionLost(self):
+		"""
+		The plotter resets when its connection is lost, dropping the commands it received but did not
+		execute yet, so it stopped around the checkpoint instead
+		"""
+		self.plotterPosition = self.position
+		self.close()
+
+	def save(self):
+		journal = json.dumps(dict(data=self.dataHash, size=self.dataSize, offset=self.offset,
+			position=self.position, plotterPosition=self.plotterPosition))
+		# json allows trailing whitespace
+		content = journal.ljust(paddedSize).encode("utf8")
+		if self.file is not None and len(content) == paddedSize:
+			# same size as the file, so nothing of the previous content is left over
+			os.pwrite(self.file, content, 0)
+			return
+
+		self._closeFile()
+		# write to a temporary file first, so that an interruption never leaves a partial journal
+		os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+		temporaryPath = f"{self.path}.{os.getpid()}.tmp"
+		with open(temporaryPath, "wb") as file:
+			file.write(content)
+		os.replace(temporaryPath, self.path)
+		if len(content) == paddedSize:
+			self.file = os.open(self.path, os.O_WRONLY)
+
+	def close(self):
+		"""Saves the journal for the last time once sending ends, and closes its file"""
+		self.save()
+		self._closeFile()
+
+	def _closeFile(self):
+		if self.file is not None:
+			os.close(self.file)
+			self.file = None
+
+	def iterResumeCommands(self, data):
+		"""
+		Yields the commands (like gcode_parser.iterBinaryCommands) needed to continue the job:
+		first a travel with the pen up from where the plotter stopped to the checkpoint, with
+		offset None since it is not part of data, then the commands after the checkpoint
+		"""
+		travelX = self.position[0] - self.plotterPosition[0]
+		travelY = self.position[1] - self.plotterPosition[1]
+		for mode, x, y in gcode_parser._splitMove(gcode_parser.moveByte, travelX, travelY):
+			yield mode, x, y, None, gcode_parser.binaryRecord.size
+		yield from gcode_parser.iterBinaryCommands(data, self.offset)
+
+
+def parseArgs(namespace):
+	argParser = argparse.ArgumentParser(fromfile_prefix_chars="@",
+		description="Show the checkpoint of the last job sent to the plotter")
+	argParser.add_argument("--journal", type=str, default=defaultPath, metavar="FILE",
+		help=f"Job journal to show (default: {defaultPath})")
+	argParser.parse_args(namespace=namespace)
+
+def main():
+	class Args: pass
+	parseArgs(Args)
+
+	try:
+		with open(Args.journal, "r") as file:
+			journal = json.load(file)
+	except FileNotFoundError:
+		print(f"{Args.journal}: no job journal")
+		return
+
+	if journal["offset"] >= journal["size"]:
+		print(f"{Args.journal}: the job was completed ({journal['size']} bytes)")
+	else:
+		print(f"{Args.journal}: the job can be resumed from byte {journal['offset']} of {journal['size']}"
+			f" at x={journal['position'][0]} y={journal['position'][1]}")
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,122 @@
+#pylint: disable=no-member
+
+import time
+import json
+import queue
+import atexit
+import threading
+
+# from the most to the least important, every level includes the ones before it
+levelNames = ["error", "warning", "info", "comment", "trace"]
+levels = {name: index for index, name in enumerate(levelNames)}
+defaultLevel = "info"
+formats = ["text", "json"]
+bufferSize = 64 * 1024 # characters kept in memory before writing them
+flushInterval = 1.0 # seconds after which buffered messages are written anyway
+
+
+def isEnabled(log, level):
+	"""
+	Whether messages at level passed to the log function would be written anywhere, so that callers
+	can skip formatting them. Functions other than Logger objects are assumed to write everything.
+	"""
+	isEnabled = getattr(log, "isEnabled", None)
+	return True if isEnabled is None else isEnabled(level)
+
+
+class Logger:
+	"""
+	Log function (to be passed as log= to the other modules) writing the messages up to maxLevel
+	to file, either as plain text lines or as json lines with time, level and message. Calls take
+	the same arguments as print(), plus level (default "info") and, for json, any extra field.
+	Instead of flushing every message, messages are buffered and written at most every
+	flushInterval (errors are written immediately), or if background is True they
+	are written by a separate thread. Without a file nothing is logged.
+	"""
+
+	def __init__(self, file, maxLevel=defaultLevel, format="text", background=False):
+		self.file = file
+		self.maxLevel = levels[maxLevel] if file is not None else -1
+		self.json = format == "json"
+		self.buffer = []
+		self.bufferedSize = 0
+		self.lastWrite = time.monotonic()
+		self.lock = threading.Lock()
+
+		self.queue = None
+		if file is not None:
+			if background:
+				self.queue = queue.SimpleQueue()
+				self.thread = threading.Thread(target=self._writeLoop, daemon=True)
+				self.thread.start()
+			atexit.register(self.close)
+
+	def isEnabled(self, level):
+		return levels[level] <= self.maxLevel
+
+	def __call__(self, *args, level=defaultLevel, sep=" ", end="\n", flush=False, **fields):
+		levelIndex = levels[level]
+		if levelIndex > self.maxLevel:
+			return
+
+		# most messages are a single string
+		message = args[0] if len(args) == 1 and type(args[0]) is str else sep.join(map(str, args))
+		if self.json:
+			line = json.dumps(dict(time=time.time(), level=level, message=message, **fields)) + "\n"
+		else:
+			line = message + end
+
+		if self.queue is not None:
+			self.queue.put(line)
+			return
+		with self.lock:
+			self.buffer.append(line)
+			self.bufferedSize += len(line)
+			if (flush or levelIndex == 0 or self.bufferedSize >= bufferSize
+					or time.monotonic() - self.lastWrite >= flushInterval):
+				self._writeBuffer()
+
+	def _writeBuffer(self):
+		if self.buffer:
+			text = "".join(self.buffer)
+			self.buffer.clear()
+			self.bufferedSize = 0
+			self.file.write(text)
+			self.file.flush()
+		self.lastWrite = time.monotonic()
+
+	def _writeLoop(self):
+		closing = False
+		while not closing:
+			lines = [self.queue.get()]
+			# write everything that accumulated in the meantime at once
+			while not self.queue.empty() and len(lines) < 1024:
+				lines.append(self.queue.get())
+			if None in lines:
+				closing = True
+				lines = [line for line in lines if line is not None]
+			self.file.write("".join(lines))
+			self.file.flush()
+
+	def flush(self):
+		if self.file is None:
+			return
+		if self.queue is not None:
+			return # the thread writes everything as soon as possible
+		with self.lock:
+			self._writeBuffer()
+
+	def close(self):
+		"""Writes all pending messages; the file is not closed, since it belongs to the caller"""
+		if self.file is None:
+			return
+		if self.queue is not None:
+			if self.thread.is_alive():
+				self.queue.put(None)
+				self.thread.join()
+		else:
+			self.flush()
+
+# shared disabled instance, used in place of a real logger
+noLog = Logger(None)
+
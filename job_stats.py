@@ -0,0 +1,133 @@
+#pylint: disable=no-member
+
+import time
+import json
+import math
+import contextlib
+
+# upper bounds (in milliseconds) of the buckets of latency histograms, the last one is unbounded
+histogramBuckets = [0.25, 0.5, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, math.inf]
+
+
+class Histogram:
+	def __init__(self):
+		self.counts = [0] * len(histogramBuckets)
+		self.count = 0
+		self.total = 0.0
+		self.min = math.inf
+		self.max = 0.0
+
+	def add(self, milliseconds):
+		for i, bound in enumerate(histogramBuckets):
+			if milliseconds <= bound:
+				self.counts[i] += 1
+				break
+		self.count += 1
+		self.total += milliseconds
+		self.min = min(self.min, milliseconds)
+		self.max = max(self.max, milliseconds)
+
+	def percentile(self, fraction):
+		"""Upper bound of the bucket containing the requested percentile"""
+		target = fraction * self.count
+		seen = 0
+		for bound, count in zip(histogramBuckets, self.counts):
+			seen += count
+			if seen >= target:
+				return min(bound, self.max)
+		return self.max
+
+	def toDict(self):
+		return dict(count=self.count, mean=self.total / self.count if self.count else None,
+			min=self.min if self.count else None, max=self.max if self.count else None,
+			p50=self.percentile(0.5), p90=self.percentile(0.9), p99=self.percentile(0.99),
+			buckets={str(bound): count for bound, count in zip(histogramBuckets, self.counts)})
+
+
+class Stats:
+	"""
+	Wall time of stages, counters and latency histograms collected while preparing and sending a
+	job. When not enabled every method does nothing, so instrumented code can always call them;
+	per-command measurements should still check enabled first, to skip taking the time at all.
+	"""
+
+	def __init__(self, enabled=True):
+		self.enabled = enabled
+		self.stages = {}
+		self.counters = {}
+		self.histograms = {}
+
+	@contextlib.contextmanager
+	def _measureStage(self, name):
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+
+	def stage(self, name):
+		"""Context manager adding the wall time spent inside it to stage name"""
+		return self._measureStage(name) if self.enabled else contextlib.nullcontext()
+
+	def count(self, name, amount=1):
+		if self.enabled:
+			self.counters[name] = self.counters.get(name, 0) + amount
+
+	def addLatency(self, name, seconds):
+		if self.enabled:
+			if name not in self.histograms:
+				self.histograms[name] = Histogram()
+			self.histograms[name].add(seconds * 1000)
+
+	def merge(self, other):
+		"""Adds the stages, counters and histograms of other (as returned by toDict) to these ones"""
+		if not self.enabled:
+			return
+		for name, seconds in other["stages"].items():
+			self.stages[name] = self.stages.get(name, 0.0) + seconds
+		for name, value in other["counters"].items():
+			self.count(name, value)
+		for name, histogramDict in other["histograms"].items():
+			if histogramDict["count"] == 0:
+				continue
+			histogram = self.histograms.setdefault(name, Histogram())
+			histogram.counts = [count + added for count, added in zip(histogram.counts, histogramDict["buckets"].values())]
+			histogram.count += histogramDict["count"]
+			histogram.total += histogramDict["mean"] * histogramDict["count"]
+			histogram.min = min(histogram.min, histogramDict["min"])
+			histogram.max = max(histogram.max, histogramDict["max"])
+
+	def toDict(self):
+		return dict(stages=self.stages, counters=self.counters,
+			histograms={name: histogram.toDict() for name, histogram in self.histograms.items()})
+
+	def toJson(self):
+		return json.dumps(self.toDict(), indent=1)
+
+	def summary(self):
+		lines = ["Stages:"]
+		totalSeconds = sum(self.stages.values())
+		for name, seconds in self.stages.items():
+			lines.append(f"  {name:<20} {seconds:>10.3f}s {seconds / totalSeconds * 100 if totalSeconds else 0.0:>6.1f}%")
+
+		lines.append("Counters:")
+		for name, value in self.counters.items():
+			lines.append(f"  {name:<20} {value:>10}")
+
+		for name, histogram in self.histograms.items():
+			if histogram.count == 0:
+				continue
+			lines.append(f"Latency of {name} (ms): mean={histogram.total / histogram.count:.3f} min={histogram.min:.3f} "
+				+ f"p50<={histogram.percentile(0.5):.3f} p90<={histogram.percentile(0.9):.3f} "
+				+ f"p99<={histogram.percentile(0.99):.3f} max={histogram.max:.3f}")
+			for bound, count in zip(histogramBuckets, histogram.counts):
+				if count > 0:
+					lines.append(f"  <= {bound:>6} {count:>10}")
+		return "\n".join(lines)
+
+	def write(self, file, format):
+		"""Writes the statistics to file as "summary" (human readable) or "json" """
+		print(self.toJson() if format == "json" else self.summary(), file=file, flush=True)
+
+# shared disabled instance, used as default argument
+noStats = Stats(enabled=False)
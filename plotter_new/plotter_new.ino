@@ -2,7 +2,26 @@
 #include <Servo.h>
 #include <LiquidCrystal.h>
 
+// Every command is followed by a reply line. Supported commands (protocol version 3):
+// - 'w'/'m' (write/move) followed by x and y deltas as big endian int16 (5 bytes)
+// - 'W'/'M' (write/move) followed by x and y deltas as int8 (3 bytes)
+// - a single byte 1pxxxyyy, where p is 1 to write, and xxx and yyy are x and y
+//   deltas as 3-bit two's complement numbers, from -4 to 3 (1 byte)
+// - 'a' to lift the pen at the end, replying "Completed!"
+// - 'v' to query the protocol version, replying "Protocol 3 window N"
+// Hosts assume protocol version 1 (only 'w', 'm' and 'a') if 'v' gets no reply.
+// Since version 3 hosts may send commands without waiting for the reply to the previous
+// ones, as long as the commands not yet replied to take at most N bytes (the size of the
+// receive buffer). Version 2 plotters reply "Protocol 2" and need to wait for every reply.
 constexpr unsigned char MOVE = 'm', WRITE = 'w', END = 'a';
+constexpr unsigned char MOVE_SHORT = 'M', WRITE_SHORT = 'W', PROTOCOL_QUERY = 'v';
+constexpr unsigned char TINY_RECORD_FLAG = 0x80, TINY_WRITE_FLAG = 0x40;
+constexpr int PROTOCOL_VERSION = 3;
+#ifndef SERIAL_RX_BUFFER_SIZE
+#define SERIAL_RX_BUFFER_SIZE 64
+#endif
+// the receive ring buffer always keeps one slot empty
+constexpr int PROTOCOL_WINDOW = SERIAL_RX_BUFFER_SIZE - 1;
 constexpr int STEPS = 200, SPEED = 50;
 constexpr int PEN_WRITING_DEG = 10, PEN_MOVING_DEG = 50, PEN_UP_DEG = 130;
 constexpr int PEN_DELAY_MS = 100;
@@ -24,6 +43,11 @@ int16_t sign(int16_t n) {
     return n >= 0 ? 1 : -1;
 }
 
+int16_t tinyDelta(unsigned char bits) {
+    bits &= 0b111;
+    return (bits & 0b100) ? bits - 8 : bits;
+}
+
 void setup() {
     Serial.begin(9600);
     Serial.println("Setup");
@@ -155,17 +179,34 @@ void setup() {
     bool penIsWriting = false;
     setPenDegrees(PEN_UP_DEG);
     while (1) {
-        char mode = readByte();
+        unsigned char mode = readByte();
+        bool isMovement = true, newPenIsWriting;
+        int16_t x, y;
         if (mode == WRITE || mode == MOVE) {
             unsigned char a, b, c, d;
             a = readByte();
             b = readByte();
             c = readByte();
             d = readByte();
-            int16_t x = (a << 8) | b;
-            int16_t y = (c << 8) | d;
+            x = (a << 8) | b;
+            y = (c << 8) | d;
+            newPenIsWriting = (mode == WRITE);
+
+        } else if (mode == WRITE_SHORT || mode == MOVE_SHORT) {
+            x = static_cast<int8_t>(readByte());
+            y = static_cast<int8_t>(readByte());
+            newPenIsWriting = (mode == WRITE_SHORT);
+
+        } else if (mode & TINY_RECORD_FLAG) {
+            x = tinyDelta(mode >> 3);
+            y = tinyDelta(mode);
+            newPenIsWriting = (mode & TINY_WRITE_FLAG);
+
+        } else {
+            isMovement = false;
+        }
 
-            bool newPenIsWriting = (mode == WRITE);
+        if (isMovement) {
             if (newPenIsWriting != penIsWriting) {
                 // the pen mode changed, move it accordingly
                 penIsWriting = newPenIsWriting;
@@ -185,6 +226,12 @@ void setup() {
             penIsWriting = false;
             setPenDegrees(PEN_UP_DEG);
             loglnMsg("Completed!");
+
+        } else if (mode == PROTOCOL_QUERY) {
+            Serial.print("Protocol ");
+            Serial.print(PROTOCOL_VERSION);
+            Serial.print(" window ");
+            Serial.println(PROTOCOL_WINDOW);
         }
         /*
         switch(readByte()) {
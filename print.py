@@ -2,31 +2,106 @@
 #pylint: disable=no-member
 
 import argparse
+import sys
+import io
 from enum import Enum
-import text_to_gcode.text_to_gcode as text_to_gcode
 import gcode_parser
+import glyph_cache
 import sender
+import job_cache
+import job_stats
+import job_log
+import job_journal
+import print_daemon
 
 
-def textToGcode(text):
-	letters = text_to_gcode.readLetters(Args.gcode_directory)
-	return text_to_gcode.textToGcode(letters, text, Args.line_length, Args.line_spacing, Args.padding)
+def layoutText(text):
+	with stats.stage("load glyphs"):
+		glyphs = glyph_cache.loadGlyphs(Args.gcode_directory, None if Args.no_cache else Args.cache_dir, log=log)
+	with stats.stage("layout"):
+		return glyph_cache.layoutText(glyphs, text, Args.line_length, Args.line_spacing, Args.padding, stats=stats)
 
-def parseGcode(gcodeData):
-	if Args.auto:
-		Args.use_g, Args.feed_visible_below, Args.speed_visible_below = \
-			gcode_parser.detectParsingMode(gcodeData, log=log)
-
-	parsedGcode = gcode_parser.parseGcode(gcodeData, log=log,
+def iterStreamedGcode(gcodeFile):
+	parsedGcode = gcode_parser.streamGcode(gcodeFile, Args.xSize, Args.ySize, Args.dilation, Args.end_home,
 		useG=Args.use_g,
 		feedVisibleBelow=Args.feed_visible_below,
-		speedVisibleBelow=Args.speed_visible_below)
+		speedVisibleBelow=Args.speed_visible_below,
+		sampleLines=Args.sample_lines,
+		log=log, stats=stats)
+	if Args.simplify is not None:
+		parsedGcode = gcode_parser.iterSimplified(parsedGcode, Args.simplify)
+	return parsedGcode
 
-	parsedGcode = gcode_parser.translateToFirstQuarter(parsedGcode, log=log)
-	parsedGcode = gcode_parser.addEnd(parsedGcode, Args.end_home, log=log)
-	parsedGcode = gcode_parser.resize(parsedGcode, Args.xSize, Args.ySize, Args.dilation, log=log)
+def streamGcodeToBinary(gcodeFile):
+	parsedGcode = iterStreamedGcode(gcodeFile)
+	binaryFile = io.BytesIO()
+	gcodeFile = None if Args.output is None else io.StringIO()
+	with stats.stage("stream"):
+		gcode_parser.writeOutputs(parsedGcode, gcodeFile, binaryFile, Args.binary_format)
+	return binaryFile.getvalue(), None if gcodeFile is None else gcodeFile.getvalue()
+
+class PipelinedJob:
+	"""
+	Binary data of a gcode job parsed and encoded in a background thread while it is being sent
+	(see stream). Once the stream is completed, result() returns the same binary data and gcode
+	prepareJob would return.
+	"""
+
+	def __init__(self, gcodeData):
+		# with --stream the input file is read again instead of being kept in memory
+		gcodeFile = Args.input if gcodeData is None else io.StringIO(gcodeData)
+		self.binaryChunks = []
+		self.gcodeFile = None if Args.output is None else io.StringIO()
+		self.stream = sender.BinaryStream(self._iterChunks(gcodeFile), Args.binary_format == 2)
+
+	def _iterChunks(self, gcodeFile):
+		parsedGcode = gcode_parser.iterWithGcodeOutput(iterStreamedGcode(gcodeFile), self.gcodeFile)
+		for chunk in gcode_parser.iterBinaryChunks(parsedGcode, Args.binary_format):
+			self.binaryChunks.append(chunk)
+			yield chunk
+
+	def result(self):
+		return b"".join(self.binaryChunks), None if self.gcodeFile is None else self.gcodeFile.getvalue()
+
+def prepareJob(inputData, options):
+	"""
+	Returns the binary data and the gcode (None if not requested with --output) for the job,
+	where options are the jobOptions()
+	"""
+	if Args.subcommand == "gcode" and Args.stream:
+		return streamGcodeToBinary(Args.input)
+
+	if Args.subcommand == "text":
+		return gcode_parser.transformAndEncode(layoutText(inputData), options, Args.output is not None, log=log, stats=stats)
+	return gcode_parser.gcodeToBinary(inputData, options, Args.output is not None, Args.workers or None, log=log, stats=stats)
+
+def storeJob(cache, key, binaryData, gcode):
+	if cache is not None:
+		with stats.stage("cache store"):
+			cache.put(key, binaryData, gcode)
+
+def writeOutputs(binaryData, gcode):
+	if Args.output is not None:
+		Args.output.write(gcode)
+	if Args.binary_output is not None:
+		Args.binary_output.write(binaryData)
 
-	return parsedGcode
+def jobOptions():
+	"""
+	All of the options that affect the binary data and the gcode generated for the job, which
+	are also the options of the gcode_parser pipeline
+	"""
+	if Args.subcommand == "gcode":
+		# the same as farm.py, so that they share cached jobs
+		return dict(gcode_parser.optionsFromArgs(Args), subcommand="gcode")
+	options = dict(subcommand=Args.subcommand, xSize=Args.xSize, ySize=Args.ySize,
+		dilation=Args.dilation, end_home=Args.end_home, optimize_travel=Args.optimize_travel,
+		keep_stroke_direction=Args.keep_stroke_direction, simplify=Args.simplify,
+		binary_format=Args.binary_format)
+	if Args.subcommand == "text":
+		options.update(line_length=Args.line_length, line_spacing=Args.line_spacing, padding=Args.padding,
+			glyphs=job_cache.hashDirectory(Args.gcode_directory))
+	return options
 
 
 def parseArgs(namespace):
@@ -42,6 +117,14 @@ def parseArgs(namespace):
 		help="File in which to save the binary data ready to be fed to the plotter")
 	ioGroup.add_argument("-l", "--log", type=argparse.FileType('w'), required=False, metavar="FILE",
 		help="File in which to save logs, comments and warnings")
+	ioGroup.add_argument("--log-level", type=str, choices=job_log.levelNames, default=job_log.defaultLevel, metavar="LEVEL",
+		help=f"Log only messages at least as important as LEVEL, one of {', '.join(job_log.levelNames)}: \"comment\" adds gcode comments, \"trace\" every command sent and reply received (default: {job_log.defaultLevel})")
+	ioGroup.add_argument("--log-format", type=str, choices=job_log.formats, default="text", metavar="FORMAT",
+		help="Write logs as plain \"text\" (default) or as \"json\" lines with time, level and message")
+	ioGroup.add_argument("--binary-format", type=int, choices=[1, 2], default=1, metavar="VERSION",
+		help="Format of the binary data: 1 is understood by all plotters, 2 is more compact (default: 1, ignored if using binary subcommand)")
+	ioGroup.add_argument("--stats", type=str, choices=["summary", "json"], metavar="FORMAT",
+		help="Print the time spent in every stage and other statistics to stderr, either as a human readable \"summary\" or as \"json\"")
 
 	genGroup = argParser.add_argument_group("Gcode generation options")
 	genGroup.add_argument("--end-home", action="store_true",
@@ -50,6 +133,22 @@ def parseArgs(namespace):
 		help="The size of the print area in millimeters (e.g. 192.7x210.3)")
 	genGroup.add_argument("-d", "--dilation", type=float, default=1.0, metavar="FACTOR",
 		help="Dilation factor to apply (useful to convert mm to steps)")
+	genGroup.add_argument("--optimize-travel", action="store_true",
+		help="Reorder the strokes to reduce the distance travelled with the pen up (not available with --stream)")
+	genGroup.add_argument("--keep-stroke-direction", action="store_true",
+		help="When optimizing travel, do not draw strokes backwards")
+	genGroup.add_argument("--simplify", type=float, metavar="STEPS",
+		help="Remove points that are less than STEPS steps away from the simplified path (after dilation)")
+
+	cacheGroup = argParser.add_argument_group("Job cache options")
+	cacheGroup.add_argument("--cache-dir", type=str, default=job_cache.defaultDirectory, metavar="DIR",
+		help=f"Directory in which to cache prepared jobs and parsed text glyphs, so that printing them again is faster (default: {job_cache.defaultDirectory})")
+	cacheGroup.add_argument("--cache-size", type=float, default=job_cache.defaultMaxSize / 1024 / 1024, metavar="MB",
+		help="Maximum size of the job cache, least recently used jobs are removed when it is exceeded (default: %(default)s)")
+	cacheGroup.add_argument("--no-cache", action="store_true",
+		help="Neither read nor write the job cache and the glyph cache")
+	cacheGroup.add_argument("--clear-cache", action="store_true",
+		help="Remove all cached jobs before preparing this one")
 
 	connGroup = argParser.add_argument_group("Plotter connectivity options")
 	connGroup.add_argument("--simulate", action="store_true",
@@ -58,6 +157,18 @@ def parseArgs(namespace):
 		help="The serial port the plotter is connected to (required unless there is --simulate)")
 	connGroup.add_argument("--baud", "--baud-rate", type=int, metavar="RATE", dest="baud_rate",
 		help="The baud rate to use for the connection with the plotter. It has to be equal to the plotter baud rate. (required unless there is --simulate)")
+	connGroup.add_argument("--daemon", type=str, nargs="?", const=print_daemon.defaultSocketPath, metavar="SOCKET",
+		help=f"Send the job to a running print_daemon.py listening on SOCKET (default: {print_daemon.defaultSocketPath}), which is already connected to the plotter; --port then chooses one of the plotters of the daemon, otherwise the first available one prints the job")
+	connGroup.add_argument("--stop-and-wait", action="store_true",
+		help=f"Wait for the reply to every command before sending the next one, even if the plotter could receive more commands in advance. Without it the protocol of the plotter is queried, and plotters with an older firmware take {sender.protocolQueryTimeout:g}s to time out before sending starts, even for version 1 binary data")
+
+	resumeGroup = argParser.add_argument_group("Resume options")
+	resumeGroup.add_argument("--journal", type=str, default=job_journal.defaultPath, metavar="FILE",
+		help=f"File in which to save the progress of the job, so that it can be resumed if interrupted (default: {job_journal.defaultPath})")
+	resumeGroup.add_argument("--no-journal", action="store_true",
+		help="Do not save the progress of the job")
+	resumeGroup.add_argument("--resume", action="store_true",
+		help="Continue the job saved in the journal from where it was interrupted: the pen is moved up to the last checkpoint and only the remaining commands are sent. The job has to be prepared with the same input and options.")
 
 
 	binParser = subparsers.add_parser("binary", help="Send binary files directly to the plotter")
@@ -78,6 +189,14 @@ def parseArgs(namespace):
 		help="Consider `F` (feed) commands with a value above the provided as pen down, otherwise as pen up")
 	gpParseGroup.add_argument("--speed-visible-below", type=float, metavar="VALUE",
 		help="Consider `S` (speed) commands with a value above the provided as pen down, otherwise as pen up")
+	gpParseGroup.add_argument("--detection-sample", type=int, metavar="LINES", dest="sample_lines",
+		help="Detect the parsing mode looking only at the first LINES lines, instead of at the whole input")
+	gpParseGroup.add_argument("-j", "--jobs", type=int, default=1, metavar="WORKERS", dest="workers",
+		help="Parse the gcode using WORKERS processes, 0 means one per CPU core (default: 1, not available with --stream)")
+	gpParseGroup.add_argument("--stream", action="store_true",
+		help="Read the input twice instead of keeping it in memory (requires a seekable input)")
+	gpParseGroup.add_argument("--pipeline", action="store_true",
+		help="Start sending as soon as the bounds of the gcode are known, while the rest is parsed and encoded in the background (not available with --optimize-travel, --jobs, --resume and --daemon, and without the journal)")
 
 
 	textParser = subparsers.add_parser("text", help="Print text with the plotter")
@@ -105,60 +224,121 @@ def parseArgs(namespace):
 	except:
 		argParser.error(f"invalid formatting for --size: {namespace.size}")
 
-	if not namespace.simulate:
+	if namespace.daemon is not None:
+		if namespace.simulate:
+			argParser.error("--simulate can't be used with --daemon")
+		if namespace.resume:
+			argParser.error("--resume can't be used with --daemon")
+	elif not namespace.simulate:
 		if namespace.serial_port is None:
 			argParser.error(f"--serial-port is required unless there is --simulate")
 		if namespace.baud_rate is None:
 			argParser.error(f"--baud-rate is required unless there is --simulate")
+	if namespace.resume and namespace.no_journal:
+		argParser.error("--resume needs the journal and can't be used with --no-journal")
 
 	# check that a subcommand was selected (required=True is buggy)
 	if namespace.subcommand is None:
 		argParser.error(f"exactly one subcommand from the following is required: binary, gcode, text")
 
 	if Args.subcommand == "gcode":
-		namespace.auto = (namespace.use_g == False and
-			namespace.feed_visible_below is None and
-			namespace.speed_visible_below is None)
+		if namespace.stream and not namespace.input.seekable():
+			argParser.error("--stream requires a seekable input file")
+		if namespace.stream and namespace.optimize_travel:
+			argParser.error("--optimize-travel needs the whole gcode in memory and can't be used with --stream")
+		if namespace.stream and namespace.workers != 1:
+			argParser.error("--jobs needs the whole gcode in memory and can't be used with --stream")
+		if namespace.workers < 0:
+			argParser.error("--jobs can't be negative")
+		if namespace.sample_lines is not None and namespace.sample_lines < 1:
+			argParser.error("--detection-sample must be at least 1")
+		if namespace.pipeline and namespace.optimize_travel:
+			argParser.error("--optimize-travel needs the whole gcode in memory and can't be used with --pipeline")
+		if namespace.pipeline and namespace.workers != 1:
+			argParser.error("--jobs can't be used with --pipeline, which parses the gcode in the background")
+		if namespace.pipeline and namespace.resume:
+			argParser.error("--resume needs the whole binary data in advance and can't be used with --pipeline")
+		if namespace.pipeline and namespace.daemon is not None:
+			argParser.error("--daemon needs the whole binary data in advance and can't be used with --pipeline")
 
 class Args:
 	pass
 
-def log(*args, **kwargs):
-	if Args.log is not None:
-		kwargs["flush"] = True
-		print(*args, **kwargs, file=Args.log)
+# replaced in main() if --stats is used
+stats = job_stats.noStats
+
+# replaced in main() if --log is used
+log = job_log.noLog
 
 def main():
+	global stats, log
 	parseArgs(Args)
-
-	binaryData = b""
+	if Args.log is not None:
+		log = job_log.Logger(Args.log, Args.log_level, Args.log_format, background=True)
+	if Args.stats is not None:
+		stats = job_stats.Stats()
+
+	cache = None
+	if not Args.no_cache:
+		cache = job_cache.JobCache(Args.cache_dir, int(Args.cache_size * 1024 * 1024), log=log)
+		if Args.clear_cache:
+			cache.clear()
+
+	binaryData, gcode = b"", None
+	pipeline = None
 	if Args.subcommand == "binary":
-		binaryData = Args.input.read()
+		binaryData = sender.mapInput(Args.input)
 	else:
-		gcodeData = ""
-		if Args.subcommand == "gcode":
-			gcodeData = Args.input.read()
-		elif Args.subcommand == "text":
-			gcodeData = textToGcode(Args.input.read())
-
-			# settings for gcode parser
-			Args.auto = False
-			Args.use_g = True
-			Args.feed_visible_below = None
-			Args.speed_visible_below = None
+		with stats.stage("read"):
+			if Args.subcommand == "gcode" and Args.stream:
+				inputData = None
+				inputHash = job_cache.hashFile(Args.input)
+			else:
+				inputData = Args.input.read()
+				inputHash = job_cache.hashData(inputData)
+
+		options = jobOptions()
+		cached, key = None, None
+		if cache is not None:
+			with stats.stage("cache lookup"):
+				key = job_cache.jobKey(inputHash, options)
+				cached = cache.get(key, withGcode=Args.output is not None)
+			stats.count("cache hits" if cached is not None else "cache misses")
+
+		if cached is not None:
+			binaryData, gcode = cached
+		elif Args.subcommand == "gcode" and Args.pipeline:
+			pipeline = PipelinedJob(inputData)
 		else:
-			raise AssertionError()
-
-		parsedGcode = parseGcode(gcodeData)
-		binaryData = gcode_parser.toBinaryData(parsedGcode)
-		if Args.output is not None:
-			Args.output.write(gcode_parser.toGcode(parsedGcode))
-
-	if Args.binary_output is not None:
-		Args.binary_output.write(binaryData)
-
+			binaryData, gcode = prepareJob(inputData, options)
+			storeJob(cache, key, binaryData, gcode)
+
+	if pipeline is None:
+		writeOutputs(binaryData, gcode)
+		stats.count("binary bytes", len(binaryData))
+
+	if Args.daemon is not None:
+		print_daemon.sendJob(binaryData, Args.daemon, Args.serial_port, windowed=not Args.stop_and_wait, log=log, stats=stats)
+	elif pipeline is not None:
+		# the journal needs the whole binary data in advance
+		sender.sendData(pipeline.stream, Args.serial_port, Args.baud_rate, Args.simulate, log=log, stats=stats, windowed=not Args.stop_and_wait)
+	else:
+		# simulating does not move the plotter, so it must not touch the journal
+		journal = None if Args.no_journal or Args.simulate else job_journal.JobJournal(Args.journal, log=log)
+		sender.sendData(binaryData, Args.serial_port, Args.baud_rate, Args.simulate, log=log, stats=stats, windowed=not Args.stop_and_wait,
+			journal=journal, resume=Args.resume)
+
+	if pipeline is not None:
+		if pipeline.stream.completed:
+			binaryData, gcode = pipeline.result()
+			storeJob(cache, key, binaryData, gcode)
+			writeOutputs(binaryData, gcode)
+			stats.count("binary bytes", len(binaryData))
+		else:
+			log("[info] The job was interrupted before being fully prepared, so it was neither cached nor written to the outputs")
 
-	sender.sendData(binaryData, Args.serial_port, Args.baud_rate, Args.simulate, log=log)
+	if Args.stats is not None:
+		stats.write(sys.stderr, Args.stats)
 
 
 if __name__ == "__main__":
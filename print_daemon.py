@@ -0,0 +1,404 @@
+#!/usr/bin/python3
+#pylint: disable=no-member
+
+import argparse
+import os
+import sys
+import json
+import queue
+import socket
+import threading
+import collections
+import serial
+import sender
+import gcode_parser
+import job_stats
+import job_log
+
+defaultSocketPath = os.path.join(os.path.expanduser("~"), ".cache", "plotter", "daemon.sock")
+
+
+def _log_nothing(*args, **kwargs):
+	pass
+
+class JobFailed(Exception):
+	pass
+
+
+class Job:
+	"""A job received from a client, with the events to be sent back to it"""
+
+	def __init__(self, data, port, windowed, logLevels):
+		self.data = data
+		self.port = port # None if any plotter can print it
+		self.windowed = windowed
+		self.logLevels = logLevels # levels of the log messages the client wants
+		self.events = queue.SimpleQueue() # dicts for the client, followed by None
+		self.cancel = threading.Event()
+
+
+class _Plotter:
+	def __init__(self, port):
+		self.port = port
+		self.connection = None # sender.Connection, kept open between jobs
+		self.job = None # the job being printed
+		self.jobsPrinted = 0
+		self.jobsCancelled = 0
+
+	def toDict(self):
+		return dict(port=self.port, connected=self.connection is not None, busy=self.job is not None,
+			jobsPrinted=self.jobsPrinted, jobsCancelled=self.jobsCancelled)
+
+
+class PrintDaemon:
+	"""
+	Local service owning the serial connections to one or more plotters and printing the jobs
+	sent by clients (see sendJob) over a Unix socket, in the order they arrive, each on the first
+	available plotter. Connections are opened once and kept open, so that jobs do not wait for
+	the plotter to reset. Progress and log messages are streamed back to the client, and a job
+	is cancelled if its client disconnects.
+	"""
+
+	def __init__(self, socketPath, ports, baudRate, log=_log_nothing):
+		self.socketPath = socketPath
+		self.plotters = [_Plotter(port) for port in ports]
+		self.baudRate = baudRate
+		self.log = log
+
+		self.condition = threading.Condition()
+		self.pendingJobs = collections.deque()
+		self.stopped = False
+		self.server = None
+		self.threads = []
+
+	def _plotterLog(self, plotter):
+		if self.log is _log_nothing:
+			return _log_nothing
+		def plotterLog(*args, **kwargs):
+			self.log(f"[{plotter.port}]", *args, **kwargs)
+		plotterLog.isEnabled = lambda level: job_log.isEnabled(self.log, level)
+		return plotterLog
+
+	def _jobLog(self, plotterLog, job):
+		# messages go to the daemon log and to the client, if it asked for their level
+		def jobLog(*args, level=job_log.defaultLevel, sep=" ", **kwargs):
+			plotterLog(*args, level=level, sep=sep, **kwargs)
+			if level in job.logLevels:
+				job.events.put(dict(event="log", level=level, message=sep.join(map(str, args))))
+		jobLog.isEnabled = lambda level: level in job.logLevels or job_log.isEnabled(plotterLog, level)
+		return jobLog
+
+	def _connect(self, plotter, log):
+		try:
+			plotter.connection = sender.Connection(plotter.port, self.baudRate, log=log)
+			log("[info] Connected")
+		except (serial.SerialException, OSError) as e:
+			log(f"[error] Could not connect: {e}", level="error")
+
+	def _disconnect(self, plotter):
+		if plotter.connection is not None:
+			try:
+				plotter.connection.close()
+			except (serial.SerialException, OSError):
+				pass
+			plotter.connection = None
+
+	def _takeJob(self, plotter):
+		with self.condition:
+			while not self.stopped:
+				for job in self.pendingJobs:
+					if job.port is None or job.port == plotter.port:
+						self.pendingJobs.remove(job)
+						plotter.job = job
+						return job
+				self.condition.wait()
+			return None
+
+	def _printJob(self, plotter, job, plotterLog):
+		if plotter.connection is None:
+			self._connect(plotter, plotterLog)
+			if plotter.connection is None:
+				job.events.put(dict(event="failed", message=f"could not connect to {plotter.port}"))
+				return
+
+		job.events.put(dict(event="started", port=plotter.port))
+		stats = job_stats.Stats()
+		try:
+			sender.sendData(job.data, plotter.port, self.baudRate, log=self._jobLog(plotterLog, job), stats=stats,
+				windowed=job.windowed, connection=plotter.connection, cancel=job.cancel,
+				progress=lambda sent, total: job.events.put(dict(event="progress", bytes=sent, total=total)))
+		except (serial.SerialException, OSError) as e:
+			# the next job reconnects
+			plotterLog(f"[error] Connection failed: {e}", level="error")
+			self._disconnect(plotter)
+			job.events.put(dict(event="failed", message=f"connection to {plotter.port} failed: {e}"))
+			return
+		except Exception as e:
+			# the plotter may have been left halfway through a command, so the next job reconnects
+			plotterLog(f"[error] Job failed: {e}", level="error")
+			self._disconnect(plotter)
+			job.events.put(dict(event="failed", message=f"job failed on {plotter.port}: {e}"))
+			return
+
+		if job.cancel.is_set():
+			plotter.jobsCancelled += 1
+			job.events.put(dict(event="cancelled", stats=stats.toDict()))
+		else:
+			plotter.jobsPrinted += 1
+			job.events.put(dict(event="completed", stats=stats.toDict()))
+
+	def _runPlotter(self, plotter):
+		plotterLog = self._plotterLog(plotter)
+		# connect right away, so that the first job does not wait for the plotter to reset
+		self._connect(plotter, plotterLog)
+		while True:
+			job = self._takeJob(plotter)
+			if job is None:
+				break
+			try:
+				if not job.cancel.is_set():
+					self._printJob(plotter, job, plotterLog)
+			finally:
+				plotter.job = None
+				job.events.put(None)
+		self._disconnect(plotter)
+
+	def _watchClient(self, clientSocket, job):
+		# clients never send anything after the job, so this only returns when they disconnect
+		try:
+			while clientSocket.recv(4096):
+				pass
+		except OSError:
+			pass
+		job.cancel.set()
+
+	def _writeEvent(self, file, event):
+		file.write(json.dumps(event).encode("utf8") + b"\n")
+		file.flush()
+
+	def _serveClient(self, clientSocket, file):
+		try:
+			request = json.loads(file.readline())
+			if request["command"] == "status":
+				with self.condition:
+					self._writeEvent(file, dict(event="status", queued=len(self.pendingJobs),
+						plotters=[plotter.toDict() for plotter in self.plotters]))
+				return
+
+			data = file.read(request["size"])
+			if len(data) != request["size"]:
+				return # the client disconnected
+			port = request.get("port")
+			if port is not None and port not in [plotter.port for plotter in self.plotters]:
+				self._writeEvent(file, dict(event="failed", message=f"the daemon has no plotter on {port}"))
+				return
+		except (ValueError, KeyError, TypeError) as e:
+			self._writeEvent(file, dict(event="failed", message=f"invalid request: {e}"))
+			return
+
+		try:
+			# rejected now, instead of failing once a plotter has started printing it
+			collections.deque(gcode_parser.iterBinaryCommands(data), maxlen=0)
+		except ValueError as e:
+			self._writeEvent(file, dict(event="failed", message=str(e)))
+			return
+
+		job = Job(data, port, request.get("windowed", True), request.get("log_levels", []))
+		with self.condition:
+			self.pendingJobs.append(job)
+			queued = len(self.pendingJobs) - 1 + sum(plotter.job is not None for plotter in self.plotters)
+			self.condition.notify_all()
+		self.log(f"[info] Job of {len(data)} bytes received, {queued} jobs before it")
+		threading.Thread(target=self._watchClient, args=(clientSocket, job), daemon=True).start()
+
+		try:
+			self._writeEvent(file, dict(event="queued", jobsBefore=queued))
+			while True:
+				event = job.events.get()
+				if event is None:
+					break
+				self._writeEvent(file, event)
+		except OSError:
+			job.cancel.set()
+			raise
+		finally:
+			# wakes up _watchClient
+			try:
+				clientSocket.shutdown(socket.SHUT_RDWR)
+			except OSError:
+				pass
+
+	def _handleClient(self, clientSocket):
+		try:
+			with clientSocket, clientSocket.makefile("rwb") as file:
+				self._serveClient(clientSocket, file)
+		except OSError:
+			pass # the client disconnected
+
+	def _listen(self):
+		if os.path.exists(self.socketPath):
+			probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+			try:
+				probe.connect(self.socketPath)
+				raise OSError(f"a daemon is already listening on {self.socketPath}")
+			except ConnectionRefusedError:
+				os.remove(self.socketPath) # left behind by a daemon that did not stop cleanly
+			finally:
+				probe.close()
+		os.makedirs(os.path.dirname(os.path.abspath(self.socketPath)), exist_ok=True)
+
+		self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		self.server.bind(self.socketPath)
+		self.server.listen()
+		self.log(f"[info] Listening on {self.socketPath}")
+
+	def _serveLoop(self):
+		try:
+			while True:
+				clientSocket, _ = self.server.accept()
+				threading.Thread(target=self._handleClient, args=(clientSocket,), daemon=True).start()
+		except OSError:
+			pass # closed by stop()
+
+	def start(self):
+		"""Starts serving in background threads and returns the socket path"""
+		self._listen()
+		self.threads = [threading.Thread(target=self._runPlotter, args=(plotter,), daemon=True) for plotter in self.plotters]
+		self.threads.append(threading.Thread(target=self._serveLoop, daemon=True))
+		for thread in self.threads:
+			thread.start()
+		return self.socketPath
+
+	def stop(self):
+		"""Stops accepting jobs, cancels the queued and running ones and closes the connections"""
+		with self.condition:
+			self.stopped = True
+			for job in self.pendingJobs:
+				job.cancel.set()
+				job.events.put(dict(event="failed", message="the daemon stopped"))
+				job.events.put(None)
+			self.pendingJobs.clear()
+			for plotter in self.plotters:
+				if plotter.job is not None:
+					plotter.job.cancel.set()
+			self.condition.notify_all()
+		if self.server is not None:
+			# shutdown wakes up accept(), close alone would not
+			try:
+				self.server.shutdown(socket.SHUT_RDWR)
+			except OSError:
+				pass
+			self.server.close()
+			os.remove(self.socketPath)
+		for thread in self.threads:
+			thread.join()
+
+	def serve(self):
+		"""Serves until Ctrl+C"""
+		self.start()
+		try:
+			# joining with a timeout lets Ctrl+C through
+			while self.threads[-1].is_alive():
+				self.threads[-1].join(1.0)
+		except KeyboardInterrupt:
+			self.log("[info] Stopping, waiting for the jobs being printed to end")
+		finally:
+			self.stop()
+
+
+def _request(socketPath, request, data=None):
+	client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	client.connect(socketPath)
+	client.sendall(json.dumps(request).encode("utf8") + b"\n")
+	if data is not None:
+		client.sendall(data)
+	return client
+
+def sendJob(data, socketPath=defaultSocketPath, port=None, windowed=True, log=_log_nothing, stats=job_stats.noStats):
+	"""
+	Prints binary data with a running daemon on the plotter on port (or on the first available
+	one), returning once the job is completed. The log messages of the daemon about the job are
+	passed to log, and its statistics are added to stats. Raises JobFailed if the job could not be
+	printed. Interrupting this (e.g. with Ctrl+C) disconnects from the daemon, which cancels the job.
+	"""
+	logLevels = [] if log is _log_nothing else [level for level in job_log.levelNames if job_log.isEnabled(log, level)]
+	request = dict(command="print", size=len(data), port=port, windowed=windowed, log_levels=logLevels)
+	try:
+		with stats.stage("daemon"), _request(socketPath, request, data) as client, client.makefile("rb") as file:
+			for line in file:
+				event = json.loads(line)
+				if event["event"] == "queued":
+					log(f"[info] Job sent to the daemon, {event['jobsBefore']} jobs before it")
+				elif event["event"] == "started":
+					log(f"[info] Printing on {event['port']}")
+				elif event["event"] == "progress":
+					log(f"[info] Progress: {event['bytes']}/{event['total']} bytes"
+						f" ({event['bytes'] / event['total'] * 100 if event['total'] else 100.0:.1f}%)")
+				elif event["event"] == "log":
+					log(event["message"], level=event["level"])
+				elif event["event"] in ("completed", "cancelled"):
+					stats.merge(event["stats"])
+					return
+				elif event["event"] == "failed":
+					raise JobFailed(event["message"])
+	except KeyboardInterrupt:
+		log("[info] Sending interrupted by user, the daemon cancels the job")
+		return
+	raise JobFailed("the daemon closed the connection")
+
+def queryStatus(socketPath=defaultSocketPath):
+	"""Returns the plotters of a running daemon and the number of queued jobs, as a dict"""
+	with _request(socketPath, dict(command="status")) as client, client.makefile("rb") as file:
+		return json.loads(file.readline())
+
+
+def parseArgs(namespace):
+	argParser = argparse.ArgumentParser(fromfile_prefix_chars="@",
+		description="Keep the connections to plotters open and print the jobs sent by print.py --daemon")
+	argParser.add_argument("--socket", type=str, default=defaultSocketPath, metavar="PATH",
+		help=f"Unix socket on which the daemon receives jobs (default: {defaultSocketPath})")
+
+	subparsers = argParser.add_subparsers(dest="subcommand", title="subcommands")
+
+	serveParser = subparsers.add_parser("serve", help="Run the daemon until Ctrl+C")
+	spConnGroup = serveParser.add_argument_group("Plotter connectivity options")
+	spConnGroup.add_argument("-p", "--port", "--serial-port", type=str, action="append", required=True, metavar="PORT", dest="serial_ports",
+		help="A serial port a plotter is connected to, repeat it for every plotter")
+	spConnGroup.add_argument("--baud", "--baud-rate", type=int, required=True, metavar="RATE", dest="baud_rate",
+		help="The baud rate to use for the connection with the plotters. It has to be equal to the plotters baud rate.")
+	spLogGroup = serveParser.add_argument_group("Output options")
+	spLogGroup.add_argument("-l", "--log", type=argparse.FileType('w'), required=False, metavar="FILE",
+		help="File in which to save the logs of all plotters")
+	spLogGroup.add_argument("--log-level", type=str, choices=job_log.levelNames, default=job_log.defaultLevel, metavar="LEVEL",
+		help=f"Log only messages at least as important as LEVEL, one of {', '.join(job_log.levelNames)}: \"trace\" adds every command sent and reply received (default: {job_log.defaultLevel})")
+	spLogGroup.add_argument("--log-format", type=str, choices=job_log.formats, default="text", metavar="FORMAT",
+		help="Write logs as plain \"text\" (default) or as \"json\" lines with time, level and message")
+
+	subparsers.add_parser("status", help="Print the plotters of the running daemon and the number of queued jobs as json")
+
+	argParser.parse_args(namespace=namespace)
+
+
+	# check that a subcommand was selected (required=True is buggy)
+	if namespace.subcommand is None:
+		argParser.error(f"exactly one subcommand from the following is required: serve, status")
+	if namespace.subcommand == "serve" and len(set(namespace.serial_ports)) != len(namespace.serial_ports):
+		argParser.error("every --port can be used only once")
+
+def main():
+	class Args: pass
+	parseArgs(Args)
+
+	if Args.subcommand == "status":
+		try:
+			print(json.dumps(queryStatus(Args.socket), indent=1))
+		except (FileNotFoundError, ConnectionRefusedError):
+			sys.exit(f"No daemon is listening on {Args.socket}")
+		return
+
+	log = job_log.noLog if Args.log is None else job_log.Logger(Args.log, Args.log_level, Args.log_format, background=True)
+	PrintDaemon(Args.socket, Args.serial_ports, Args.baud_rate, log=log).serve()
+
+
+if __name__ == "__main__":
+	main()
@@ -2,49 +2,363 @@
 #pylint: disable=no-member
 
 import argparse
+import sys
+import io
+import mmap
+import time
+import queue
+import signal
+import threading
+import collections
 import serial
+import gcode_parser
+import job_stats
+import job_log
+import job_journal
 
 endByte = b"a"
+protocolQueryByte = b"v"
+protocolQueryTimeout = 1.0 # seconds
 serialLogLabel = "[info from serial]"
+progressInterval = 0.5 # seconds
 
 
 def _log_nothing(*args, **kwargs):
 	pass
 
-def sendData(data, serialPort, baudRate, simulate=False, log=_log_nothing):
+def queryProtocol(ser, log=_log_nothing):
+	"""
+	Asks the plotter which protocol version it supports, returning (version, windowSize).
+	Plotters that do not support anything but version 1 ignore the query, so after a timeout
+	version 1 is assumed. windowSize is the number of bytes of commands that can be sent
+	without waiting for their replies, or None if the plotter can only handle one at a time.
+	"""
+	ser.timeout = protocolQueryTimeout
+	ser.write(protocolQueryByte)
+	readData = ser.readline()
+	ser.timeout = None
+
+	try:
+		words = readData.decode("utf8").split()
+		if words[0] == "Protocol":
+			log(serialLogLabel, readData[:-2].decode("utf8"))
+			version = int(words[1])
+			if len(words) >= 4 and words[2] == "window":
+				return version, max(int(words[3]), gcode_parser.binaryRecord.size)
+			return version, None
+	except (ValueError, IndexError):
+		pass
+	log("[info] The plotter did not answer the protocol query, assuming protocol 1")
+	return 1, None
+
+class Connection:
+	"""
+	Serial connection to a plotter that can be reused for several jobs. Opening the port resets
+	the plotter, which then takes a while to print "Setup", so keeping it open makes the following
+	jobs start immediately. The protocol version is queried at most once per connection.
+	"""
+
+	def __init__(self, serialPort, baudRate, log=_log_nothing):
+		self.serialPort = serialPort
+		self.ser = serial.Serial(serialPort, baudRate)
+		log(serialLogLabel, self.ser.readline()[:-2].decode("utf8"))
+		self.protocol = None # (version, windowSize) once queried
+
+	def queryProtocol(self, log=_log_nothing):
+		if self.protocol is None:
+			self.protocol = queryProtocol(self.ser, log=log)
+		return self.protocol
+
+	def close(self):
+		self.ser.close()
+
+class _DeferredInterrupt:
+	"""
+	Turns the first Ctrl+C into a flag to be checked between commands, so that sending never
+	stops halfway through a command or a reply. A second Ctrl+C raises KeyboardInterrupt as usual.
+	Signal handlers can only be installed in the main thread, elsewhere this does nothing.
+	"""
+
+	def __init__(self):
+		self.interrupted = False
+		self.previousHandler = None
+
+	def _handle(self, signum, frame):
+		if self.interrupted:
+			raise KeyboardInterrupt()
+		self.interrupted = True
+
+	def __enter__(self):
+		if threading.current_thread() is threading.main_thread():
+			self.previousHandler = signal.signal(signal.SIGINT, self._handle)
+		return self
+
+	def __exit__(self, *args):
+		if self.previousHandler is not None:
+			signal.signal(signal.SIGINT, self.previousHandler)
+
+def sendData(data, serialPort, baudRate, simulate=False, log=_log_nothing, stats=job_stats.noStats, windowed=True,
+		journal=None, resume=False, connection=None, cancel=None, progress=None):
+	"""
+	Sends binary data (in any format) to the plotter. If windowed and the plotter supports it,
+	commands are sent ahead without waiting for the reply to the previous one, as long as the
+	plotter has room for them in its receive buffer, so that it never waits for the next command.
+	If a job_journal.JobJournal is provided, the progress is saved there, and with resume the
+	job continues from the checkpoint of a previous interrupted run.
+	An already open Connection can be passed instead of serialPort and baudRate, and is left open.
+	Setting the threading.Event cancel stops sending like Ctrl+C does. progress, if provided, is
+	called with the bytes of data acknowledged so far and the length of data (None for a
+	BinaryStream), at most every progressInterval seconds and at the end.
+	data can also be a BinaryStream, whose chunks are sent as soon as they are produced.
+	"""
+	streaming = isinstance(data, BinaryStream)
+	if streaming:
+		if journal is not None:
+			raise ValueError("the journal needs the whole data in advance and can't be used with a BinaryStream")
+		compact = data.compact
+		totalLength = None
+	else:
+		compact = data[:len(gcode_parser.compactHeader)] == gcode_parser.compactHeader
+		totalLength = len(data)
+
+	if streaming:
+		chunks = _iterStreamChunks(data)
+	elif journal is None:
+		commands = gcode_parser.iterBinaryCommands(data)
+	elif resume and journal.load(data):
+		if journal.isCompleted():
+			log("[info] The job in the journal was already completed, nothing to resume")
+		else:
+			log(f"[info] Resuming the job from byte {journal.offset} of {len(data)}"
+				f" at x={journal.position[0]} y={journal.position[1]}")
+		commands = journal.iterResumeCommands(data)
+	else:
+		if resume:
+			log("[info] No job journal to resume from, starting from the beginning")
+		journal.begin(data)
+		commands = gcode_parser.iterBinaryCommands(data)
+	if not streaming:
+		dataView = memoryview(data)
+		chunks = [(dataView, 0, commands)]
+
 	if simulate:
 		log(serialLogLabel, "Setup")
 	else:
-		ser = serial.Serial(serialPort, baudRate)
-		log(serialLogLabel, ser.readline()[:-2].decode("utf8"))
+		with stats.stage("connect"):
+			ownConnection = connection is None
+			if ownConnection:
+				connection = Connection(serialPort, baudRate, log=log)
+			ser = connection.ser
+			# plotters only supporting protocol 1 take a timeout to answer the query,
+			# so only ask if there is something to gain
+			if compact or windowed:
+				protocolVersion, windowSize = connection.queryProtocol(log=log)
+			else:
+				protocolVersion, windowSize = 1, None
+			# without a window a command is sent only when nothing else is waiting for a reply
+			windowSize = windowSize if windowed and windowSize is not None else 0
+			if windowSize > 0:
+				log(f"[info] Sending up to {windowSize} bytes of commands ahead")
+
+	commandsSent, bytesSent = 0, 0
+	# (length, time sent, offset after the command, position reached) of the commands not yet acknowledged
+	inFlight = collections.deque()
+	inFlightBytes = 0
+	# commands not yet written to the port, written all together right before waiting for replies
+	batch = bytearray()
+	# absolute position reached by the last command sent, only tracked for the journal
+	positionX, positionY = (0, 0) if journal is None else journal.plotterPosition
+	resumeOffset = len(gcode_parser.compactHeader) if compact else 0
+	if journal is not None:
+		resumeOffset = journal.offset
+	acknowledgedOffset = 0
+	lastProgress = time.monotonic()
+	# formatting every command and reply is expensive, so skip it if they would not be written
+	logging = log is not _log_nothing and job_log.isEnabled(log, "trace")
+	# commands in data can be sent as they are, without decoding and encoding them again
+	sendAsIs = not compact or (not simulate and protocolVersion >= 2)
+
+	def writeBatch():
+		nonlocal bytesSent
+		if batch:
+			if journal is not None:
+				# the plotter executes whatever it received even if the sender dies right after
+				journal.send((positionX, positionY))
+			ser.write(batch)
+			bytesSent += len(batch)
+			batch.clear()
 
+	def receiveReply():
+		nonlocal inFlightBytes, acknowledgedOffset, lastProgress
+		writeBatch()
+		readData = ser.readline()
+		length, sentTime, offsetAfter, position = inFlight.popleft()
+		inFlightBytes -= length
+		acknowledgedOffset = offsetAfter
+		if stats.enabled:
+			stats.addLatency("acknowledgements", time.perf_counter() - sentTime)
+		if journal is not None:
+			journal.acknowledge(offsetAfter, position)
+		if progress is not None and time.monotonic() - lastProgress >= progressInterval:
+			lastProgress = time.monotonic()
+			progress(acknowledgedOffset, totalLength)
+		if logging:
+			log(serialLogLabel, readData[:-2].decode("utf8"), level="trace")
+
+	interrupt = _DeferredInterrupt()
+	connectionLost = False
 	try:
-		i = 0
-		while i < len(data):
-			mode = data[i:i+1]
-			x = int.from_bytes(data[i+1:i+3], byteorder="big", signed=True)
-			y = int.from_bytes(data[i+3:i+5], byteorder="big", signed=True)
-			log(f"[info] Sent: {repr(mode)[2:-1]:<2} x={x:>5} y={y:>5}")
+		with interrupt, stats.stage("send"):
+			# offsets of commands are relative to view, which starts at chunkOffset in data
+			for view, chunkOffset, commands in chunks:
+				for mode, x, y, offset, length in commands:
+					if interrupt.interrupted or (cancel is not None and cancel.is_set()):
+						raise KeyboardInterrupt()
+					if logging:
+						log(f"[info] Sent: {repr(mode)[2:-1]:<2} x={x:>5} y={y:>5}", level="trace")
+
+					if not simulate:
+						if sendAsIs and offset is not None:
+							command = view[offset:offset+length]
+						else:
+							command = gcode_parser.binaryRecord.pack(mode, x, y)
+
+						# every reply means that a command left the plotter buffer
+						while inFlight and inFlightBytes + len(command) > windowSize:
+							receiveReply()
 
-			if not simulate:
-				ser.write(data[i:i+5])
-				readData = ser.readline()
-				log(serialLogLabel, readData[:-2].decode("utf8"))
+						batch += command
+						if journal is not None:
+							positionX += x
+							positionY += y
+						# the travel to the checkpoint when resuming is not part of data
+						offsetAfter = resumeOffset if offset is None else chunkOffset + offset + length
+						inFlight.append((len(command), time.perf_counter() if stats.enabled else None,
+							offsetAfter, (positionX, positionY)))
+						inFlightBytes += len(command)
+					commandsSent += 1
 
-			i+=5
+			while not simulate and inFlight:
+				receiveReply()
 
 	except KeyboardInterrupt:
 		log("[info] Sending interrupted by user")
+	except (serial.SerialException, OSError):
+		connectionLost = True
+		raise
 	finally:
+		stats.count("commands sent", commandsSent)
+		if streaming:
+			data.close()
+		else:
+			dataView.release()
 		if simulate:
+			stats.count("bytes sent", bytesSent)
+			if progress is not None:
+				progress(totalLength, totalLength)
 			log("[info] Completed!")
+		elif connectionLost:
+			stats.count("bytes sent", bytesSent)
+			if journal is not None:
+				journal.connectionLost()
+				log("[warning] Connection to the plotter lost, if it stopped in the middle of a command"
+					" move the pen back to where the job started before resuming it", level="warning")
 		else:
+			try:
+				# commands already sent are executed anyway, wait for them before ending
+				while inFlight:
+					receiveReply()
+			except (serial.SerialException, OSError):
+				connectionLost = True
+				raise
+			finally:
+				stats.count("bytes sent", bytesSent)
+				if journal is not None:
+					if connectionLost:
+						journal.connectionLost()
+					else:
+						journal.close()
 			ser.write(endByte)
 			readData = ser.readline()[:-2].decode("utf8")
 			log(serialLogLabel, readData)
-			if (readData != "Completed!"):
-				log(serialLogLabel, readData)
+			while readData != "Completed!":
 				readData = ser.readline()[:-2].decode("utf8")
+				log(serialLogLabel, readData)
+			if progress is not None:
+				progress(acknowledgedOffset, totalLength)
+			if ownConnection:
+				connection.close()
+
+
+class BinaryStream:
+	"""
+	Binary data produced by a background thread while it is being sent, so that sending starts
+	before all of it is ready. chunks is an iterable of bytes (e.g. from gcode_parser.iterBinaryChunks,
+	iterated in the thread) every one ending at a record boundary, and compact tells whether
+	they are in version 2 format. At most maxChunks chunks wait in memory to be sent. Iterating
+	yields the chunks, raising again any exception raised while producing them.
+	"""
+
+	def __init__(self, chunks, compact, maxChunks=64):
+		self.compact = compact
+		self.completed = False # whether all of the chunks were produced
+		self.queue = queue.Queue(maxChunks)
+		self.closed = threading.Event()
+		self.thread = threading.Thread(target=self._produce, args=(chunks,), daemon=True)
+		self.thread.start()
+
+	def _put(self, item):
+		# gives up if the consumer went away
+		while not self.closed.is_set():
+			try:
+				self.queue.put(item, timeout=0.1)
+				return True
+			except queue.Full:
+				pass
+		return False
+
+	def _produce(self, chunks):
+		try:
+			for chunk in chunks:
+				if not self._put(chunk):
+					return
+			self.completed = True
+			self._put(None)
+		except Exception as e:
+			self._put(e)
+
+	def __iter__(self):
+		while True:
+			item = self.queue.get()
+			if item is None:
+				return
+			if isinstance(item, Exception):
+				raise item
+			yield item
+
+	def close(self):
+		"""Stops the thread, even if not all of the chunks were produced"""
+		self.closed.set()
+		self.thread.join()
+
+def _iterStreamChunks(stream):
+	# (view, offset of the chunk in the data, commands of the chunk) like sendData uses them
+	chunkOffset = 0
+	for chunk in stream:
+		start = len(gcode_parser.compactHeader) if chunkOffset == 0 and stream.compact else 0
+		yield memoryview(chunk), chunkOffset, gcode_parser.iterBinaryCommands(chunk, start)
+		chunkOffset += len(chunk)
+
+
+def mapInput(file):
+	"""
+	Memory-maps a binary file, so that even huge inputs are paged in lazily while sending and
+	do not need to fit in memory. Inputs that can't be mapped (e.g. pipes or empty files) are read.
+	"""
+	try:
+		return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+	except (OSError, ValueError, io.UnsupportedOperation):
+		return file.read()
 
 
 def parseArgs(namespace):
@@ -56,6 +370,12 @@ def parseArgs(namespace):
 		help="Binary file from which to read the raw data to send to the plotter")
 	ioGroup.add_argument("-l", "--log", type=argparse.FileType('w'), required=False, metavar="FILE",
 		help="File in which to save logs, comments and warnings")
+	ioGroup.add_argument("--log-level", type=str, choices=job_log.levelNames, default=job_log.defaultLevel, metavar="LEVEL",
+		help=f"Log only messages at least as important as LEVEL, one of {', '.join(job_log.levelNames)}: \"comment\" adds gcode comments, \"trace\" every command sent and reply received (default: {job_log.defaultLevel})")
+	ioGroup.add_argument("--log-format", type=str, choices=job_log.formats, default="text", metavar="FORMAT",
+		help="Write logs as plain \"text\" (default) or as \"json\" lines with time, level and message")
+	ioGroup.add_argument("--stats", type=str, choices=["summary", "json"], metavar="FORMAT",
+		help="Print the time spent sending, the number of commands and bytes sent and the latency of acknowledgements to stderr, either as a human readable \"summary\" or as \"json\"")
 
 	connGroup = argParser.add_argument_group("Plotter connectivity options")
 	connGroup.add_argument("--simulate", action="store_true",
@@ -64,6 +384,16 @@ def parseArgs(namespace):
 		help="The serial port the plotter is connected to (required unless there is --simulate)")
 	connGroup.add_argument("--baud", "--baud-rate", type=int, metavar="RATE", dest="baud_rate",
 		help="The baud rate to use for the connection with the plotter. It has to be equal to the plotter baud rate. (required unless there is --simulate)")
+	connGroup.add_argument("--stop-and-wait", action="store_true",
+		help=f"Wait for the reply to every command before sending the next one, even if the plotter could receive more commands in advance. Without it the protocol of the plotter is queried, and plotters with an older firmware take {protocolQueryTimeout:g}s to time out before sending starts, even for version 1 binary data")
+
+	resumeGroup = argParser.add_argument_group("Resume options")
+	resumeGroup.add_argument("--journal", type=str, default=job_journal.defaultPath, metavar="FILE",
+		help=f"File in which to save the progress of the job, so that it can be resumed if interrupted (default: {job_journal.defaultPath})")
+	resumeGroup.add_argument("--no-journal", action="store_true",
+		help="Do not save the progress of the job")
+	resumeGroup.add_argument("--resume", action="store_true",
+		help="Continue the job saved in the journal from where it was interrupted: the pen is moved up to the last checkpoint and only the remaining commands are sent")
 
 	argParser.parse_args(namespace=namespace)
 
@@ -73,18 +403,23 @@ def parseArgs(namespace):
 			argParser.error(f"--serial-port is required unless there is --simulate")
 		if namespace.baud_rate is None:
 			argParser.error(f"--baud-rate is required unless there is --simulate")
+	if namespace.resume and namespace.no_journal:
+		argParser.error("--resume needs the journal and can't be used with --no-journal")
 
 def main():
 	class Args: pass
 	parseArgs(Args)
 
-	def log(*args, **kwargs):
-		if Args.log is not None:
-			kwargs["flush"] = True
-			print(*args, **kwargs, file=Args.log)
-
-	data = Args.input.read()
-	sendData(data, Args.serial_port, Args.baud_rate, Args.simulate, log=log)
+	log = job_log.noLog if Args.log is None else job_log.Logger(Args.log, Args.log_level, Args.log_format, background=True)
+	stats = job_stats.noStats if Args.stats is None else job_stats.Stats()
+	with stats.stage("read"):
+		data = mapInput(Args.input)
+	# simulating does not move the plotter, so it must not touch the journal
+	journal = None if Args.no_journal or Args.simulate else job_journal.JobJournal(Args.journal, log=log)
+	sendData(data, Args.serial_port, Args.baud_rate, Args.simulate, log=log, stats=stats, windowed=not Args.stop_and_wait,
+		journal=journal, resume=Args.resume)
+	if Args.stats is not None:
+		stats.write(sys.stderr, Args.stats)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,115 @@
+import unittest
+import gcode_parser
+
+
+def linesFromDeltas(deltas, pen=1):
+	"""Parsed lines reaching the points obtained by moving by every delta in turn"""
+	x, y = 0, 0
+	lines = []
+	for deltaX, deltaY in deltas:
+		x, y = x + deltaX, y + deltaY
+		lines.append(gcode_parser.ParsedLine.fromRawCoordinates(pen, x, y))
+	return lines
+
+def decodedPositions(data):
+	"""Absolute positions reached by the commands in binary data of either format"""
+	x, y = 0, 0
+	positions = []
+	for mode, deltaX, deltaY, _, _ in gcode_parser.iterBinaryCommands(data):
+		x, y = x + deltaX, y + deltaY
+		positions.append((mode, x, y))
+	return positions
+
+def recordLengths(data):
+	return [length for _, _, _, _, length in gcode_parser.iterBinaryCommands(data)]
+
+
+class TestRoundTrip(unittest.TestCase):
+	def assertRoundTrip(self, deltas, lengths):
+		lines = linesFromDeltas(deltas)
+		compact = gcode_parser.toCompactBinaryData(lines)
+		self.assertEqual(recordLengths(compact), lengths)
+		decoded = [(deltaX, deltaY) for _, deltaX, deltaY, _, _ in gcode_parser.iterBinaryCommands(compact)]
+		self.assertEqual(decoded, deltas)
+		self.assertEqual(gcode_parser.toSimpleBinaryData(compact), gcode_parser.toBinaryData(lines))
+
+	def test_tinyDeltas(self):
+		self.assertRoundTrip([(-4, 3), (3, -4), (-4, -4), (3, 3), (0, 0), (-1, 1)], [1] * 6)
+		self.assertRoundTrip([(4, 0), (0, -5), (-5, 3), (3, 4)], [3] * 4)
+
+	def test_shortDeltas(self):
+		self.assertRoundTrip([(-128, 127), (127, -128), (-128, -128), (127, 127)], [3] * 4)
+		self.assertRoundTrip([(128, 0), (0, -129), (-129, 127), (127, 128)], [5] * 4)
+
+	def test_int16Deltas(self):
+		self.assertRoundTrip([(32767, -32767), (-32767, 32767), (32767, 0), (-32768, -32768)], [5] * 4)
+
+	def test_splitBeyondInt16(self):
+		for deltaX, deltaY, parts in [(32768, 0, 2), (-32769, 1, 2), (-70000, 5, 3), (3, 100000, 4)]:
+			data = gcode_parser.toBinaryData(linesFromDeltas([(deltaX, deltaY)]))
+			records = list(gcode_parser.iterBinaryCommands(data))
+			self.assertEqual(len(records), parts)
+			for mode, partX, partY, _, _ in records:
+				self.assertEqual(mode, gcode_parser.writeByte)
+				self.assertLessEqual(abs(partX), gcode_parser.maxBinaryDelta)
+				self.assertLessEqual(abs(partY), gcode_parser.maxBinaryDelta)
+			self.assertEqual(decodedPositions(data)[-1], (gcode_parser.writeByte, deltaX, deltaY))
+
+	def test_sameDecodedPositions(self):
+		deltas = [(1, 2), (-4, 3), (100, -7), (-300, 20), (40000, -2), (0, 0), (-3, -128), (5, 32767)]
+		lines = linesFromDeltas(deltas)
+		# moves with the pen up in between
+		for line in lines[::3]:
+			line[gcode_parser.AttrType.pen] = 0
+		simple = decodedPositions(gcode_parser.toBinaryData(lines))
+		self.assertEqual(decodedPositions(gcode_parser.toCompactBinaryData(lines)), simple)
+		self.assertEqual(simple[-1][1:], (sum(x for x, _ in deltas), sum(y for _, y in deltas)))
+		self.assertEqual([mode for mode, _, _ in simple][:4],
+			[gcode_parser.moveByte, gcode_parser.writeByte, gcode_parser.writeByte, gcode_parser.moveByte])
+
+	def test_roundedPositions(self):
+		# rounding errors must not add up
+		lines = [gcode_parser.ParsedLine.fromRawCoordinates(1, 0.6 * i, -0.6 * i) for i in range(1, 100)]
+		for data in (gcode_parser.toBinaryData(lines), gcode_parser.toCompactBinaryData(lines)):
+			self.assertEqual([(x, y) for _, x, y in decodedPositions(data)],
+				[(round(0.6 * i), round(-0.6 * i)) for i in range(1, 100)])
+
+
+class TestHeader(unittest.TestCase):
+	def test_compactHeader(self):
+		data = gcode_parser.toCompactBinaryData(linesFromDeltas([(1, 1), (200, 0)]))
+		self.assertEqual(data[:2], gcode_parser.compactHeader)
+		self.assertEqual([offset for _, _, _, offset, _ in gcode_parser.iterBinaryCommands(data)], [2, 3])
+		self.assertEqual(gcode_parser.countBinaryCommands(data), 2)
+
+	def test_emptyData(self):
+		self.assertEqual(gcode_parser.toCompactBinaryData([]), gcode_parser.compactHeader)
+		self.assertEqual(list(gcode_parser.iterBinaryCommands(gcode_parser.compactHeader)), [])
+		self.assertEqual(gcode_parser.toBinaryData([]), b"")
+
+	def test_simpleDataHasNoHeader(self):
+		data = gcode_parser.toBinaryData(linesFromDeltas([(1, 1), (200, 0)]))
+		self.assertEqual(recordLengths(data), [5, 5])
+		self.assertEqual(gcode_parser.countBinaryCommands(data), 2)
+
+
+class TestInvalidData(unittest.TestCase):
+	def assertInvalid(self, data, message):
+		with self.assertRaisesRegex(ValueError, message):
+			list(gcode_parser.iterBinaryCommands(data))
+
+	def test_truncatedRecords(self):
+		simple = gcode_parser.toBinaryData(linesFromDeltas([(1000, 0), (0, 1000)]))
+		for end in range(6, len(simple)):
+			self.assertInvalid(simple[:end], "truncated record at offset 5")
+		compact = gcode_parser.toCompactBinaryData(linesFromDeltas([(1, 1), (100, 0), (1000, 0)]))
+		self.assertInvalid(compact[:4], "truncated record at offset 3")
+		self.assertInvalid(compact[:8], "truncated record at offset 6")
+
+	def test_unknownRecords(self):
+		self.assertInvalid(b"x\x00\x01\x00\x01", "unknown record type 120 at offset 0")
+		self.assertInvalid(gcode_parser.compactHeader + b"\x80\x00", "unknown record type 0 at offset 3")
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,33 @@
+import io
+import unittest
+import serial
+import emulator
+import gcode_parser
+import sender
+
+
+class TestReconnect(unittest.TestCase):
+	def setUp(self):
+		self.record = io.BytesIO()
+		self.emulator = emulator.PlotterEmulator(speed=20, bootTime=0.5, recordFile=self.record)
+		self.port = self.emulator.start()
+
+	def tearDown(self):
+		self.emulator.stop()
+
+	def test_reopenedPortResets(self):
+		# closing and opening the port right away must reset the plotter every time
+		for _ in range(10):
+			with serial.Serial(self.port, 9600, timeout=3) as ser:
+				self.assertEqual(ser.readline(), b"Setup\r\n")
+
+	def test_backToBackJobs(self):
+		data = gcode_parser.toBinaryData(gcode_parser.parseGcode("G0 X0 Y0\nG1 X40 Y0\nG1 X40 Y30\nG0 X0 Y0\n", True))
+		for _ in range(5):
+			sender.sendData(data, self.port, 9600)
+		self.assertEqual(self.emulator.jobsCompleted, 5)
+		self.assertEqual(self.record.getvalue(), data * 5)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,100 @@
+import io
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+import emulator
+import farm
+import gcode_parser
+import job_cache
+
+options = dict(xSize=100.0, ySize=100.0, dilation=1.0, end_home=False, optimize_travel=False,
+	keep_stroke_direction=False, simplify=None, binary_format=1, use_g=False,
+	feed_visible_below=None, speed_visible_below=None, sample_lines=None)
+
+def zigzagGcode(moveCount, step):
+	return "".join(f"G{i % 2} X{(i % 2) * step} Y{i * 2}\n" for i in range(moveCount))
+
+class TestPlotterFarm(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.records = [io.BytesIO(), io.BytesIO()]
+		self.emulators = [emulator.PlotterEmulator(speed=50, bootTime=0.5, recordFile=record) for record in self.records]
+		self.ports = [plotter.start() for plotter in self.emulators]
+
+	def tearDown(self):
+		for plotter in self.emulators:
+			plotter.stop()
+		shutil.rmtree(self.directory)
+
+	def writeJobs(self, count, moveCount=150):
+		"""Binary jobs of the same length and with different contents, returns their paths and data"""
+		paths, jobs = [], []
+		for i in range(count):
+			data = gcode_parser.toBinaryData(gcode_parser.parseGcode(zigzagGcode(moveCount, 20 + i), True))
+			path = os.path.join(self.directory, f"job{i}.bin")
+			with open(path, "wb") as file:
+				file.write(data)
+			paths.append(path)
+			jobs.append(data)
+		return paths, jobs
+
+	def printedJobs(self, record, jobLength):
+		data = record.getvalue()
+		return [data[offset:offset+jobLength] for offset in range(0, len(data), jobLength)]
+
+	def test_allJobsPrinted(self):
+		paths, jobs = self.writeJobs(4)
+		plotterFarm = farm.PlotterFarm(self.ports, 9600, options, prepareWorkers=1)
+		plotterFarm.run(paths)
+
+		self.assertEqual(plotterFarm.unprintedPaths(), [])
+		self.assertEqual(sum(plotter.jobsPrinted for plotter in plotterFarm.plotters), 4)
+		printed = self.printedJobs(self.records[0], len(jobs[0])) + self.printedJobs(self.records[1], len(jobs[0]))
+		self.assertEqual(sorted(printed), sorted(jobs))
+		# the port of every plotter is opened only once, instead of resetting it for every job
+		self.assertEqual([plotter.connections for plotter in self.emulators], [1, 1])
+
+	def test_failedPlotterJobGoesToOther(self):
+		paths, jobs = self.writeJobs(3)
+		failing = self.emulators[0]
+		def unplugMidJob():
+			# once the first plotter has drawn part of its first job
+			while self.records[0].tell() < len(jobs[0]) // 3:
+				time.sleep(0.01)
+			failing.unplug()
+		threading.Thread(target=unplugMidJob, daemon=True).start()
+
+		plotterFarm = farm.PlotterFarm(self.ports, 9600, options, prepareWorkers=1)
+		plotterFarm.run(paths)
+
+		failed, working = plotterFarm.plotters
+		self.assertTrue(failed.failed)
+		self.assertEqual(failed.jobsPrinted, 0)
+		self.assertFalse(working.failed)
+		self.assertEqual(working.jobsPrinted, 3)
+		self.assertEqual(self.emulators[1].connections, 1)
+		self.assertEqual(plotterFarm.unprintedPaths(), [])
+		self.assertEqual(sorted(self.printedJobs(self.records[1], len(jobs[0]))), sorted(jobs))
+
+	def test_gcodeJobSharesCacheWithPrint(self):
+		path = os.path.join(self.directory, "job.gcode")
+		with open(path, "w") as file:
+			file.write(zigzagGcode(40, 30))
+		cacheDirectory = os.path.join(self.directory, "cache")
+		plotterFarm = farm.PlotterFarm(self.ports[:1], 9600, options, prepareWorkers=1, cacheDirectory=cacheDirectory)
+		plotterFarm.run([path])
+
+		with open(path, "r") as file:
+			data = file.read()
+		binaryData, _ = gcode_parser.gcodeToBinary(data, options)
+		self.assertEqual(self.records[0].getvalue(), binaryData)
+		# the key print.py gcode uses for the same input and options
+		key = job_cache.jobKey(job_cache.hashData(data), dict(options, subcommand="gcode"))
+		self.assertEqual(job_cache.JobCache(cacheDirectory).get(key)[0], binaryData)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,86 @@
+import io
+import random
+import unittest
+import gcode_parser
+
+options = dict(xSize=100.0, ySize=100.0, dilation=1.0, end_home=False, optimize_travel=False,
+	keep_stroke_direction=False, simplify=None, binary_format=1, use_g=True,
+	feed_visible_below=None, speed_visible_below=None, sample_lines=None)
+
+
+class TestNothingToPrint(unittest.TestCase):
+	inputs = ["", "; only a comment\n", "G0 X10 Y10\nG0 X20 Y5\n"]
+
+	def test_inMemory(self):
+		for data in self.inputs:
+			for endHome in (False, True):
+				for binaryFormat in (1, 2):
+					with self.subTest(data=data, endHome=endHome, binaryFormat=binaryFormat):
+						with self.assertRaisesRegex(ValueError, "does not contain any line to print"):
+							gcode_parser.gcodeToBinary(data, dict(options, end_home=endHome, binary_format=binaryFormat))
+
+	def test_stream(self):
+		for data in self.inputs:
+			with self.subTest(data=data):
+				with self.assertRaisesRegex(ValueError, "does not contain any line to print"):
+					list(gcode_parser.streamGcode(io.StringIO(data), 100.0, 100.0, 1.0, False, useG=True))
+
+
+def mixedGcode(lineCount, seed):
+	"""
+	Strokes of moves with and without G or F words, separated by travel moves, with comments,
+	repeated points, unknown words and unclosed comments, so that chunk seams fall anywhere
+	"""
+	rng = random.Random(seed)
+	lines = []
+	while len(lines) < lineCount:
+		x, y = rng.randint(0, 200), rng.randint(0, 200)
+		lines.append(rng.choice([f"G0 X{x} Y{y}", f"G1 X{x} Y{y} F3000", f"G0 X{x} Y{y} (travel)", "(new stroke)"]))
+		for _ in range(rng.randint(1, 12)):
+			x += rng.choice([-1, 0, 1])
+			y += rng.choice([-1, 0, 1])
+			lines.append(rng.choice([f"G1 X{x} Y{y}", f"X{x} Y{y}", f"X{x}", f"Y{y}", f"G1 X{x} Y{y} F800",
+				f"G1 X{x} Y{y} (stroke)", f"X{x} Y{y} M3", "", "( only a comment )", f"G1 X{x} Y{y} (unclosed"]))
+	return "\n".join(lines) + "\n"
+
+class Messages(list):
+	"""A log function keeping the messages"""
+	def __call__(self, *args, **kwargs):
+		self.append((args, kwargs))
+
+
+class TestParallelParser(unittest.TestCase):
+	def assertSameAsSequential(self, data, workers, **parsingMode):
+		sequentialLog, parallelLog = Messages(), Messages()
+		sequential = gcode_parser.parseGcode(data, log=sequentialLog, **parsingMode)
+		parallel = gcode_parser.parseGcodeParallel(data, workers=workers, log=parallelLog, **parsingMode)
+		for column in ("pen", "x", "y", "lineNr"):
+			self.assertEqual(getattr(parallel, column), getattr(sequential, column), column)
+		self.assertEqual(parallelLog, sequentialLog)
+
+	def test_seams(self):
+		seamLines = []
+		for seed in range(3):
+			data = mixedGcode(600, seed)
+			for workers in (2, 3):
+				# the first line of every chunk but the first one
+				seamLines += [text.split("\n")[0] for text, _ in gcode_parser._splitChunks(data, workers * 4)[1:]]
+				for parsingMode in (dict(useG=True), dict(feedVisibleBelow=1000.0)):
+					with self.subTest(seed=seed, workers=workers, **parsingMode):
+						self.assertSameAsSequential(data, workers, **parsingMode)
+
+		# seams inside strokes, on comments and where the pen changes
+		self.assertTrue(any(line.startswith(("X", "Y")) for line in seamLines))
+		self.assertTrue(any("(" in line for line in seamLines))
+		self.assertTrue(any(line.startswith("G0") or "F" in line for line in seamLines))
+
+	def test_chunkStartingWithoutCoordinates(self):
+		# the second half only sets some attributes, which come from the end of the first one
+		data = "G1 X5 Y5\nG1 X6 Y6\n" * 50 + "Y9\n(comment)\nG0\nX7\n" * 50
+		for workers in (2, 4):
+			with self.subTest(workers=workers):
+				self.assertSameAsSequential(data, workers, useG=True)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,47 @@
+import os
+import shutil
+import tempfile
+import unittest
+import gcode_parser
+
+try:
+	import text_to_gcode.text_to_gcode as text_to_gcode
+	import glyph_cache
+except ImportError:
+	text_to_gcode = None
+
+text = "Hello world\nthe quick  brown fox\n\njumps over\nthe lazy dog "
+lineLength, lineSpacing, padding = 100.0, 8.0, 1.5
+
+
+@unittest.skipIf(text_to_gcode is None, "the text_to_gcode submodule is missing")
+class TestLayoutText(unittest.TestCase):
+	def setUp(self):
+		self.directory = os.path.join(os.path.dirname(text_to_gcode.__file__), "ascii_gcode")
+		self.letters = text_to_gcode.readLetters(self.directory)
+		gcode = text_to_gcode.textToGcode(self.letters, text, lineLength, lineSpacing, padding)
+		self.expected = gcode_parser.parseGcode(gcode, True)
+
+	def assertSameLayout(self, glyphs):
+		path = glyph_cache.layoutText(glyphs, text, lineLength, lineSpacing, padding)
+		self.assertEqual(list(path.pen), list(self.expected.pen))
+		self.assertEqual(list(path.x), list(self.expected.x))
+		self.assertEqual(list(path.y), list(self.expected.y))
+		self.assertEqual(list(path.lineNr), list(self.expected.lineNr))
+		self.assertEqual(gcode_parser.toBinaryData(path), gcode_parser.toBinaryData(self.expected))
+
+	def test_sameAsParsedGcode(self):
+		self.assertSameLayout(glyph_cache.parseLetters(self.letters))
+
+	def test_cachedGlyphs(self):
+		cacheDirectory = tempfile.mkdtemp()
+		try:
+			glyph_cache.loadGlyphs(self.directory, cacheDirectory)
+			# the second load reads the cache file
+			self.assertSameLayout(glyph_cache.loadGlyphs(self.directory, cacheDirectory))
+		finally:
+			shutil.rmtree(cacheDirectory)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,91 @@
+import io
+import os
+import json
+import time
+import shutil
+import tempfile
+import unittest
+import unittest.mock
+import emulator
+import gcode_parser
+import print_daemon
+
+
+def zigzagData(moveCount, step=40):
+	lines = [f"G{i % 2} X{(i % 2) * step} Y{i * 2}" for i in range(moveCount)]
+	return gcode_parser.toBinaryData(gcode_parser.parseGcode("\n".join(lines) + "\n", True))
+
+class TestPrintDaemon(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.record = io.BytesIO()
+		self.emulator = emulator.PlotterEmulator(speed=20, bootTime=0.5, recordFile=self.record)
+		self.port = self.emulator.start()
+		self.daemon = print_daemon.PrintDaemon(os.path.join(self.directory, "daemon.sock"), [self.port], 9600)
+		self.socketPath = self.daemon.start()
+
+	def tearDown(self):
+		self.daemon.stop()
+		self.emulator.stop()
+		shutil.rmtree(self.directory)
+
+	def waitIdle(self):
+		for _ in range(100):
+			status = print_daemon.queryStatus(self.socketPath)
+			if status["queued"] == 0 and not status["plotters"][0]["busy"]:
+				return status
+			time.sleep(0.1)
+		self.fail("the daemon did not finish the job")
+
+	def test_completedJob(self):
+		data = zigzagData(10)
+		print_daemon.sendJob(data, self.socketPath)
+		self.assertEqual(self.emulator.jobsCompleted, 1)
+		self.assertEqual(self.record.getvalue(), data)
+		self.assertEqual(self.waitIdle()["plotters"][0]["jobsPrinted"], 1)
+
+	def test_jobsOnSameConnection(self):
+		first, second = zigzagData(6), zigzagData(8, step=20)
+		print_daemon.sendJob(first, self.socketPath)
+		connection = self.daemon.plotters[0].connection
+		print_daemon.sendJob(second, self.socketPath)
+		self.assertIs(self.daemon.plotters[0].connection, connection)
+		self.assertEqual(self.emulator.jobsCompleted, 2)
+		self.assertEqual(self.record.getvalue(), first + second)
+
+	def test_cancelledOnDisconnect(self):
+		data = zigzagData(400, step=100)
+		client = print_daemon._request(self.socketPath, dict(command="print", size=len(data)), data)
+		with client, client.makefile("rb") as file:
+			for line in file:
+				if json.loads(line)["event"] == "progress":
+					break
+		self.waitIdle()
+		self.assertLess(len(self.record.getvalue()), len(data))
+		# the plotter is still usable
+		print_daemon.sendJob(zigzagData(4), self.socketPath)
+		plotter = self.waitIdle()["plotters"][0]
+		self.assertEqual(plotter["jobsPrinted"], 1)
+		self.assertEqual(plotter["jobsCancelled"], 1)
+
+	def test_malformedJob(self):
+		with self.assertRaisesRegex(print_daemon.JobFailed, "unknown record type"):
+			print_daemon.sendJob(b"x\x00\x01\x00\x02", self.socketPath)
+		with self.assertRaisesRegex(print_daemon.JobFailed, "truncated record"):
+			print_daemon.sendJob(zigzagData(4)[:-2], self.socketPath)
+		data = zigzagData(4)
+		print_daemon.sendJob(data, self.socketPath)
+		self.assertEqual(self.record.getvalue(), data)
+
+	def test_unexpectedErrorKeepsPlotter(self):
+		with unittest.mock.patch.object(print_daemon.sender, "sendData", side_effect=RuntimeError("unexpected")):
+			with self.assertRaisesRegex(print_daemon.JobFailed, "unexpected"):
+				print_daemon.sendJob(zigzagData(4), self.socketPath)
+		data = zigzagData(4)
+		print_daemon.sendJob(data, self.socketPath)
+		self.assertEqual(self.record.getvalue(), data)
+		self.assertEqual(self.waitIdle()["plotters"][0]["jobsPrinted"], 1)
+
+
+if __name__ == "__main__":
+	unittest.main()
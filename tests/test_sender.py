@@ -0,0 +1,76 @@
+import io
+import threading
+import unittest
+import emulator
+import gcode_parser
+import sender
+
+sendTimeout = 30 # seconds
+
+
+def mixedData(moveCount, binaryFormat):
+	"""Strokes of varied lengths, so that version 2 data has records of every size"""
+	lines = []
+	for i in range(moveCount):
+		step = (2, 20, 150)[i % 3]
+		lines.append(f"G{i % 2} X{(i % 4) * step} Y{i * 3}")
+	parsedGcode = gcode_parser.parseGcode("\n".join(lines) + "\n", True)
+	if binaryFormat == 2:
+		return gcode_parser.toCompactBinaryData(parsedGcode)
+	return gcode_parser.toBinaryData(parsedGcode)
+
+class Messages(list):
+	"""A log function keeping the messages"""
+	def __call__(self, *args, **kwargs):
+		self.append(" ".join(str(arg) for arg in args))
+
+
+class TestWindowedSending(unittest.TestCase):
+	def sendToEmulator(self, data, windowed, protocolVersion=3):
+		record = io.BytesIO()
+		plotter = emulator.PlotterEmulator(protocolVersion, speed=500, bootTime=0.5, recordFile=record)
+		port = plotter.start()
+		messages = Messages()
+		errors = []
+		def send():
+			try:
+				sender.sendData(data, port, 9600, log=messages, windowed=windowed)
+			except Exception as e:
+				errors.append(e)
+		# the sender waits forever for the replies to commands lost in an overflow
+		thread = threading.Thread(target=send, daemon=True)
+		thread.start()
+		thread.join(sendTimeout)
+		completed = not thread.is_alive()
+		plotter.stop()
+
+		self.assertEqual(plotter.overflows, 0)
+		self.assertTrue(completed, "the job did not complete")
+		if errors:
+			raise errors[0]
+		self.assertEqual(plotter.jobsCompleted, 1)
+		self.assertEqual(record.getvalue(), gcode_parser.toSimpleBinaryData(data))
+		return messages
+
+	def test_windowed(self):
+		for binaryFormat in (1, 2):
+			with self.subTest(binaryFormat=binaryFormat):
+				messages = self.sendToEmulator(mixedData(150, binaryFormat), windowed=True)
+				self.assertTrue(any("commands ahead" in message for message in messages))
+
+	def test_stopAndWait(self):
+		for binaryFormat in (1, 2):
+			with self.subTest(binaryFormat=binaryFormat):
+				messages = self.sendToEmulator(mixedData(150, binaryFormat), windowed=False)
+				self.assertFalse(any("commands ahead" in message for message in messages))
+
+	def test_olderFirmware(self):
+		# plotters without a window get one command at a time even if sending ahead is allowed
+		for protocolVersion in (1, 2):
+			with self.subTest(protocolVersion=protocolVersion):
+				messages = self.sendToEmulator(mixedData(60, 1), windowed=True, protocolVersion=protocolVersion)
+				self.assertFalse(any("commands ahead" in message for message in messages))
+
+
+if __name__ == "__main__":
+	unittest.main()